@@ -1,15 +1,898 @@
 from hdbcli import dbapi
+from elasticsearch import ConflictError, NotFoundError
+from elasticsearch.serializer import JsonSerializer
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+import collections
+import hashlib
+import heapq
+import json
 import logging
+import mmap
+import os
+import queue
+import random
+import threading
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 LOGGER : logging.Logger = None
 
 
+class ResultStream:
+    """ Risultati di una query SAP HANA letti in streaming.
+
+    Le righe vengono lette dal cursore a blocchi di `batch_size` tramite fetchmany,
+    così in memoria resta al più un blocco alla volta indipendentemente dalla dimensione del risultato.
+    Se viene indicata una colonna `track_max`, durante la lettura ne viene mantenuto il valore massimo.
+    Con `columnar` impostato i blocchi sono `ColumnBatch` invece di liste di dizionari.
+    """
+
+    def __init__(self, cursor, batch_size, track_max=None):
+        self._cursor = cursor
+        self._batch_size = batch_size
+        self.description = cursor.description
+        self.columns = [col[0] for col in cursor.description]
+        self.schema = self._build_schema(cursor.description)
+        self.rows_fetched = 0
+        # Tempi (in secondi) di esecuzione della query, lettura dal cursore e costruzione dei dizionari
+        self.execute_time = 0.0
+        self.fetch_time = 0.0
+        self.materialize_time = 0.0
+        self.track_max = track_max
+        self.max_value = None
+        # Conversioni per colonna applicate alla lettura: lista di coppie (indice della colonna, funzione)
+        self.converters = None
+        self.columnar = False
+        # Righe attese, se note prima della lettura (ad esempio da un COUNT(*) preliminare)
+        self.expected_rows = None
+        # Colonna da cui leggere la versione esterna dei documenti, impostata da chi esegue la query
+        self.version_column = None
+        # Query senza il filtro watermark e connessione che l'ha eseguita, impostate da chi applica il filtro
+        self.base_query = None
+        self.connection = None
+
+        if track_max is not None and track_max not in self.columns:
+            raise KeyError(f"Column {track_max!r} not found in query results")
+        self._track_index = self.columns.index(track_max) if track_max is not None else None
+
+    def __iter__(self):
+        try:
+            while True:
+                started = time.perf_counter()
+                rows = self._cursor.fetchmany(self._batch_size)
+                fetched = time.perf_counter()
+                self.fetch_time += fetched - started
+                if not rows:
+                    break
+                self.rows_fetched += len(rows)
+                if self._track_index is not None:
+                    self._update_max(rows)
+                if self.columnar:
+                    batch = ColumnBatch(self.columns, self._convert_columns(rows), self.schema)
+                elif self.converters:
+                    batch = [dict(zip(self.columns, values)) for values in zip(*self._convert_columns(rows))]
+                else:
+                    batch = [dict(zip(self.columns, row)) for row in rows]
+                self.materialize_time += time.perf_counter() - fetched
+                yield batch
+        finally:
+            self.close()
+
+    @staticmethod
+    def _build_schema(description):
+        """ Ricava lo schema dei risultati dalla description del cursore (nome, type code, lunghezza, precisione, scala). """
+
+        schema = []
+        for column in description:
+            column = tuple(column) + (None,) * (7 - len(column))
+            name, type_code, display_size, internal_size, precision, scale, _ = column[:7]
+            schema.append({
+                "name": name,
+                "type_code": type_code,
+                "length": display_size or internal_size,
+                "precision": precision,
+                "scale": scale
+            })
+        return schema
+
+    def _convert_columns(self, rows):
+        # Le conversioni vengono applicate colonna per colonna sull'intero blocco, i valori NULL restano None
+        columns = list(zip(*rows))
+        for index, convert in self.converters or ():
+            columns[index] = [None if value is None else convert(value) for value in columns[index]]
+        return columns
+
+    def _update_max(self, rows):
+        values = [row[self._track_index] for row in rows if row[self._track_index] is not None]
+        if values:
+            batch_max = max(values)
+            if self.max_value is None or batch_max > self.max_value:
+                self.max_value = batch_max
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._cursor is not None:
+            try:
+                self._cursor.close()
+            except dbapi.Error as e:
+                LOGGER.warning(f"Error closing SAP HANA cursor: {e}")
+            self._cursor = None
+
+
+class ColumnBatch:
+    """ Blocco di risultati in formato colonnare: una sequenza di valori per colonna e lo schema condiviso.
+
+    Le righe non vengono trasformate in dizionari durante la lettura: le conversioni e l'estrazione
+    degli identificativi lavorano su intere colonne, e i documenti vengono costruiti solo al momento
+    di serializzarli con `documents`. L'accesso per indice (`batch[0]`) restituisce comunque la riga
+    come dizionario, per il codice che ne legge solo alcune.
+    """
+
+    def __init__(self, columns, data, schema=None):
+        self.columns = list(columns)
+        self.data = list(data)
+        self.schema = schema
+        self._length = len(self.data[0]) if self.data else 0
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, row):
+        return {name: values[row] for name, values in zip(self.columns, self.data)}
+
+    def __iter__(self):
+        for values in zip(*self.data):
+            yield dict(zip(self.columns, values))
+
+    def column(self, name):
+        return self.data[self.columns.index(name)]
+
+    def ids(self, name):
+        """ Identificativi dei documenti letti dalla colonna indicata, convertiti in stringa. """
+
+        return [str(value) for value in self.column(name)]
+
+    def documents(self, columns=None):
+        """ Costruisce i documenti delle righe, con le sole colonne indicate e nel loro ordine (di default tutte). """
+
+        columns = self.columns if columns is None else list(columns)
+        data = [self.data[self.columns.index(name)] for name in columns]
+        for values in zip(*data):
+            yield dict(zip(columns, values))
+
+
+class PartitionedResultStream:
+    """ Risultati di una query letta in parallelo da più cursori, uno per intervallo della colonna chiave.
+
+    Espone la stessa interfaccia di `ResultStream`: ogni partizione viene letta da un thread dedicato
+    e i blocchi vengono passati a chi consuma tramite una coda limitata, quindi l'ordine dei blocchi
+    tra le partizioni non è garantito e in memoria restano al più `queue_size` blocchi in attesa.
+    Alla chiusura vengono chiusi anche i cursori e le connessioni indicate in `connections`,
+    poi viene chiamata una sola volta la funzione `on_close`, se indicata.
+    """
+
+    _DONE = object()
+
+    def __init__(self, streams, connections=(), queue_size=None, on_close=None):
+        self._streams = list(streams)
+        self._connections = list(connections)
+        self._on_close = on_close
+        self._queue = queue.Queue(maxsize=queue_size or 2 * len(self._streams))
+        self._stop = threading.Event()
+        self._threads = []
+        first = self._streams[0]
+        self.description = first.description
+        self.columns = first.columns
+        self.schema = first.schema
+        self.track_max = first.track_max
+        self.expected_rows = None
+        self.version_column = None
+        self.base_query = None
+        self.connection = None
+
+    @property
+    def partitions(self):
+        return len(self._streams)
+
+    @property
+    def converters(self):
+        return self._streams[0].converters
+
+    @converters.setter
+    def converters(self, converters):
+        for stream in self._streams:
+            stream.converters = converters
+
+    @property
+    def columnar(self):
+        return self._streams[0].columnar
+
+    @columnar.setter
+    def columnar(self, columnar):
+        for stream in self._streams:
+            stream.columnar = columnar
+
+    @property
+    def rows_fetched(self):
+        return sum(stream.rows_fetched for stream in self._streams)
+
+    @property
+    def max_value(self):
+        values = [stream.max_value for stream in self._streams if stream.max_value is not None]
+        return max(values) if values else None
+
+    # I tempi sono la somma di quelli delle partizioni, che in parte si sovrappongono
+    @property
+    def execute_time(self):
+        return sum(stream.execute_time for stream in self._streams)
+
+    @property
+    def fetch_time(self):
+        return sum(stream.fetch_time for stream in self._streams)
+
+    @property
+    def materialize_time(self):
+        return sum(stream.materialize_time for stream in self._streams)
+
+    def _read(self, stream):
+        try:
+            for batch in stream:
+                if not self._put(batch):
+                    return
+            self._put(self._DONE)
+        except BaseException as e:
+            self._put(e)
+
+    def _put(self, item):
+        # Se chi consuma ha chiuso lo stream, il thread termina invece di restare bloccato sulla coda piena
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        try:
+            for stream in self._streams:
+                thread = threading.Thread(target=self._read, args=(stream,), name="partition", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+            running = len(self._streams)
+            while running:
+                item = self._queue.get()
+                if item is self._DONE:
+                    running -= 1
+                elif isinstance(item, BaseException):
+                    raise item
+                else:
+                    yield item
+        finally:
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        for stream in self._streams:
+            stream.close()
+        for connection in self._connections:
+            connection.close()
+        self._connections = []
+        if self._on_close is not None:
+            on_close, self._on_close = self._on_close, None
+            on_close()
+
+
+class KeySet:
+    """ Insieme compatto di chiavi, usato per confrontare decine di milioni di identificativi.
+
+    Ogni chiave viene memorizzata come hash a 64 bit (8 byte) in un array('Q').
+    Le chiavi aggiunte vengono accumulate in un buffer che, una volta pieno, viene ordinato e salvato come run;
+    alla prima ricerca le run vengono fuse in un unico array ordinato, su cui si cerca per bisezione.
+    Una collisione tra hash fa solo considerare presente una chiave che non lo è.
+    """
+
+    def __init__(self, run_size=1_000_000):
+        self._run_size = run_size
+        self._buffer = array("Q")
+        self._runs = []
+        self._keys = array("Q")
+
+    @staticmethod
+    def hash(key) -> int:
+        return int.from_bytes(hashlib.blake2b(str(key).encode("utf-8"), digest_size=8).digest(), "little")
+
+    def add(self, key):
+        self._buffer.append(self.hash(key))
+        if len(self._buffer) >= self._run_size:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self._runs.append(array("Q", sorted(self._buffer)))
+            self._buffer = array("Q")
+
+    def _merge(self) -> array:
+        # Fonde le run in attesa con le chiavi già ordinate, eliminando i duplicati
+        self._flush()
+        if self._runs:
+            merged = array("Q")
+            for value in heapq.merge(self._keys, *self._runs):
+                if not merged or merged[-1] != value:
+                    merged.append(value)
+            self._keys = merged
+            self._runs = []
+        return self._keys
+
+    def __contains__(self, key):
+        keys = self._merge()
+        value = self.hash(key)
+        position = bisect_left(keys, value)
+        return position < len(keys) and keys[position] == value
+
+    def __len__(self):
+        return len(self._merge())
+
+
+class BulkSerializer:
+    """ Serializzatore JSON delle righe NDJSON del bulk e del contenuto su cui si calcola l'hash, basato sul modulo json.
+
+    I tipi non JSON vengono convertiti come fa il client Elasticsearch; con le conversioni per colonna
+    di `ResultStream` arrivano qui già convertiti e il fallback non viene quasi mai usato.
+    """
+
+    name = "json"
+
+    def __init__(self):
+        self._default = JsonSerializer().default
+
+    def dumps(self, data) -> bytes:
+        return json.dumps(data, default=self._default, ensure_ascii=False, separators=(",", ":")).encode("utf-8", "surrogatepass")
+
+    def dumps_sorted(self, data) -> bytes:
+        # Chiavi ordinate, per ottenere sempre gli stessi byte a parità di contenuto
+        return json.dumps(data, default=self._default, ensure_ascii=False, separators=(",", ":"), sort_keys=True).encode("utf-8", "surrogatepass")
+
+
+class OrjsonBulkSerializer(BulkSerializer):
+    """ Serializzatore basato su orjson, disponibile solo se il pacchetto è installato. """
+
+    name = "orjson"
+
+    def dumps(self, data) -> bytes:
+        return orjson.dumps(data, default=self._default)
+
+    def dumps_sorted(self, data) -> bytes:
+        return orjson.dumps(data, default=self._default, option=orjson.OPT_SORT_KEYS)
+
+
+def create_bulk_serializer(kind="auto") -> BulkSerializer:
+    """ Crea il serializzatore richiesto: "orjson", "json" o "auto" (orjson se installato).
+    Se orjson è richiesto ma non installato viene usato il modulo json.
+    """
+
+    if kind in ("auto", "orjson") and orjson is not None:
+        return OrjsonBulkSerializer()
+    return BulkSerializer()
+
+
+class BulkController:
+    """ Regola la dimensione dei blocchi bulk in base alla latenza osservata e ai rifiuti di Elasticsearch.
+
+    Finché il `took` delle richieste resta sotto la latenza obiettivo la dimensione cresce gradualmente,
+    sopra l'obiettivo si riduce in proporzione e a ogni rifiuto (429) si dimezza, sempre tra il minimo e il massimo.
+    Un solo controller viene condiviso da tutti i Code, che scrivono sullo stesso cluster.
+    """
+
+    def __init__(self, initial, minimum, maximum, target_latency_ms, adaptive=True, initial_backoff=1.0, max_backoff=30.0):
+        self._chunk_docs = initial
+        self._minimum = minimum
+        self._maximum = maximum
+        self._target = target_latency_ms
+        self._adaptive = adaptive
+        self._initial_backoff = initial_backoff
+        self._max_backoff = max_backoff
+        self._lock = threading.Lock()
+
+    @property
+    def chunk_docs(self):
+        return self._chunk_docs
+
+    def observe(self, docs, took_ms, rejected):
+        """ Aggiorna la dimensione dei blocchi dopo una richiesta di `docs` operazioni, durata `took_ms`,
+        in cui `rejected` operazioni sono state rifiutate per sovraccarico. """
+
+        if not self._adaptive:
+            return
+
+        with self._lock:
+            current = self._chunk_docs
+            if rejected:
+                target = current // 2
+            elif docs < current // 2:
+                # Un blocco piccolo (ad esempio l'ultimo di un Code) non dice nulla sulla capacità del cluster
+                return
+            elif took_ms < self._target * 0.8:
+                target = max(current + 1, int(current * 1.25))
+            elif took_ms > self._target * 1.2:
+                target = int(current * self._target / took_ms)
+            else:
+                return
+
+            self._chunk_docs = min(self._maximum, max(self._minimum, target))
+            if self._chunk_docs != current:
+                LOGGER.debug(f"Bulk chunk size changed from {current} to {self._chunk_docs} docs (took {took_ms}ms, {rejected} rejected)")
+
+    def backoff(self, attempt) -> float:
+        """ Attesa in secondi prima del tentativo successivo: esponenziale con jitter, fino al massimo configurato. """
+
+        delay = min(self._max_backoff, self._initial_backoff * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+
+class SnapshotWriter:
+    """ Scrive su disco lo snapshot dei risultati di una query figlia.
+
+    Lo snapshot è formato da due file: `<nome>.ndjson`, con un blocco di righe per linea (ogni riga come
+    array JSON dei valori), e `<nome>.json` con colonne, schema e posizione (offset, lunghezza, righe) di ogni
+    blocco, che permette di leggere i blocchi con mmap senza scorrere il file. I file vengono scritti con
+    estensione `.tmp` e rinominati solo da `close`, quindi uno snapshot incompleto non viene mai letto.
+    """
+
+    def __init__(self, path, columns, schema, serializer):
+        self.path = path
+        self.columns = list(columns)
+        self.schema = schema
+        self.rows = 0
+        self._serializer = serializer
+        self._batches = []
+        self._offset = 0
+        self._file = open(f"{path}.ndjson.tmp", "wb")
+
+    def write(self, rows):
+        """ Aggiunge un blocco, come sequenza di righe ognuna con i valori nell'ordine delle colonne. """
+
+        rows = [list(row) for row in rows]
+        if not rows:
+            return
+        line = self._serializer.dumps(rows) + b"\n"
+        self._file.write(line)
+        self._batches.append([self._offset, len(line) - 1, len(rows)])
+        self._offset += len(line)
+        self.rows += len(rows)
+
+    def close(self, metadata=None):
+        """ Completa lo snapshot scrivendo i metadati, a cui vengono aggiunti quelli indicati. """
+
+        self._file.close()
+        content = dict(metadata or {})
+        content.update({"columns": self.columns, "schema": self.schema, "rows": self.rows, "batches": self._batches})
+        with open(f"{self.path}.json.tmp", "wb") as metadata_file:
+            metadata_file.write(self._serializer.dumps(content))
+        os.replace(f"{self.path}.ndjson.tmp", f"{self.path}.ndjson")
+        os.replace(f"{self.path}.json.tmp", f"{self.path}.json")
+
+    def abort(self):
+        # Anche lo snapshot precedente viene eliminato, per non caricare dati più vecchi dell'esportazione fallita
+        self._file.close()
+        for suffix in (".ndjson.tmp", ".json.tmp", ".ndjson", ".json"):
+            try:
+                os.remove(f"{self.path}{suffix}")
+            except FileNotFoundError:
+                pass
+
+
+class SnapshotReader:
+    """ Risultati di una query figlia riletti da uno snapshot scritto da `SnapshotWriter`.
+
+    Espone la stessa interfaccia di `ResultStream`, così il caricamento su Elasticsearch non cambia.
+    Il file dei dati viene mappato in memoria e i blocchi vengono decodificati uno alla volta.
+    I valori sono già quelli convertiti durante l'esportazione, quindi non servono conversioni.
+    """
+
+    def __init__(self, path, metadata=None):
+        if metadata is None:
+            with open(f"{path}.json", "rb") as metadata_file:
+                metadata = json.loads(metadata_file.read())
+        self.path = path
+        self.metadata = metadata
+        self.columns = metadata["columns"]
+        self.schema = metadata["schema"]
+        self.description = None
+        self.rows_fetched = 0
+        self.execute_time = 0.0
+        self.fetch_time = 0.0
+        self.materialize_time = 0.0
+        self.track_max = metadata.get("track_max")
+        self.expected_rows = metadata["rows"]
+        self.version_column = None
+        self.max_value = None
+        self.converters = None
+        self.columnar = False
+        self.base_query = None
+        self.connection = None
+        self._file = open(f"{path}.ndjson", "rb")
+        self._map = None
+
+    def __iter__(self):
+        loads = orjson.loads if orjson is not None else json.loads
+        try:
+            if not self.metadata["batches"]:
+                return
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            for offset, length, _ in self.metadata["batches"]:
+                started = time.perf_counter()
+                rows = loads(self._map[offset:offset + length])
+                parsed = time.perf_counter()
+                self.fetch_time += parsed - started
+                self.rows_fetched += len(rows)
+                if self.columnar:
+                    batch = ColumnBatch(self.columns, list(zip(*rows)), self.schema)
+                else:
+                    batch = [dict(zip(self.columns, row)) for row in rows]
+                self.materialize_time += time.perf_counter() - parsed
+                yield batch
+        finally:
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class RunJournal:
+    """ Diario di un'esecuzione, salvato su file per riprendere un'esecuzione interrotta.
+
+    Per ogni Code registra lo stato ("in_progress" o "completed") e l'indice in cui viene caricato. Non viene
+    registrata la posizione raggiunta: riprendendo un indice la query figlia viene riletta per intero e sono gli
+    hash del contenuto a evitare di reinviare i documenti già caricati. Il file viene scritto in un file
+    temporaneo e poi rinominato, così resta valido anche se il processo viene terminato durante la scrittura.
+    """
+
+    def __init__(self, path, update_mode, entries=None, started_at=None):
+        self.path = path
+        self.update_mode = update_mode
+        self.started_at = started_at or time.time()
+        self.codes = entries or {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path, update_mode, clean_start=False, max_age=None):
+        """ Carica il diario dell'esecuzione precedente se può essere ripresa, altrimenti ne inizia uno nuovo.
+
+        Il diario precedente viene ignorato se è richiesta una partenza pulita, se è stato scritto in un'altra
+        modalità di aggiornamento o se è più vecchio di `max_age` secondi.
+        """
+
+        if clean_start or not os.path.exists(path):
+            return cls(path, update_mode)
+
+        try:
+            with open(path, encoding="utf-8") as journal_file:
+                data = json.load(journal_file)
+        except (OSError, ValueError) as e:
+            LOGGER.warning(f"Could not read run journal {path}, starting a new run: {e}")
+            return cls(path, update_mode)
+
+        if data.get("update_mode") != update_mode:
+            LOGGER.info(f"Run journal {path} was written in {data.get('update_mode')} mode, starting a new run")
+            return cls(path, update_mode)
+        if max_age is not None and time.time() - data.get("started_at", 0) > max_age:
+            LOGGER.info(f"Run journal {path} is older than {max_age} seconds, starting a new run")
+            return cls(path, update_mode)
+
+        return cls(path, update_mode, entries=data.get("codes", {}), started_at=data.get("started_at"))
+
+    @property
+    def resumed(self):
+        return bool(self.codes)
+
+    def get(self, code):
+        with self._lock:
+            return dict(self.codes.get(code, {}))
+
+    def is_completed(self, code):
+        return self.get(code).get("status") == "completed"
+
+    def start(self, code, index):
+        with self._lock:
+            self.codes[code] = {"status": "in_progress", "index": index, "updated_at": time.time()}
+        self.save()
+
+    def complete(self, code):
+        with self._lock:
+            entry = self.codes.setdefault(code, {})
+            entry.update({"status": "completed", "updated_at": time.time()})
+        self.save()
+
+    def discard(self, code):
+        with self._lock:
+            self.codes.pop(code, None)
+        self.save()
+
+    def save(self):
+        with self._lock:
+            content = json.dumps({"update_mode": self.update_mode, "started_at": self.started_at, "codes": self.codes}, indent=2)
+            try:
+                temp_path = f"{self.path}.tmp"
+                with open(temp_path, "w", encoding="utf-8") as journal_file:
+                    journal_file.write(content)
+                os.replace(temp_path, self.path)
+            except OSError as e:
+                LOGGER.error(f"Error writing run journal {self.path}: {e}")
+
+    def remove(self):
+        with self._lock:
+            self.codes = {}
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                LOGGER.error(f"Error removing run journal {self.path}: {e}")
+
+
+class LeaseCoordinator:
+    """ Coordina più istanze che sincronizzano gli stessi Code tramite lease salvati in un indice di controllo.
+
+    Ogni Code ha un documento (con _id il Code in minuscolo) che indica l'istanza proprietaria e la scadenza
+    del lease. Un lease viene acquisito solo se è libero o scaduto, con una scrittura condizionata da
+    `if_seq_no`/`if_primary_term` (o con la creazione del documento se non esiste): se due istanze
+    ci provano insieme, una sola scrittura riesce. I lease acquisiti vengono rinnovati da un thread ogni
+    terzo della durata; quelli di un'istanza terminata scadono e vengono ripresi dalle altre.
+    Se un rinnovo scopre che il lease è stato ripreso da un'altra istanza, il Code viene segnato come perso
+    e `is_lost` lo segnala alla sincronizzazione in corso, che deve interrompersi.
+    """
+
+    def __init__(self, client, index, owner, ttl):
+        self.index = index
+        self.owner = owner
+        self.ttl = ttl
+        self._client = client
+        self._leases = {}
+        self._write_locks = {}
+        self._lost = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def acquire(self, code, completed_after=None) -> bool:
+        """ Prova ad acquisire il lease di un Code.
+
+        Args:
+            code (str): Il Code.
+            completed_after (float): Se il Code è stato completato da un'istanza dopo questo istante
+                (epoch in secondi), il lease non viene acquisito.
+
+        Returns:
+            bool: True se il lease è stato acquisito.
+        """
+
+        doc_id = code.lower()
+        now = time.time()
+        try:
+            current = self._client.get(index=self.index, id=doc_id)
+        except NotFoundError:
+            current = None
+
+        source = dict(current["_source"]) if current else {}
+        if source.get("owner") and source.get("expires_at", 0) > now:
+            return False
+        if completed_after is not None and source.get("completed_at") is not None and source["completed_at"] >= completed_after:
+            return False
+        if source.get("owner"):
+            LOGGER.info(f"Taking over expired lease of CODE: {code!r} from worker {source['owner']!r}")
+
+        source.update({"code": code, "owner": self.owner, "status": "running", "acquired_at": now, "expires_at": now + self.ttl})
+        try:
+            if current:
+                response = self._client.index(
+                    index=self.index, id=doc_id, document=source,
+                    if_seq_no=current["_seq_no"], if_primary_term=current["_primary_term"]
+                )
+            else:
+                response = self._client.create(index=self.index, id=doc_id, document=source)
+        except ConflictError:
+            # Un'altra istanza ha scritto il documento dopo la lettura
+            return False
+
+        with self._lock:
+            self._leases[doc_id] = (source, response["_seq_no"], response["_primary_term"])
+            self._write_locks[doc_id] = threading.Lock()
+            self._lost.discard(doc_id)
+        return True
+
+    def is_lost(self, code) -> bool:
+        """ Indica se il lease di un Code acquisito da questa istanza è stato ripreso da un'altra istanza. """
+
+        with self._lock:
+            return code.lower() in self._lost
+
+    def _write(self, doc_id, changes) -> bool:
+        # La richiesta a Elasticsearch avviene fuori da self._lock, così un rinnovo lento non blocca gli altri Code;
+        # il lock del singolo lease mette in sequenza rinnovo e rilascio, che scrivono lo stesso documento
+        with self._lock:
+            write_lock = self._write_locks.get(doc_id)
+        if write_lock is None:
+            return False
+
+        with write_lock:
+            with self._lock:
+                if doc_id not in self._leases:
+                    return False
+                source, seq_no, primary_term = self._leases[doc_id]
+            source = dict(source, **changes)
+            try:
+                response = self._client.index(
+                    index=self.index, id=doc_id, document=source, if_seq_no=seq_no, if_primary_term=primary_term
+                )
+            except ConflictError:
+                with self._lock:
+                    self._leases.pop(doc_id, None)
+                    self._lost.add(doc_id)
+                LOGGER.error(f"Lease of CODE: {source.get('code')!r} was taken over by another worker")
+                return False
+            with self._lock:
+                if doc_id in self._leases:
+                    self._leases[doc_id] = (source, response["_seq_no"], response["_primary_term"])
+            return True
+
+    def renew(self) -> None:
+        """ Prolunga la scadenza di tutti i lease acquisiti. """
+
+        with self._lock:
+            doc_ids = list(self._leases)
+        for doc_id in doc_ids:
+            try:
+                self._write(doc_id, {"expires_at": time.time() + self.ttl})
+            except Exception as e:
+                # Il rinnovo viene ritentato al giro successivo, prima della scadenza
+                LOGGER.warning(f"Error renewing lease {doc_id!r}: {e}")
+
+    def release(self, code, completed) -> None:
+        """ Rilascia il lease di un Code, registrandone il completamento se la sincronizzazione è riuscita. """
+
+        doc_id = code.lower()
+        changes = {"owner": None, "expires_at": 0, "status": "completed" if completed else "failed"}
+        if completed:
+            changes["completed_at"] = time.time()
+        try:
+            self._write(doc_id, changes)
+        except Exception as e:
+            # Il lease scade comunque e viene ripreso da un'altra istanza
+            LOGGER.warning(f"Error releasing lease of CODE: {code!r}: {e}")
+        with self._lock:
+            self._leases.pop(doc_id, None)
+            self._write_locks.pop(doc_id, None)
+            self._lost.discard(doc_id)
+
+    def start(self) -> None:
+        def heartbeat():
+            while not self._stop.wait(self.ttl / 3):
+                self.renew()
+
+        self._thread = threading.Thread(target=heartbeat, name="lease-heartbeat", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class SearchCache:
+    """ Cache LRU dei risultati delle ricerche, con scadenza e invalidazione legata ai dati dell'indice.
+
+    Ogni voce è associata alla versione dell'indice con cui è stata calcolata (ad esempio il last_sync
+    dei metadati) e vale solo finché la versione non cambia e non sono passati `ttl` secondi.
+    La versione di un indice viene riletta al più ogni `revalidate` secondi.
+    Tutti i metodi possono essere chiamati da più thread contemporaneamente.
+
+    Args:
+        max_entries (int): Numero massimo di risultati in memoria, oltre il quale si scartano i meno usati.
+        ttl (float): Durata massima in secondi di una voce.
+        revalidate (float): Secondi per cui la versione letta di un indice viene considerata attuale.
+    """
+
+    def __init__(self, max_entries, ttl, revalidate=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.revalidate = revalidate
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._versions = {}
+
+    @staticmethod
+    def key(index, query):
+        # Query uguali con le chiavi in ordine diverso condividono la stessa voce
+        return index, json.dumps(query, sort_keys=True, separators=(",", ":"), default=str)
+
+    def version(self, index, loader):
+        """ Restituisce la versione di un indice, chiamando `loader(index)` se quella letta non è più recente. """
+
+        now = time.monotonic()
+        with self._lock:
+            cached = self._versions.get(index)
+            if cached is not None and now - cached[1] < self.revalidate:
+                return cached[0]
+        version = loader(index)
+        with self._lock:
+            self._versions[index] = (version, now)
+        return version
+
+    def get(self, key, version):
+        """ Restituisce il risultato salvato per `key` con questa versione dell'indice, None se assente o scaduto. """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] != version or time.monotonic() >= entry[2]:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, version, value):
+        with self._lock:
+            self._entries[key] = (value, version, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def expire_versions(self):
+        # Le versioni vanno rilette alla prossima ricerca, ad esempio dopo un aggiornamento dei metadati
+        with self._lock:
+            self._versions.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+
 class SAP_HANA:
-    def __init__(self, host, port, user, password):
+    def __init__(self, host, port, user, password, fetch_size=5000):
         self._host = host
         self._port = port
         self._user = user
         self._password = password
+        self._fetch_size = fetch_size
         self._connection = None
         self._cursor = None
 
@@ -27,15 +910,248 @@ class SAP_HANA:
             LOGGER.warning(f"Error connecting to SAP HANA: {e}")
 
 
-    def execute(self, query):
-        if not self._cursor:
+    def close(self):
+        if self._connection:
+            try:
+                self._connection.close()
+            except dbapi.Error as e:
+                LOGGER.warning(f"Error closing SAP HANA connection: {e}")
+        self._connection = None
+        self._cursor = None
+
+
+    def is_connected(self):
+        if not self._connection:
+            return False
+        try:
+            return self._connection.isconnected()
+        except dbapi.Error:
+            return False
+
+
+    def ensure_connected(self):
+        """ Riapre la connessione se non è mai stata aperta o se è caduta.
+
+        Raises:
+            ConnectionError: Se non è possibile connettersi a SAP HANA.
+        """
+
+        if self.is_connected():
+            return
+        if self._connection:
+            LOGGER.warning("SAP HANA connection lost, reconnecting")
+            self.close()
+        self.connect()
+        if not self._connection:
             raise ConnectionError("Not connected to SAP HANA")
 
+
+    def execute(self, query):
+        # Se la connessione cade durante la query, la query (di sola lettura) viene rieseguita una volta dopo la riconnessione
+        for attempt in range(2):
+            self.ensure_connected()
+            try:
+                self._cursor.execute(query)
+                columns = [col[0] for col in self._cursor.description]
+                rows = self._cursor.fetchall()
+                return [dict(zip(columns, row)) for row in rows]
+            except dbapi.Error as e:
+                if attempt == 0 and not self.is_connected():
+                    LOGGER.warning(f"SAP HANA connection lost while executing query, retrying: {e}")
+                    continue
+                LOGGER.error(f"Error executing query: {e}")
+                raise
+
+
+    def execute_stream(self, query, batch_size=None, params=None, track_max=None) -> ResultStream:
+        """ Esegue la query su un cursore dedicato e restituisce i risultati in streaming.
+
+        Args:
+            query (str): La query da eseguire.
+            batch_size (int): Numero di righe lette per ogni fetchmany, di default quello della connessione.
+            params (list): Parametri della query, da associare ai segnaposto `?`.
+            track_max (str): Colonna di cui mantenere il valore massimo durante la lettura.
+
+        Raises:
+            ConnectionError: Se non è possibile connettersi a SAP HANA.
+
+        Returns:
+            ResultStream: Iterabile che restituisce i risultati a blocchi di dizionari.
+        """
+
+        # Come in `execute`, una connessione caduta viene riaperta e la query rieseguita una volta
+        for attempt in range(2):
+            self.ensure_connected()
+            cursor = None
+            try:
+                cursor = self._connection.cursor()
+                started = time.perf_counter()
+                if params:
+                    cursor.execute(query, params)
+                else:
+                    cursor.execute(query)
+                results = ResultStream(cursor, batch_size or self._fetch_size, track_max=track_max)
+                results.execute_time = time.perf_counter() - started
+                return results
+            except (dbapi.Error, KeyError) as e:
+                if cursor:
+                    cursor.close()
+                if attempt == 0 and isinstance(e, dbapi.Error) and not self.is_connected():
+                    LOGGER.warning(f"SAP HANA connection lost while executing query, retrying: {e}")
+                    continue
+                LOGGER.error(f"Error executing query: {e}")
+                raise
+
+
+class SAP_HANA_Pool:
+    """ Pool di connessioni SAP HANA da condividere tra più worker.
+
+    Il numero di connessioni è fisso: un worker che ne richiede una quando sono tutte
+    in uso resta in attesa, così il carico su SAP HANA non supera mai la dimensione del pool.
+    Una connessione caduta viene riaperta quando viene presa in prestito.
+    """
+
+    def __init__(self, size, host, port, user, password, fetch_size=5000):
+        self._size = size
+        self._connections = []
+        self._available = queue.Queue()
+
+        for _ in range(size):
+            connection = SAP_HANA(host, port, user, password, fetch_size=fetch_size)
+            connection.connect()
+            self._connections.append(connection)
+            self._available.put(connection)
+
+        LOGGER.info(f"SAP HANA connection pool initialized with {size} connections")
+
+    @property
+    def size(self):
+        return self._size
+
+    @contextmanager
+    def connection(self):
+        """ Prende in prestito una connessione dal pool e la restituisce al termine. """
+
+        connection = self._available.get()
+        try:
+            connection.ensure_connected()
+            yield connection
+        finally:
+            self._available.put(connection)
+
+    def close(self):
+        for connection in self._connections:
+            connection.close()
+        LOGGER.info("SAP HANA connection pool closed")
+
+class RunMetrics:
+    """ Tempi e contatori di un'esecuzione, raccolti per Code e per fase.
+
+    I tempi sono in secondi e, per le fasi eseguite in parallelo (ad esempio più richieste bulk in corso),
+    sono la somma dei tempi dei singoli thread; una fase può includerne altre (la riconciliazione include
+    il bulk delle eliminazioni). Le operazioni non legate a un Code usano `code=None`.
+    Tutti i metodi possono essere chiamati da più thread contemporaneamente.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self._codes = {}
+
+    def _entry(self, code):
+        return self._codes.setdefault(code, {"stages": {}, "counters": {}, "status": None})
+
+    @contextmanager
+    def timer(self, code, stage):
+        started = time.perf_counter()
         try:
-            self._cursor.execute(query)
-            columns = [col[0] for col in self._cursor.description]
-            rows = self._cursor.fetchall()
-            return [dict(zip(columns, row)) for row in rows]
-        except dbapi.Error as e:
-            LOGGER.error(f"Error executing query: {e}")
-            raise
\ No newline at end of file
+            yield
+        finally:
+            self.add_time(code, stage, time.perf_counter() - started)
+
+    def add_time(self, code, stage, seconds):
+        with self._lock:
+            stages = self._entry(code)["stages"]
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+    def increment(self, code, counter, value=1):
+        with self._lock:
+            counters = self._entry(code)["counters"]
+            counters[counter] = counters.get(counter, 0) + value
+
+    def set_status(self, code, status):
+        with self._lock:
+            self._entry(code)["status"] = status
+
+    def report(self) -> dict:
+        """ Restituisce il riepilogo dell'esecuzione, con le velocità calcolate sul tempo totale di ogni Code. """
+
+        with self._lock:
+            codes = {}
+            for code, entry in self._codes.items():
+                if code is None:
+                    continue
+                total = entry["stages"].get("total", 0.0)
+                counters = entry["counters"]
+                codes[code] = {
+                    "status": entry["status"],
+                    "stages": {stage: round(seconds, 6) for stage, seconds in entry["stages"].items()},
+                    "counters": dict(counters),
+                    "rows_per_second": round(counters.get("rows", 0) / total, 2) if total else None,
+                    "docs_per_second": round(counters.get("docs", 0) / total, 2) if total else None
+                }
+            run = self._codes.get(None, {"stages": {}, "counters": {}})
+            return {
+                "started_at": self.started_at,
+                "finished_at": time.time(),
+                "duration": round(time.time() - self.started_at, 6),
+                "stages": {stage: round(seconds, 6) for stage, seconds in run["stages"].items()},
+                "counters": dict(run["counters"]),
+                "codes": codes
+            }
+
+    def to_prometheus(self, prefix="radar") -> str:
+        """ Restituisce i tempi e i contatori nel formato testuale di Prometheus (textfile collector). """
+
+        def label(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        report = self.report()
+        lines = [
+            f"# HELP {prefix}_run_duration_seconds Duration of the run.",
+            f"# TYPE {prefix}_run_duration_seconds gauge",
+            f"{prefix}_run_duration_seconds {report['duration']}",
+            f"# HELP {prefix}_run_finished_timestamp_seconds Time the report was written.",
+            f"# TYPE {prefix}_run_finished_timestamp_seconds gauge",
+            f"{prefix}_run_finished_timestamp_seconds {report['finished_at']}"
+        ]
+
+        lines += [
+            f"# HELP {prefix}_stage_seconds_total Time spent per code and stage, summed across threads.",
+            f"# TYPE {prefix}_stage_seconds_total counter"
+        ]
+        for stage, seconds in report["stages"].items():
+            lines.append(f'{prefix}_stage_seconds_total{{code="",stage="{label(stage)}"}} {seconds}')
+        for code, entry in report["codes"].items():
+            for stage, seconds in entry["stages"].items():
+                lines.append(f'{prefix}_stage_seconds_total{{code="{label(code)}",stage="{label(stage)}"}} {seconds}')
+
+        counters = sorted({counter for entry in report["codes"].values() for counter in entry["counters"]})
+        for counter in counters:
+            lines += [
+                f"# HELP {prefix}_{counter}_total Total {counter} per code.",
+                f"# TYPE {prefix}_{counter}_total counter"
+            ]
+            for code, entry in report["codes"].items():
+                if counter in entry["counters"]:
+                    lines.append(f'{prefix}_{counter}_total{{code="{label(code)}"}} {entry["counters"][counter]}')
+
+        lines += [
+            f"# HELP {prefix}_code_success Whether the last synchronization of the code succeeded.",
+            f"# TYPE {prefix}_code_success gauge"
+        ]
+        for code, entry in report["codes"].items():
+            if entry["status"] is not None:
+                lines.append(f'{prefix}_code_success{{code="{label(code)}"}} {1 if entry["status"] == "ok" else 0}')
+
+        return "\n".join(lines) + "\n"
@@ -1,3 +1,4 @@
+import json
 import os
 
 APP_NAME = os.getenv("APP_NAME", "Elastic Search <-> SAP Integration")
@@ -20,10 +21,272 @@ SAP_HANA_USER = os.getenv("SAP_HANA_USER", None)
 SAP_HANA_PASSWORD = os.getenv("SAP_HANA_PASSWORD", None)
 SAP_DATABASE = os.getenv("SAP_DATABASE", None)
 SAP_HANA_MASTER_QUERY = os.getenv("SAP_HANA_MASTER_QUERY", "SELECT * FROM \"@KAIROS_RADAR\"")
+# Numero di righe lette per ogni fetchmany dalle query figlie
+SAP_HANA_FETCH_SIZE = int(os.getenv("SAP_HANA_FETCH_SIZE", "5000"))
 
 if SAP_HANA_HOST is None or SAP_HANA_PORT is None or SAP_HANA_USER is None or SAP_HANA_PASSWORD is None:
     raise ValueError("Please set SAP_HANA_HOST, SAP_HANA_PORT, SAP_HANA_USER, and SAP_HANA_PASSWORD in your environment variables.")
 
+if SAP_HANA_FETCH_SIZE <= 0:
+    raise ValueError("SAP_HANA_FETCH_SIZE must be a positive integer. Current value: {}".format(SAP_HANA_FETCH_SIZE))
+
+# Parametri del bulk indexing su Elasticsearch
+BULK_CHUNK_DOCS = int(os.getenv("BULK_CHUNK_DOCS", "1000"))                 # Documenti massimi per richiesta bulk
+BULK_CHUNK_BYTES = int(os.getenv("BULK_CHUNK_BYTES", str(10 * 1024 * 1024)))  # Byte massimi per richiesta bulk
+BULK_MAX_IN_FLIGHT = int(os.getenv("BULK_MAX_IN_FLIGHT", "2"))              # Richieste bulk contemporanee per indice
+BULK_REQUEST_TIMEOUT = int(os.getenv("BULK_REQUEST_TIMEOUT", "60"))         # Timeout HTTP di ogni richiesta bulk (secondi)
+
+if BULK_CHUNK_DOCS <= 0 or BULK_CHUNK_BYTES <= 0 or BULK_MAX_IN_FLIGHT <= 0:
+    raise ValueError("BULK_CHUNK_DOCS, BULK_CHUNK_BYTES and BULK_MAX_IN_FLIGHT must be positive integers.")
+
+# Dimensionamento adattivo dei blocchi: BULK_CHUNK_DOCS è la dimensione iniziale, che cresce o si riduce
+# tra BULK_MIN_CHUNK_DOCS e BULK_MAX_CHUNK_DOCS per mantenere il took delle richieste vicino a BULK_TARGET_LATENCY_MS
+BULK_ADAPTIVE = os.getenv("BULK_ADAPTIVE", "true").lower() == "true"
+BULK_MIN_CHUNK_DOCS = int(os.getenv("BULK_MIN_CHUNK_DOCS", "100"))
+BULK_MAX_CHUNK_DOCS = int(os.getenv("BULK_MAX_CHUNK_DOCS", "10000"))
+BULK_TARGET_LATENCY_MS = int(os.getenv("BULK_TARGET_LATENCY_MS", "1000"))
+
+# Le operazioni rifiutate per sovraccarico (429) vengono ritentate da sole, con attesa esponenziale
+BULK_MAX_RETRIES = int(os.getenv("BULK_MAX_RETRIES", "5"))
+BULK_RETRY_INITIAL_BACKOFF = float(os.getenv("BULK_RETRY_INITIAL_BACKOFF", "1"))  # Secondi
+BULK_RETRY_MAX_BACKOFF = float(os.getenv("BULK_RETRY_MAX_BACKOFF", "30"))         # Secondi
+
+if not 0 < BULK_MIN_CHUNK_DOCS <= BULK_CHUNK_DOCS <= BULK_MAX_CHUNK_DOCS:
+    raise ValueError("BULK_CHUNK_DOCS must be between BULK_MIN_CHUNK_DOCS and BULK_MAX_CHUNK_DOCS, which must be positive.")
+
+if BULK_TARGET_LATENCY_MS <= 0 or BULK_MAX_RETRIES < 0 or BULK_RETRY_INITIAL_BACKOFF < 0 or BULK_RETRY_MAX_BACKOFF < 0:
+    raise ValueError("BULK_TARGET_LATENCY_MS must be positive, BULK_MAX_RETRIES and the retry backoffs must not be negative.")
+
+# Numero di Code sincronizzati in parallelo (e di connessioni SAP HANA nel pool)
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", "1"))
+SYNC_MAX_WORKERS = 16
+
+if SYNC_WORKERS < 1 or SYNC_WORKERS > SYNC_MAX_WORKERS:
+    raise ValueError("SYNC_WORKERS must be between 1 and {}. Current value: {}".format(SYNC_MAX_WORKERS, SYNC_WORKERS))
+
+# Modalità della pipeline di caricamento:
+# THREADED esegue estrazione e bulk in sequenza per ogni blocco,
+# ASYNC sovrappone l'estrazione da SAP HANA al bulk su Elasticsearch tramite una coda limitata
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "THREADED").upper()
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))  # Blocchi bulk in attesa nella coda
+PIPELINE_WRITERS = int(os.getenv("PIPELINE_WRITERS", "2"))        # Writer bulk asincroni per Code
+
+if PIPELINE_MODE not in ["THREADED", "ASYNC"]:
+    raise ValueError("PIPELINE_MODE must be either 'THREADED' or 'ASYNC'. Current value: {}".format(PIPELINE_MODE))
+
+if PIPELINE_QUEUE_SIZE <= 0 or PIPELINE_WRITERS <= 0:
+    raise ValueError("PIPELINE_QUEUE_SIZE and PIPELINE_WRITERS must be positive integers.")
+
+# Colonne watermark per la sincronizzazione incrementale: il valore nel record master (campo WATERMARK_MASTER_FIELD)
+# ha la precedenza su quello configurato per Code in SAP_HANA_WATERMARK_COLUMNS (JSON, es. {"CODE1": "UpdateDate"}).
+# La colonna deve crescere a ogni modifica di una riga (timestamp o contatore): vengono rilette le righe con valore
+# maggiore o uguale all'ultimo sincronizzato
+WATERMARK_MASTER_FIELD = os.getenv("WATERMARK_MASTER_FIELD", "U_KAI_WATERMARK")
+try:
+    WATERMARK_COLUMNS = json.loads(os.getenv("SAP_HANA_WATERMARK_COLUMNS", "{}"))
+except json.JSONDecodeError as e:
+    raise ValueError("SAP_HANA_WATERMARK_COLUMNS must be a JSON object mapping Code to column name: {}".format(e))
+if not isinstance(WATERMARK_COLUMNS, dict):
+    raise ValueError("SAP_HANA_WATERMARK_COLUMNS must be a JSON object mapping Code to column name.")
+
+# Estrazione partizionata: la query figlia di un Code viene divisa in intervalli della colonna chiave letti in parallelo
+# su connessioni dedicate. Il numero di partizioni viene letto dal campo PARTITIONS_MASTER_FIELD del record master
+# o da EXTRACTION_PARTITIONS (JSON, es. {"CODE1": 4}), altrimenti vale DEFAULT_EXTRACTION_PARTITIONS (1 = disattivata).
+# Le query con meno di EXTRACTION_PARTITION_MIN_ROWS righe vengono comunque lette su un solo cursore
+PARTITIONS_MASTER_FIELD = os.getenv("PARTITIONS_MASTER_FIELD", "U_KAI_PARTITIONS")
+DEFAULT_EXTRACTION_PARTITIONS = int(os.getenv("DEFAULT_EXTRACTION_PARTITIONS", "1"))
+EXTRACTION_PARTITION_MIN_ROWS = int(os.getenv("EXTRACTION_PARTITION_MIN_ROWS", "500000"))
+EXTRACTION_MAX_PARTITIONS = 16
+try:
+    EXTRACTION_PARTITIONS = json.loads(os.getenv("EXTRACTION_PARTITIONS", "{}"))
+except json.JSONDecodeError as e:
+    raise ValueError("EXTRACTION_PARTITIONS must be a JSON object mapping Code to number of partitions: {}".format(e))
+if not isinstance(EXTRACTION_PARTITIONS, dict):
+    raise ValueError("EXTRACTION_PARTITIONS must be a JSON object mapping Code to number of partitions.")
+
+if DEFAULT_EXTRACTION_PARTITIONS < 1 or DEFAULT_EXTRACTION_PARTITIONS > EXTRACTION_MAX_PARTITIONS:
+    raise ValueError("DEFAULT_EXTRACTION_PARTITIONS must be between 1 and {}. Current value: {}".format(EXTRACTION_MAX_PARTITIONS, DEFAULT_EXTRACTION_PARTITIONS))
+
+if EXTRACTION_PARTITION_MIN_ROWS < 0:
+    raise ValueError("EXTRACTION_PARTITION_MIN_ROWS must be zero or a positive integer. Current value: {}".format(EXTRACTION_PARTITION_MIN_ROWS))
+
+# Massimo di connessioni dedicate alle partizioni aperte contemporaneamente da tutti i worker, oltre a quelle
+# del pool: se non ce ne sono abbastanza libere un Code viene letto con meno partizioni (o su un solo cursore)
+EXTRACTION_MAX_CONNECTIONS = int(os.getenv("EXTRACTION_MAX_CONNECTIONS", "8"))
+if EXTRACTION_MAX_CONNECTIONS < 0:
+    raise ValueError("EXTRACTION_MAX_CONNECTIONS must be zero or a positive integer. Current value: {}".format(EXTRACTION_MAX_CONNECTIONS))
+
 UPDATE_MODE = os.getenv("UPDATE_MODE", "INCREMENTAL").upper()
 if UPDATE_MODE not in ["FULL", "INCREMENTAL"]:
-    raise ValueError("UPDATE_MODE must be either 'FULL' or 'INCREMENTAL'. Current value: {}".format(UPDATE_MODE))
\ No newline at end of file
+    raise ValueError("UPDATE_MODE must be either 'FULL' or 'INCREMENTAL'. Current value: {}".format(UPDATE_MODE))
+
+# Impostazioni di produzione degli indici
+INDEX_REPLICAS = int(os.getenv("INDEX_REPLICAS", "0"))
+INDEX_REFRESH_INTERVAL = os.getenv("INDEX_REFRESH_INTERVAL", "1s")
+
+# Profilo di caricamento: durante il bulk di un Code refresh e fsync del translog vengono sospesi e ripristinati
+# al termine, anche in caso di errore. Le repliche vengono tolte solo alle nuove generazioni non ancora dietro l'alias;
+# sull'indice attivo di un Code INCREMENTAL il profilo si attiva solo dopo BULK_LOAD_PROFILE_MIN_DOCS documenti inviati
+BULK_LOAD_PROFILE_ENABLED = os.getenv("BULK_LOAD_PROFILE_ENABLED", "true").lower() == "true"
+BULK_LOAD_PROFILE_MIN_DOCS = int(os.getenv("BULK_LOAD_PROFILE_MIN_DOCS", "10000"))
+if BULK_LOAD_PROFILE_MIN_DOCS < 0:
+    raise ValueError("BULK_LOAD_PROFILE_MIN_DOCS must be zero or a positive integer. Current value: {}".format(BULK_LOAD_PROFILE_MIN_DOCS))
+FORCE_MERGE_AFTER_LOAD = os.getenv("FORCE_MERGE_AFTER_LOAD", "false").lower() == "true"
+FORCE_MERGE_MAX_SEGMENTS = int(os.getenv("FORCE_MERGE_MAX_SEGMENTS", "1"))
+FORCE_MERGE_TIMEOUT = int(os.getenv("FORCE_MERGE_TIMEOUT", "600"))  # Timeout HTTP del force merge (secondi)
+
+# Mapping esplicito degli indici: le stringhe fino a KEYWORD_MAX_LENGTH caratteri sono keyword, le più lunghe text.
+# INDEX_MAPPING_OVERRIDES permette di sostituire il mapping di singoli campi per Code (JSON, es. {"CODE1": {"Notes": {"type": "text"}}})
+KEYWORD_MAX_LENGTH = int(os.getenv("KEYWORD_MAX_LENGTH", "256"))
+try:
+    INDEX_MAPPING_OVERRIDES = json.loads(os.getenv("INDEX_MAPPING_OVERRIDES", "{}"))
+except json.JSONDecodeError as e:
+    raise ValueError("INDEX_MAPPING_OVERRIDES must be a JSON object mapping Code to field mappings: {}".format(e))
+if not isinstance(INDEX_MAPPING_OVERRIDES, dict):
+    raise ValueError("INDEX_MAPPING_OVERRIDES must be a JSON object mapping Code to field mappings.")
+INDEX_MAPPING_OVERRIDES = {code.upper(): fields for code, fields in INDEX_MAPPING_OVERRIDES.items()}
+
+# Dimensionamento degli shard: alla creazione il numero di shard primari viene calcolato dai documenti attesi
+# (conteggio e dimensione salvati nei metadati dall'ultima sincronizzazione o, senza storico e con
+# SHARD_PREFLIGHT_COUNT, un COUNT(*) della query figlia) così che ogni shard resti sotto SHARD_TARGET_SIZE_GB
+# e SHARD_MAX_DOCS documenti, al più INDEX_MAX_SHARDS. Con SHARD_AUTO_RESIZE un indice INCREMENTAL che supera
+# queste soglie viene ricostruito alla sincronizzazione successiva in una nuova generazione con più shard
+SHARD_SIZING_ENABLED = os.getenv("SHARD_SIZING_ENABLED", "true").lower() == "true"
+SHARD_TARGET_SIZE_GB = float(os.getenv("SHARD_TARGET_SIZE_GB", "30"))
+SHARD_MAX_DOCS = int(os.getenv("SHARD_MAX_DOCS", "200000000"))
+SHARD_DEFAULT_DOC_BYTES = int(os.getenv("SHARD_DEFAULT_DOC_BYTES", "1024"))  # Dimensione stimata di un documento senza storico
+SHARD_PREFLIGHT_COUNT = os.getenv("SHARD_PREFLIGHT_COUNT", "false").lower() == "true"
+SHARD_AUTO_RESIZE = os.getenv("SHARD_AUTO_RESIZE", "false").lower() == "true"
+INDEX_MAX_SHARDS = int(os.getenv("INDEX_MAX_SHARDS", "16"))
+
+if SHARD_TARGET_SIZE_GB <= 0 or SHARD_MAX_DOCS <= 0 or SHARD_DEFAULT_DOC_BYTES <= 0 or INDEX_MAX_SHARDS < 1:
+    raise ValueError("SHARD_TARGET_SIZE_GB, SHARD_MAX_DOCS, SHARD_DEFAULT_DOC_BYTES and INDEX_MAX_SHARDS must be positive.")
+
+# Generazioni precedenti dell'indice di un Code da mantenere dopo una ricostruzione FULL (oltre a quella attiva)
+INDEX_GENERATIONS_TO_KEEP = int(os.getenv("INDEX_GENERATIONS_TO_KEEP", "0"))
+if INDEX_GENERATIONS_TO_KEEP < 0:
+    raise ValueError("INDEX_GENERATIONS_TO_KEEP must be zero or a positive integer. Current value: {}".format(INDEX_GENERATIONS_TO_KEEP))
+
+# Rilevamento delle modifiche: in INCREMENTAL vengono reinviati solo i documenti nuovi o con hash del contenuto diverso
+CONTENT_HASH_ENABLED = os.getenv("CONTENT_HASH_ENABLED", "true").lower() == "true"
+CONTENT_HASH_FIELD = os.getenv("CONTENT_HASH_FIELD", "radar_content_hash")
+
+# Scrittura dei documenti: UPSERT li invia come update con doc_as_upsert, per cui Elasticsearch legge e unisce il
+# documento esistente; INDEX come index che lo sostituisce per intero (le query figlie restituiscono righe complete).
+# In INDEX la versione esterna (version_type=external_gte) è il valore della colonna indicata nel campo VERSION_MASTER_FIELD
+# del record master o in SAP_HANA_VERSION_COLUMNS (JSON, es. {"CODE1": "UpdateDate"}), altrimenti della colonna watermark:
+# Elasticsearch rifiuta le righe con una versione più vecchia di quella già indicizzata, mentre con la stessa versione
+# (ad esempio una riga modificata di nuovo nello stesso giorno con una colonna DATE) il documento viene sovrascritto
+BULK_WRITE_MODE = os.getenv("BULK_WRITE_MODE", "UPSERT").upper()
+VERSION_MASTER_FIELD = os.getenv("VERSION_MASTER_FIELD", "U_KAI_VERSION")
+try:
+    VERSION_COLUMNS = json.loads(os.getenv("SAP_HANA_VERSION_COLUMNS", "{}"))
+except json.JSONDecodeError as e:
+    raise ValueError("SAP_HANA_VERSION_COLUMNS must be a JSON object mapping Code to column name: {}".format(e))
+if not isinstance(VERSION_COLUMNS, dict):
+    raise ValueError("SAP_HANA_VERSION_COLUMNS must be a JSON object mapping Code to column name.")
+
+if BULK_WRITE_MODE not in ("UPSERT", "INDEX"):
+    raise ValueError("BULK_WRITE_MODE must be either 'UPSERT' or 'INDEX'. Current value: {}".format(BULK_WRITE_MODE))
+
+# Riconciliazione in INCREMENTAL: i documenti il cui identificativo non è più restituito dalla query figlia
+# vengono eliminati, leggendo gli _id dell'indice a pagine di RECONCILE_PAGE_SIZE tramite point in time
+RECONCILE_DELETES = os.getenv("RECONCILE_DELETES", "true").lower() == "true"
+RECONCILE_PAGE_SIZE = int(os.getenv("RECONCILE_PAGE_SIZE", "10000"))
+RECONCILE_KEEP_ALIVE = os.getenv("RECONCILE_KEEP_ALIVE", "5m")  # Durata del point in time tra una pagina e l'altra
+
+if RECONCILE_PAGE_SIZE <= 0 or RECONCILE_PAGE_SIZE > 10000:
+    raise ValueError("RECONCILE_PAGE_SIZE must be between 1 and 10000. Current value: {}".format(RECONCILE_PAGE_SIZE))
+
+# Ricerche: fino a SEARCH_CACHE_SIZE risultati di `model.search` restano in memoria (LRU, 0 = disattivata) per al più
+# SEARCH_CACHE_TTL secondi e smettono di valere quando cambia il last_sync nei metadati dell'indice, riletto al più ogni
+# SEARCH_CACHE_REVALIDATE secondi. `model.iter_search` legge i risultati grandi a pagine di SEARCH_PAGE_SIZE documenti
+# tramite point in time e search_after
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "256"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "300"))
+SEARCH_CACHE_REVALIDATE = float(os.getenv("SEARCH_CACHE_REVALIDATE", "5"))
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "1000"))
+SEARCH_KEEP_ALIVE = os.getenv("SEARCH_KEEP_ALIVE", "1m")  # Durata del point in time tra una pagina e l'altra
+
+if SEARCH_CACHE_SIZE < 0 or SEARCH_CACHE_TTL <= 0 or SEARCH_CACHE_REVALIDATE < 0:
+    raise ValueError("SEARCH_CACHE_SIZE and SEARCH_CACHE_REVALIDATE must not be negative and SEARCH_CACHE_TTL must be positive.")
+if SEARCH_PAGE_SIZE <= 0 or SEARCH_PAGE_SIZE > 10000:
+    raise ValueError("SEARCH_PAGE_SIZE must be between 1 and 10000. Current value: {}".format(SEARCH_PAGE_SIZE))
+
+# Modalità di esecuzione: ONCE sincronizza tutti i Code una volta e termina, DAEMON resta attivo con le connessioni
+# aperte e sincronizza ogni Code al proprio intervallo (in secondi), letto dal campo SYNC_INTERVAL_MASTER_FIELD
+# del record master o da SYNC_INTERVALS (JSON, es. {"CODE1": 60}), altrimenti DEFAULT_SYNC_INTERVAL
+RUN_MODE = os.getenv("RUN_MODE", "ONCE").upper()
+SYNC_INTERVAL_MASTER_FIELD = os.getenv("SYNC_INTERVAL_MASTER_FIELD", "U_KAI_INTERVAL")
+DEFAULT_SYNC_INTERVAL = int(os.getenv("DEFAULT_SYNC_INTERVAL", "3600"))
+MASTER_REFRESH_INTERVAL = int(os.getenv("MASTER_REFRESH_INTERVAL", "300"))  # Ogni quanto rileggere la query master
+DAEMON_POLL_INTERVAL = float(os.getenv("DAEMON_POLL_INTERVAL", "1"))        # Ogni quanto controllare i Code da sincronizzare
+try:
+    SYNC_INTERVALS = json.loads(os.getenv("SYNC_INTERVALS", "{}"))
+except json.JSONDecodeError as e:
+    raise ValueError("SYNC_INTERVALS must be a JSON object mapping Code to seconds: {}".format(e))
+if not isinstance(SYNC_INTERVALS, dict):
+    raise ValueError("SYNC_INTERVALS must be a JSON object mapping Code to seconds.")
+
+# Ordine di sincronizzazione: i Code prioritari (campo PRIORITY_MASTER_FIELD del record master a 1/Y/true,
+# o elencati in PRIORITY_CODES separati da virgola, senza distinzione tra maiuscole e minuscole) partono per primi, poi gli altri dal più lungo al più breve
+# secondo la durata dell'ultima sincronizzazione salvata nei metadati dell'indice (longest processing time).
+# Con SCHEDULE_BY_COST=false, a parte i prioritari, i Code restano nell'ordine della query master
+SCHEDULE_BY_COST = os.getenv("SCHEDULE_BY_COST", "true").lower() == "true"
+PRIORITY_MASTER_FIELD = os.getenv("PRIORITY_MASTER_FIELD", "U_KAI_PRIORITY")
+PRIORITY_CODES = {code.strip().lower() for code in os.getenv("PRIORITY_CODES", "").split(",") if code.strip()}
+
+if RUN_MODE not in ["ONCE", "DAEMON"]:
+    raise ValueError("RUN_MODE must be either 'ONCE' or 'DAEMON'. Current value: {}".format(RUN_MODE))
+
+if DEFAULT_SYNC_INTERVAL <= 0 or MASTER_REFRESH_INTERVAL <= 0 or DAEMON_POLL_INTERVAL <= 0:
+    raise ValueError("DEFAULT_SYNC_INTERVAL, MASTER_REFRESH_INTERVAL and DAEMON_POLL_INTERVAL must be positive.")
+
+# Snapshot delle estrazioni: EXPORT scrive i risultati completi delle query figlie in SNAPSHOT_DIR senza usare
+# Elasticsearch, LOAD li carica su Elasticsearch con il normale upsert senza interrogare SAP HANA;
+# OFF (default) sincronizza direttamente. Entrambe le modalità richiedono RUN_MODE ONCE
+SNAPSHOT_MODE = os.getenv("SNAPSHOT_MODE", "OFF").upper()
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "./snapshots")
+
+if SNAPSHOT_MODE not in ["OFF", "EXPORT", "LOAD"]:
+    raise ValueError("SNAPSHOT_MODE must be 'OFF', 'EXPORT' or 'LOAD'. Current value: {}".format(SNAPSHOT_MODE))
+
+if SNAPSHOT_MODE != "OFF" and RUN_MODE != "ONCE":
+    raise ValueError("SNAPSHOT_MODE {} requires RUN_MODE ONCE. Current value: {}".format(SNAPSHOT_MODE, RUN_MODE))
+
+# Coordinamento tra più istanze sulla stessa query master: ogni Code viene sincronizzato da una sola istanza alla volta,
+# che ne acquisisce il lease (durata LEASE_TTL secondi, rinnovato durante la sincronizzazione) in COORDINATION_INDEX.
+# In ONCE un Code completato da un'altra istanza dopo l'avvio (meno COORDINATION_RUN_WINDOW secondi) viene saltato,
+# in DAEMON uno completato da meno del suo intervallo di sincronizzazione. WORKER_ID identifica l'istanza (default host-pid)
+COORDINATION_ENABLED = os.getenv("COORDINATION_ENABLED", "false").lower() == "true"
+COORDINATION_INDEX = os.getenv("COORDINATION_INDEX", "radar-coordination").lower()
+LEASE_TTL = int(os.getenv("LEASE_TTL", "300"))
+COORDINATION_RUN_WINDOW = int(os.getenv("COORDINATION_RUN_WINDOW", "600"))
+WORKER_ID = os.getenv("WORKER_ID", "")
+
+if LEASE_TTL < 3 or COORDINATION_RUN_WINDOW < 0:
+    raise ValueError("LEASE_TTL must be at least 3 seconds and COORDINATION_RUN_WINDOW must not be negative.")
+
+# Report dell'esecuzione con tempi e contatori per Code e per fase: JSON e file per il textfile collector
+# di Prometheus, scritti al termine di ogni esecuzione (in DAEMON a ogni rilettura della query master); vuoto per disattivarli
+RUN_REPORT_PATH = os.getenv("RUN_REPORT_PATH", "./logs/run_report.json")
+PROMETHEUS_TEXTFILE_PATH = os.getenv("PROMETHEUS_TEXTFILE_PATH", "./logs/radar.prom")
+
+# Blocchi colonnari: le righe lette da SAP HANA restano una lista di valori per colonna fino alla costruzione
+# dei documenti, invece di un dizionario per riga. Gli hash del contenuto non cambiano tra i due formati
+COLUMNAR_BATCHES = os.getenv("COLUMNAR_BATCHES", "false").lower() == "true"
+
+# Serializzatore JSON del bulk: "auto" usa orjson se installato, altrimenti il modulo json
+JSON_SERIALIZER = os.getenv("JSON_SERIALIZER", "auto").lower()
+if JSON_SERIALIZER not in ["auto", "orjson", "json"]:
+    raise ValueError("JSON_SERIALIZER must be 'auto', 'orjson' or 'json'. Current value: {}".format(JSON_SERIALIZER))
+
+# Diario dell'esecuzione: un'esecuzione ONCE interrotta riprende saltando i Code già completati e, in FULL con
+# CONTENT_HASH_ENABLED, ricaricando la generazione dell'indice lasciata a metà: la query figlia viene riletta per
+# intero e gli hash del contenuto evitano di reinviare i documenti già caricati. RUN_CLEAN_START forza una partenza da zero;
+# un diario più vecchio di RUN_JOURNAL_MAX_AGE secondi viene ignorato. Vuoto per disattivarlo
+RUN_JOURNAL_PATH = os.getenv("RUN_JOURNAL_PATH", "./logs/run_journal.json")
+RUN_CLEAN_START = os.getenv("RUN_CLEAN_START", "false").lower() == "true"
+RUN_JOURNAL_MAX_AGE = int(os.getenv("RUN_JOURNAL_MAX_AGE", str(6 * 3600)))
+if RUN_JOURNAL_MAX_AGE <= 0:
+    raise ValueError("RUN_JOURNAL_MAX_AGE must be a positive number of seconds. Current value: {}".format(RUN_JOURNAL_MAX_AGE))
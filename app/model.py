@@ -1,12 +1,139 @@
 import logging
 import config
 import datetime
-from elasticsearch import Elasticsearch
+import asyncio
+import base64
+import decimal
+import hashlib
+import json
+import math
+import operator
+import os
+import re
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from elasticsearch import Elasticsearch, AsyncElasticsearch
 import classes
 
 LOGGER : logging.Logger = None
 ELASTIC : Elasticsearch = None
+ASYNC_ELASTIC : AsyncElasticsearch = None
 SAP_HANA : classes.SAP_HANA = None
+SAP_HANA_POOL : classes.SAP_HANA_Pool = None
+
+# Connessioni dedicate alle partizioni ancora disponibili, condivise da tutti i worker
+EXTRACTION_CONNECTIONS = threading.BoundedSemaphore(config.EXTRACTION_MAX_CONNECTIONS)
+
+# Cache in-process di metadati e alias degli indici, caricata con due sole richieste e aggiornata
+# a ogni modifica fatta da questa applicazione: {indice: {"metadata": {...}, "aliases": set()}}
+INDEX_CACHE : dict = None
+INDEX_CACHE_LOCK = threading.RLock()
+
+# Mapping Elasticsearch dei type code restituiti da SAP HANA nella description del cursore
+HANA_TYPE_MAPPINGS = {
+    1: {"type": "short"},                 # TINYINT (0-255, non entra in un byte con segno)
+    2: {"type": "short"},                 # SMALLINT
+    3: {"type": "integer"},               # INTEGER
+    4: {"type": "long"},                  # BIGINT
+    5: {"type": "double"},                # DECIMAL
+    6: {"type": "float"},                 # REAL
+    7: {"type": "double"},                # DOUBLE
+    12: {"type": "binary"},               # BINARY
+    13: {"type": "binary"},               # VARBINARY
+    14: {"type": "date"},                 # DATE
+    15: {"type": "keyword"},              # TIME
+    16: {"type": "date"},                 # TIMESTAMP
+    25: {"type": "text"},                 # CLOB
+    26: {"type": "text"},                 # NCLOB
+    27: {"type": "binary"},               # BLOB
+    28: {"type": "boolean"},              # BOOLEAN
+    47: {"type": "double"},               # SMALLDECIMAL
+    51: {"type": "text"},                 # TEXT
+    61: {"type": "date"},                 # LONGDATE
+    62: {"type": "date"},                 # SECONDDATE
+    63: {"type": "date"},                 # DAYDATE
+    64: {"type": "keyword"}               # SECONDTIME
+}
+# Type code delle stringhe: keyword se corte, text oltre config.KEYWORD_MAX_LENGTH caratteri
+HANA_STRING_TYPE_CODES = {8, 9, 10, 11, 29, 30, 35, 52, 55}  # CHAR, VARCHAR, NCHAR, NVARCHAR, STRING, NSTRING, VARCHAR2, SHORTTEXT, ALPHANUM
+
+# Cache dei mapping già ricavati, per Code e hash dello schema
+SCHEMA_CACHE : dict = {}
+
+
+def _read_lob(value):
+    # I LOB di hdbcli vanno letti per intero, gli altri valori restano invariati
+    return value.read() if hasattr(value, "read") else value
+
+
+def _to_base64(value) -> str:
+    return base64.b64encode(_read_lob(value)).decode("ascii")
+
+
+# Conversioni dei valori restituiti da SAP HANA in tipi JSON, per type code: applicate per colonna durante
+# la lettura dei risultati, così la serializzazione non deve riconoscere il tipo di ogni singolo valore
+HANA_VALUE_CONVERTERS = {
+    5: float,                                # DECIMAL
+    47: float,                               # SMALLDECIMAL
+    14: operator.methodcaller("isoformat"),  # DATE
+    15: operator.methodcaller("isoformat"),  # TIME
+    16: operator.methodcaller("isoformat"),  # TIMESTAMP
+    61: operator.methodcaller("isoformat"),  # LONGDATE
+    62: operator.methodcaller("isoformat"),  # SECONDDATE
+    63: operator.methodcaller("isoformat"),  # DAYDATE
+    64: operator.methodcaller("isoformat"),  # SECONDTIME
+    12: _to_base64,                          # BINARY (il tipo binary di Elasticsearch richiede base64)
+    13: _to_base64,                          # VARBINARY
+    27: _to_base64,                          # BLOB
+    25: _read_lob,                           # CLOB
+    26: _read_lob,                           # NCLOB
+    51: _read_lob                            # TEXT
+}
+
+
+def _decimal_key(value):
+    # Le chiavi DECIMAL intere restano int, così l'_id resta "123" e non diventa "123.0"
+    return int(value) if value == value.to_integral_value() else float(value)
+
+
+# Conversioni della colonna chiave, che ha la precedenza su HANA_VALUE_CONVERTERS: l'_id dei documenti
+# e le chiavi lette per la riconciliazione delle eliminazioni vengono ricavati dal valore convertito
+HANA_KEY_CONVERTERS = {
+    5: _decimal_key,                         # DECIMAL
+    47: _decimal_key                         # SMALLDECIMAL
+}
+
+# Serializzatore usato per preparare le righe NDJSON del bulk e calcolare l'hash del contenuto
+BULK_SERIALIZER : classes.BulkSerializer = classes.create_bulk_serializer(config.JSON_SERIALIZER)
+
+# Dimensionamento dei blocchi bulk e attese tra i tentativi, condiviso da tutti i Code
+BULK_CONTROLLER : classes.BulkController = classes.BulkController(
+    initial = config.BULK_CHUNK_DOCS,
+    minimum = config.BULK_MIN_CHUNK_DOCS,
+    maximum = config.BULK_MAX_CHUNK_DOCS,
+    target_latency_ms = config.BULK_TARGET_LATENCY_MS,
+    adaptive = config.BULK_ADAPTIVE,
+    initial_backoff = config.BULK_RETRY_INITIAL_BACKOFF,
+    max_backoff = config.BULK_RETRY_MAX_BACKOFF
+)
+
+# Tempi e contatori dell'esecuzione per Code e per fase, scritti nel report con `write_run_report`
+METRICS : classes.RunMetrics = classes.RunMetrics()
+
+# Diario dell'esecuzione per la ripresa dopo un'interruzione, None se non utilizzato (ad esempio in DAEMON)
+JOURNAL : classes.RunJournal = None
+
+# Lease dei Code condivisi con le altre istanze, None se il coordinamento non è attivo
+COORDINATOR : classes.LeaseCoordinator = None
+COORDINATION_STARTED_AT : float = None
+
+# Risultati delle ricerche in memoria, None se la cache è disattivata
+SEARCH_CACHE : classes.SearchCache = (
+    classes.SearchCache(config.SEARCH_CACHE_SIZE, config.SEARCH_CACHE_TTL, config.SEARCH_CACHE_REVALIDATE)
+    if config.SEARCH_CACHE_SIZE else None
+)
 
 
 def init_elasticsearch() -> Elasticsearch:
@@ -34,6 +161,10 @@ def init_elasticsearch() -> Elasticsearch:
         LOGGER.error("Elasticsearch connection failed")
         raise ConnectionError("Could not connect to Elasticsearch")
 
+    if config.JSON_SERIALIZER == "orjson" and BULK_SERIALIZER.name != "orjson":
+        LOGGER.warning("orjson is not installed, falling back to the json module for bulk serialization")
+    LOGGER.info(f"Using {BULK_SERIALIZER.name} bulk serializer")
+
     elastic_info = ELASTIC.info()
     LOGGER.debug(f"Elasticsearch info: {elastic_info}")
     if 'version' in elastic_info:
@@ -41,95 +172,1840 @@ def init_elasticsearch() -> Elasticsearch:
     else:
         LOGGER.warning("Elasticsearch version information not found in response")
 
-    return ELASTIC
+    return ELASTIC
+
+
+def create_async_elasticsearch() -> AsyncElasticsearch:
+    """ Crea un client asincrono di Elasticsearch, legato all'event loop in cui viene usato.
+
+    Il client va creato e chiuso all'interno dell'event loop che lo utilizza: ogni event loop
+    (ad esempio quelli dei Code sincronizzati in parallelo in DAEMON) deve avere il proprio.
+
+    Returns:
+        AsyncElasticsearch: L'istanza del client asincrono.
+    """
+
+    return AsyncElasticsearch(
+        config.ELASTIC_HOST,
+        basic_auth=(config.ELASTIC_USERNAME, config.ELASTIC_PASSWORD),
+        verify_certs=False,  # Disabilita la verifica del certificato SSL (non consigliato in produzione)
+        request_timeout=30,
+        retry_on_timeout=True,
+        max_retries=3
+    )
+
+
+def init_async_elasticsearch() -> AsyncElasticsearch:
+    """ Inizializza il client asincrono globale di Elasticsearch, usato quando non ne viene passato un altro.
+
+    Returns:
+        AsyncElasticsearch: L'istanza del client asincrono.
+    """
+
+    global ASYNC_ELASTIC
+
+    ASYNC_ELASTIC = create_async_elasticsearch()
+    return ASYNC_ELASTIC
+
+
+def init_coordination() -> classes.LeaseCoordinator:
+    """ Attiva il coordinamento con le altre istanze, creando se serve l'indice di controllo dei lease.
+
+    Raises:
+        ConnectionError: Se la connessione a Elasticsearch non è stata inizializzata.
+
+    Returns:
+        classes.LeaseCoordinator: Il coordinatore, con il rinnovo dei lease già avviato.
+    """
+
+    global COORDINATOR, COORDINATION_STARTED_AT
+
+    if not ELASTIC:
+        raise ConnectionError("Elasticsearch connection not initialized")
+
+    if not ELASTIC.indices.exists(index=config.COORDINATION_INDEX):
+        try:
+            ELASTIC.indices.create(
+                index=config.COORDINATION_INDEX,
+                settings={"number_of_shards": 1},
+                mappings={
+                    "dynamic": False,
+                    "properties": {
+                        "code": {"type": "keyword"},
+                        "owner": {"type": "keyword"},
+                        "status": {"type": "keyword"},
+                        "acquired_at": {"type": "double"},
+                        "expires_at": {"type": "double"},
+                        "completed_at": {"type": "double"}
+                    }
+                }
+            )
+            LOGGER.info(f"Coordination index {config.COORDINATION_INDEX} created")
+        except Exception as e:
+            # Un'altra istanza può averlo creato nel frattempo
+            if not ELASTIC.indices.exists(index=config.COORDINATION_INDEX):
+                LOGGER.error(f"Error creating coordination index {config.COORDINATION_INDEX}: {e}")
+                raise
+
+    worker_id = config.WORKER_ID or f"{socket.gethostname()}-{os.getpid()}"
+    COORDINATION_STARTED_AT = time.time()
+    COORDINATOR = classes.LeaseCoordinator(ELASTIC, config.COORDINATION_INDEX, worker_id, config.LEASE_TTL)
+    COORDINATOR.start()
+    LOGGER.info(f"Coordination enabled as worker {worker_id!r} with {config.LEASE_TTL}s leases")
+    return COORDINATOR
+
+
+def claim_code(row: dict) -> bool:
+    """ Acquisisce il lease di un Code prima di sincronizzarlo, se il coordinamento è attivo.
+
+    Il Code non viene acquisito se un'altra istanza lo sta sincronizzando o lo ha completato di recente:
+    in ONCE dopo l'avvio di questa istanza (meno `config.COORDINATION_RUN_WINDOW`), in DAEMON da meno
+    del suo intervallo di sincronizzazione.
+
+    Args:
+        row (dict): Il record della query master.
+
+    Returns:
+        bool: True se il Code va sincronizzato da questa istanza.
+    """
+
+    if not COORDINATOR:
+        return True
+
+    code = str(row.get("Code", None))
+    if config.RUN_MODE == "DAEMON":
+        completed_after = time.time() - get_sync_interval(row)
+    else:
+        completed_after = COORDINATION_STARTED_AT - config.COORDINATION_RUN_WINDOW
+
+    if not COORDINATOR.acquire(code, completed_after):
+        return False
+
+    # Gli indici possono essere stati modificati da altre istanze dopo il caricamento della cache
+    load_index_cache(force=True)
+    return True
+
+
+def check_lease(code: str) -> None:
+    """ Interrompe la sincronizzazione di un Code se nel frattempo il suo lease è stato ripreso da un'altra istanza.
+
+    Args:
+        code (str): Il Code in sincronizzazione.
+
+    Raises:
+        Exception: Se il lease del Code è stato perso.
+    """
+
+    if COORDINATOR and COORDINATOR.is_lost(code):
+        raise Exception(f"Lease of CODE: {code!r} was taken over by another worker, aborting the sync")
+
+
+def release_code(row: dict, completed: bool) -> None:
+    """ Rilascia il lease di un Code acquisito con `claim_code`. """
+
+    if COORDINATOR:
+        COORDINATOR.release(str(row.get("Code", None)), completed)
+
+
+def init_sap_hana() -> classes.SAP_HANA:
+    """ Inizializza la connessione a SAP HANA.
+
+    Returns:
+        classes.SAP_HANA: L'istanza della connessione a SAP HANA.
+    """
+
+    global SAP_HANA
+
+    SAP_HANA = classes.SAP_HANA(
+        host = config.SAP_HANA_HOST,
+        port = config.SAP_HANA_PORT,
+        user = config.SAP_HANA_USER,
+        password = config.SAP_HANA_PASSWORD,
+        fetch_size = config.SAP_HANA_FETCH_SIZE
+    )
+    SAP_HANA.connect()
+
+    return SAP_HANA
+
+
+def init_sap_hana_pool() -> classes.SAP_HANA_Pool:
+    """ Inizializza il pool di connessioni SAP HANA usato dai worker per le query figlie.
+
+    Returns:
+        classes.SAP_HANA_Pool: Il pool con `config.SYNC_WORKERS` connessioni.
+    """
+
+    global SAP_HANA_POOL
+
+    SAP_HANA_POOL = classes.SAP_HANA_Pool(
+        size = config.SYNC_WORKERS,
+        host = config.SAP_HANA_HOST,
+        port = config.SAP_HANA_PORT,
+        user = config.SAP_HANA_USER,
+        password = config.SAP_HANA_PASSWORD,
+        fetch_size = config.SAP_HANA_FETCH_SIZE
+    )
+
+    return SAP_HANA_POOL
+
+
+def execute_master_query() -> list:
+    """ Esegue la query master su SAP HANA.
+    Raises:
+        ConnectionError: Se la connessione a SAP HANA non è stata inizializzata.
+    Returns:
+        list: Una lista di dizionari contenenti i risultati della query master.
+    """
+
+    if not SAP_HANA:
+        raise ConnectionError("SAP HANA connection not initialized")
+
+    try:
+        # Eseguo la query master
+        with METRICS.timer(None, "master_query"):
+            results = SAP_HANA.execute(config.SAP_HANA_MASTER_QUERY)
+        LOGGER.info(f"Master query executed successfully, retrieved {len(results)} records")
+        return results
+    except Exception as e:
+        LOGGER.error(f"Error executing master query: {e}")
+        raise
+
+
+def execute_child_query(row: dict, connection: classes.SAP_HANA = None, full: bool = False) -> tuple:
+    """ Esegue la query figlia su SAP HANA per un dato record.
+
+    I risultati non vengono caricati in memoria: vengono restituiti in streaming a blocchi
+    di `config.SAP_HANA_FETCH_SIZE` righe e letti solo quando vengono consumati.
+
+    Args:
+        row (dict): Il record da cui estrarre i parametri per la query figlia.
+        connection (classes.SAP_HANA): Connessione da usare, di default quella globale.
+        full (bool): Legge tutte le righe anche in INCREMENTAL, senza il filtro watermark.
+
+    Raises:
+        ConnectionError: Se la connessione a SAP HANA non è stata inizializzata.
+
+    Returns:
+        tuple: Un tuple contenente il codice, il nome e lo stream dei risultati della query figlia.
+    """
+
+    connection = connection or SAP_HANA
+    if not connection:
+        raise ConnectionError("SAP HANA connection not initialized")
+
+    code = row.get("Code", None)
+    name = row.get("Name", None)
+    query = row.get("U_KAI_FUNCTION", None)
+
+    assert code is not None, "CODE cannot be None"
+    assert name is not None, "NAME cannot be None"
+    assert query is not None, "U_KAI_FUNCTION cannot be None"
+    
+    # Un indice da ricostruire con più shard va ricaricato per intero
+    full = full or needs_shard_resize(code.lower())
+
+    # In modalità incrementale leggo solo le righe dall'ultimo valore della colonna watermark in poi. Il confronto
+    # include quel valore: con colonne a granularità di giorno o righe con lo stesso timestamp salvate dopo la lettura,
+    # le righe modificate dopo la sincronizzazione hanno ancora l'ultimo valore. Rileggerle è innocuo: quelle invariate
+    # vengono scartate dal confronto degli hash e gli upsert sono idempotenti
+    watermark_column = get_watermark_column(row)
+    base_query = query
+    params = None
+    if watermark_column and config.UPDATE_MODE == "INCREMENTAL" and not full:
+        last_value = get_last_watermark(code.lower(), watermark_column)
+        if last_value is not None:
+            quoted_column = watermark_column.replace('"', '""')
+            query = f'SELECT * FROM ({query}) WHERE "{quoted_column}" >= ?'
+            params = [last_value]
+            LOGGER.info(f"Using watermark {watermark_column!r} >= {last_value!r} for CODE: {code!r}, NAME: {name!r}")
+
+    LOGGER.info(f"Executing child query {query!r} for CODE: {code!r}, NAME: {name!r}")
+
+    try:
+        # Eseguo la query figlia, le righe verranno lette a blocchi durante l'upsert
+        results = None
+        partitions = get_partition_count(row)
+        if partitions > 1:
+            results = execute_partitioned_query(code, connection, query, params, watermark_column, partitions)
+        if results is None:
+            results = connection.execute_stream(query, params=params, track_max=watermark_column)
+            if config.SHARD_SIZING_ENABLED and config.SHARD_PREFLIGHT_COUNT and ELASTIC and not index_exists(code.lower()):
+                # Senza un indice precedente il numero di shard si ricava dal conteggio delle righe
+                results.expected_rows = count_child_rows(connection, query, params)
+        results.converters = build_column_converters(results.schema, get_key_field(results.columns))
+        results.columnar = config.COLUMNAR_BATCHES
+        results.version_column = get_version_column(row)
+        METRICS.add_time(code.lower(), "hana_execute", results.execute_time)
+        if params:
+            # La riconciliazione delle eliminazioni deve leggere tutte le chiavi, non solo le righe oltre il watermark
+            results.base_query = base_query
+            results.connection = connection
+        LOGGER.info(f"Child query executed successfully for CODE: {code!r}, NAME: {name!r}, streaming results in batches of {config.SAP_HANA_FETCH_SIZE}")
+        return code, name, results
+    except Exception as e:
+        LOGGER.error(f"Error executing child query for CODE: {code!r}, NAME: {name!r}: {e}")
+        raise
+
+
+def snapshot_path(code: str) -> str:
+    """ Percorso, senza estensione, dei file dello snapshot di un Code in `config.SNAPSHOT_DIR`. """
+
+    return os.path.join(config.SNAPSHOT_DIR, code.lower())
+
+
+def export_snapshot(row: dict, connection: classes.SAP_HANA = None) -> dict:
+    """ Esegue la query figlia di un Code e ne scrive i risultati in uno snapshot su disco.
+
+    Vengono lette tutte le righe, senza il filtro watermark, già convertite come per il caricamento;
+    il valore massimo della colonna watermark viene salvato nei metadati dello snapshot, così il
+    caricamento imposta lo stesso watermark di una sincronizzazione diretta.
+
+    Args:
+        row (dict): Il record della query master.
+        connection (classes.SAP_HANA): Connessione da usare, di default quella globale.
+
+    Returns:
+        dict: Il numero di record esportati.
+    """
+
+    code, name, results = execute_child_query(row, connection, full=True)
+    metrics_code = code.lower()
+    results.columnar = True
+    path = snapshot_path(code)
+    try:
+        os.makedirs(config.SNAPSHOT_DIR, exist_ok=True)
+        writer = classes.SnapshotWriter(path, results.columns, results.schema, BULK_SERIALIZER)
+    except OSError:
+        _close_results(results)
+        raise
+
+    try:
+        for batch in results:
+            with METRICS.timer(metrics_code, "snapshot_write"):
+                writer.write(zip(*batch.data))
+        metadata = {
+            "code": code,
+            "name": name,
+            "created_at": datetime.datetime.now().isoformat(),
+            "track_max": results.track_max
+        }
+        if results.max_value is not None:
+            metadata["max_value"] = _encode_watermark(results.max_value)
+        writer.close(metadata)
+    except Exception as e:
+        LOGGER.error(f"Error exporting snapshot for CODE: {code!r}, NAME: {name!r}: {e}")
+        writer.abort()
+        raise
+    finally:
+        _close_results(results)
+        METRICS.add_time(metrics_code, "hana_fetch", results.fetch_time)
+        METRICS.add_time(metrics_code, "materialize", results.materialize_time)
+        METRICS.increment(metrics_code, "rows", writer.rows)
+
+    LOGGER.info(f"Exported {writer.rows} records of CODE: {code!r}, NAME: {name!r} to snapshot {path}.ndjson")
+    return {"records": writer.rows}
+
+
+def open_snapshot(row: dict) -> tuple:
+    """ Apre lo snapshot di un Code al posto della query figlia, per caricarlo con il normale upsert.
+
+    Args:
+        row (dict): Il record della query master, letto dal manifest dello snapshot.
+
+    Raises:
+        FileNotFoundError: Se lo snapshot del Code non esiste.
+
+    Returns:
+        tuple: Un tuple contenente il codice, il nome e lo stream dei risultati dello snapshot.
+    """
+
+    code = row.get("Code", None)
+    name = row.get("Name", None)
+    assert code is not None, "CODE cannot be None"
+
+    results = classes.SnapshotReader(snapshot_path(code))
+    if results.metadata.get("max_value"):
+        results.max_value = _decode_watermark(*results.metadata["max_value"])
+    results.columnar = config.COLUMNAR_BATCHES
+    results.version_column = get_version_column(row)
+    LOGGER.info(f"Loading CODE: {code!r}, NAME: {name!r} from snapshot created at {results.metadata.get('created_at')} "
+                f"with {results.metadata['rows']} records")
+    return code, name, results
+
+
+def write_snapshot_manifest(rows: list) -> None:
+    """ Salva i record della query master nello snapshot, così il caricamento non deve rieseguirla. """
+
+    path = os.path.join(config.SNAPSHOT_DIR, "manifest.json")
+    os.makedirs(config.SNAPSHOT_DIR, exist_ok=True)
+    with open(f"{path}.tmp", "wb") as manifest_file:
+        manifest_file.write(BULK_SERIALIZER.dumps({"created_at": datetime.datetime.now().isoformat(), "rows": rows}))
+    os.replace(f"{path}.tmp", path)
+
+
+def read_snapshot_manifest() -> list:
+    """ Legge i record della query master salvati da `write_snapshot_manifest`.
+
+    Raises:
+        FileNotFoundError: Se in `config.SNAPSHOT_DIR` non c'è uno snapshot.
+
+    Returns:
+        list: I record della query master al momento dell'esportazione.
+    """
+
+    with open(os.path.join(config.SNAPSHOT_DIR, "manifest.json"), encoding="utf-8") as manifest_file:
+        manifest = json.load(manifest_file)
+    LOGGER.info(f"Snapshot manifest created at {manifest.get('created_at')}, {len(manifest['rows'])} records")
+    return manifest["rows"]
+
+
+def is_priority_code(row: dict) -> bool:
+    """ Indica se un Code va sincronizzato prima degli altri, secondo il record master o `config.PRIORITY_CODES`. """
+
+    value = row.get(config.PRIORITY_MASTER_FIELD)
+    return str(row.get("Code")).lower() in config.PRIORITY_CODES or str(value).strip().upper() in ("1", "Y", "YES", "TRUE")
+
+
+def estimate_sync_costs(rows: list) -> dict:
+    """ Stima la durata della sincronizzazione di ogni Code dai metadati dell'ultima sincronizzazione.
+
+    Si usa `sync_seconds`; per gli indici sincronizzati prima che venisse salvato si stima dal numero
+    di record con i secondi per record medi degli altri Code. I Code senza indice non hanno storico
+    e valgono infinito, così partono per primi: potrebbero essere i più lunghi.
+
+    Args:
+        rows (list): I record della query master.
+
+    Returns:
+        dict: La durata stimata in secondi per Code.
+    """
+
+    history = {}
+    for row in rows:
+        code = row.get("Code", None)
+        history[code] = get_index_metadata(str(code).lower()) if index_exists(str(code).lower()) else None
+
+    timed = [meta for meta in history.values() if meta and meta.get("sync_seconds") is not None and meta.get("record_count")]
+    seconds_per_record = (
+        sum(meta["sync_seconds"] for meta in timed) / sum(meta["record_count"] for meta in timed) if timed else None
+    )
+
+    costs = {}
+    for code, meta in history.items():
+        if meta is None:
+            costs[code] = float("inf")
+        elif meta.get("sync_seconds") is not None:
+            costs[code] = float(meta["sync_seconds"])
+        elif seconds_per_record is not None:
+            costs[code] = meta.get("record_count", 0) * seconds_per_record
+        else:
+            # Nessuna durata salvata: il numero di record è comunque confrontabile tra i Code
+            costs[code] = float(meta.get("record_count", 0))
+    return costs
+
+
+def schedule_rows(rows: list) -> list:
+    """ Ordina i record della query master per la sincronizzazione.
+
+    Prima i Code prioritari, poi, con `config.SCHEDULE_BY_COST`, dal più lungo al più breve: i worker
+    prendono il Code successivo appena si liberano, quindi i Code brevi riempiono i tempi morti
+    lasciati da quelli lunghi (longest processing time first) e la durata complessiva si riduce.
+
+    Args:
+        rows (list): I record della query master.
+
+    Returns:
+        list: I record nell'ordine in cui avviarli.
+    """
+
+    costs = estimate_sync_costs(rows) if config.SCHEDULE_BY_COST else {}
+    ordered = sorted(rows, key=lambda row: (not is_priority_code(row), -costs.get(row.get("Code", None), 0.0)))
+    LOGGER.debug(f"Sync order: {[row.get('Code', None) for row in ordered]}")
+    return ordered
+
+
+def get_partition_count(row: dict) -> int:
+    """ Restituisce in quante partizioni dividere l'estrazione della query figlia di un Code.
+
+    Il numero viene letto dal record master, poi dalla configurazione per Code, altrimenti vale quello di default.
+
+    Args:
+        row (dict): Il record della query master.
+
+    Returns:
+        int: Il numero di partizioni, 1 se l'estrazione non va partizionata.
+    """
+
+    code = row.get("Code")
+    partitions = row.get(config.PARTITIONS_MASTER_FIELD) or config.EXTRACTION_PARTITIONS.get(code)
+    if partitions is None:
+        return config.DEFAULT_EXTRACTION_PARTITIONS
+
+    try:
+        partitions = int(partitions)
+        if partitions < 1:
+            raise ValueError("partitions must be positive")
+        return min(partitions, config.EXTRACTION_MAX_PARTITIONS)
+    except (TypeError, ValueError):
+        LOGGER.warning(f"Invalid number of partitions {partitions!r} for CODE: {code!r}, using {config.DEFAULT_EXTRACTION_PARTITIONS}")
+        return config.DEFAULT_EXTRACTION_PARTITIONS
+
+
+def count_child_rows(connection: classes.SAP_HANA, query: str, params: list = None) -> int:
+    """ Conta le righe restituite da una query figlia con un COUNT(*) che la racchiude. """
+
+    with connection.execute_stream(f'SELECT COUNT(*) AS "ROWS" FROM ({query})', params=params) as stream:
+        return next(iter(stream), [{"ROWS": 0}])[0]["ROWS"]
+
+
+def _query_partition_boundaries(connection: classes.SAP_HANA, query: str, params: list, key_column: str, partitions: int) -> list:
+    """ Calcola i valori della colonna chiave che dividono i risultati in partizioni di dimensione simile.
+
+    I limiti sono quantili della colonna chiave, non valori equidistanti tra minimo e massimo,
+    così le partizioni restano bilanciate anche con chiavi alfanumeriche o distribuite in modo irregolare.
+
+    Returns:
+        tuple: Il numero di righe della query e fino a `partitions - 1` limiti in ordine crescente,
+        nessuno se le righe sono troppo poche.
+    """
+
+    quoted_key = key_column.replace('"', '""')
+    total = count_child_rows(connection, query, params)
+    if total < max(config.EXTRACTION_PARTITION_MIN_ROWS, partitions):
+        return total, []
+
+    # Una chiave ogni `step` righe in ordine di chiave: ogni limite chiude una partizione
+    step = -(-total // partitions)
+    boundaries = []
+    with connection.execute_stream(
+        f'SELECT "{quoted_key}" FROM (SELECT "{quoted_key}", ROW_NUMBER() OVER (ORDER BY "{quoted_key}") AS "RADAR_ROW" '
+        f'FROM ({query}) WHERE "{quoted_key}" IS NOT NULL) WHERE MOD("RADAR_ROW", ?) = 0 ORDER BY "{quoted_key}"',
+        params=list(params or []) + [step]
+    ) as stream:
+        for batch in stream:
+            for row in batch:
+                if not boundaries or row[key_column] != boundaries[-1]:
+                    boundaries.append(row[key_column])
+    return total, boundaries[:partitions - 1]
+
+
+def _reserve_extraction_connections(count: int) -> int:
+    # Prende senza attendere fino a `count` connessioni dedicate libere: un worker che ne aspettasse altre
+    # tenendo quelle già prese potrebbe bloccarsi con gli altri worker
+    reserved = 0
+    while reserved < count and EXTRACTION_CONNECTIONS.acquire(blocking=False):
+        reserved += 1
+    return reserved
+
+
+def _release_extraction_connections(count: int) -> None:
+    for _ in range(count):
+        EXTRACTION_CONNECTIONS.release()
+
+
+def execute_partitioned_query(code: str, connection: classes.SAP_HANA, query: str, params: list, track_max: str, partitions: int):
+    """ Esegue la query figlia divisa in intervalli della colonna chiave, letti in parallelo.
+
+    La colonna chiave è la prima che contiene "Code", la stessa usata come identificativo dei documenti.
+    La prima partizione viene letta sulla connessione indicata, le altre su connessioni dedicate
+    aperte per questa estrazione e chiuse insieme ai risultati. Le connessioni dedicate di tutti i worker
+    sono al più `config.EXTRACTION_MAX_CONNECTIONS`: se non ce ne sono abbastanza libere le partizioni diminuiscono.
+
+    Args:
+        code (str): Il Code della query figlia.
+        connection (classes.SAP_HANA): Connessione su cui calcolare i limiti e leggere la prima partizione.
+        query (str): La query figlia, già filtrata dal watermark se previsto.
+        params (list): Parametri della query.
+        track_max (str): Colonna di cui mantenere il valore massimo durante la lettura.
+        partitions (int): Numero massimo di partizioni.
+
+    Returns:
+        classes.PartitionedResultStream: Lo stream dei risultati, None se la query non va partizionata
+        (nessuna colonna chiave, meno di `config.EXTRACTION_PARTITION_MIN_ROWS` righe o nessuna connessione dedicata libera).
+    """
+
+    reserved = _reserve_extraction_connections(partitions - 1)
+    if not reserved:
+        LOGGER.info(f"No free extraction connections for CODE: {code!r}, reading it on a single cursor")
+        return None
+
+    try:
+        with METRICS.timer(code.lower(), "hana_partitioning"):
+            with connection.execute_stream(f"SELECT * FROM ({query}) LIMIT 0", params=params) as stream:
+                key_column = get_key_field(stream.columns)
+            boundaries = []
+            if key_column is not None:
+                total, boundaries = _query_partition_boundaries(connection, query, params, key_column, reserved + 1)
+    except Exception:
+        _release_extraction_connections(reserved)
+        raise
+    # Restituisco le connessioni riservate che non servono: una per ogni limite
+    _release_extraction_connections(reserved - len(boundaries))
+    reserved = len(boundaries)
+    if not boundaries:
+        return None
+
+    # Intervalli (limite inferiore escluso, limite superiore incluso); le chiavi NULL finiscono nella prima partizione
+    quoted_key = key_column.replace('"', '""')
+    ranges = list(zip([None] + boundaries, boundaries + [None]))
+    streams = []
+    connections = []
+    try:
+        for lower, upper in ranges:
+            if lower is None:
+                condition, bounds = f'"{quoted_key}" <= ? OR "{quoted_key}" IS NULL', [upper]
+            elif upper is None:
+                condition, bounds = f'"{quoted_key}" > ?', [lower]
+            else:
+                condition, bounds = f'"{quoted_key}" > ? AND "{quoted_key}" <= ?', [lower, upper]
+
+            partition_connection = connection
+            if streams:
+                partition_connection = classes.SAP_HANA(
+                    config.SAP_HANA_HOST,
+                    config.SAP_HANA_PORT,
+                    config.SAP_HANA_USER,
+                    config.SAP_HANA_PASSWORD,
+                    fetch_size=config.SAP_HANA_FETCH_SIZE
+                )
+                connections.append(partition_connection)
+                partition_connection.connect()
+            streams.append(partition_connection.execute_stream(
+                f"SELECT * FROM ({query}) WHERE ({condition})",
+                params=list(params or []) + bounds,
+                track_max=track_max
+            ))
+    except Exception:
+        for stream in streams:
+            stream.close()
+        for partition_connection in connections:
+            partition_connection.close()
+        _release_extraction_connections(reserved)
+        raise
+
+    LOGGER.info(f"Extracting CODE: {code!r} in {len(streams)} partitions on column {key_column!r}")
+    results = classes.PartitionedResultStream(
+        streams, connections=connections, on_close=lambda: _release_extraction_connections(reserved)
+    )
+    results.expected_rows = total
+    return results
+
+
+def build_column_converters(schema: list, key_field: str = None) -> list:
+    """ Prepara una sola volta, dallo schema dei risultati, le conversioni da applicare alle colonne.
+
+    Args:
+        schema (list): Schema dei risultati (`classes.ResultStream.schema`).
+        key_field (str): Colonna usata come identificativo dei documenti, convertita con HANA_KEY_CONVERTERS.
+
+    Returns:
+        list: Coppie (indice della colonna, funzione di conversione), solo per le colonne che ne hanno bisogno.
+    """
+
+    converters = []
+    for index, column in enumerate(schema or []):
+        if column["name"] == key_field and column["type_code"] in HANA_KEY_CONVERTERS:
+            converters.append((index, HANA_KEY_CONVERTERS[column["type_code"]]))
+        elif column["type_code"] in HANA_VALUE_CONVERTERS:
+            converters.append((index, HANA_VALUE_CONVERTERS[column["type_code"]]))
+    return converters
+
+
+def get_key_field(columns) -> str:
+    """ Restituisce la colonna usata come identificativo dei documenti: la prima il cui nome contiene "Code".
+
+    Args:
+        columns: Nomi delle colonne dei risultati, nel loro ordine.
+
+    Returns:
+        str: Il nome della colonna, None se nessuna colonna contiene "Code".
+    """
+
+    return next((column for column in columns if "Code" in column), None)
+
+
+def get_watermark_column(row: dict) -> str:
+    """ Restituisce la colonna watermark di un Code, letta dal record master o dalla configurazione.
+
+    Args:
+        row (dict): Il record della query master.
+
+    Returns:
+        str: Il nome della colonna watermark, None se il Code non ne ha una.
+    """
+
+    column = row.get(config.WATERMARK_MASTER_FIELD) or config.WATERMARK_COLUMNS.get(row.get("Code"))
+    return column.strip() if column and column.strip() else None
+
+
+def get_version_column(row: dict) -> str:
+    """ Restituisce la colonna da cui leggere la versione esterna dei documenti di un Code, in BULK_WRITE_MODE INDEX.
+
+    Args:
+        row (dict): Il record della query master.
+
+    Returns:
+        str: La colonna letta dal record master o dalla configurazione, altrimenti la colonna watermark;
+        None se il Code non ne ha una o i documenti vengono scritti con doc_as_upsert.
+    """
+
+    if config.BULK_WRITE_MODE != "INDEX":
+        return None
+    column = row.get(config.VERSION_MASTER_FIELD) or config.VERSION_COLUMNS.get(row.get("Code"))
+    return column.strip() if column and column.strip() else get_watermark_column(row)
+
+
+def _external_version(value) -> int:
+    """ Converte il valore della colonna versione in una versione esterna di Elasticsearch (intero non negativo).
+
+    I contatori vengono usati così come sono, i timestamp (già convertiti in stringhe ISO 8601 dalla lettura)
+    diventano i microsecondi dal 1970, considerando UTC quelli senza fuso orario.
+
+    Returns:
+        int: La versione, None se il valore è assente o non convertibile.
+    """
+
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float, decimal.Decimal)):
+        return int(value) if value >= 0 and value == int(value) else None
+    if isinstance(value, str):
+        try:
+            value = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time())
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        version = (value - datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)) // datetime.timedelta(microseconds=1)
+        return version if version >= 0 else None
+    return None
+
+
+def get_sync_interval(row: dict) -> int:
+    """ Restituisce ogni quanti secondi sincronizzare un Code in modalità DAEMON.
+
+    L'intervallo viene letto dal record master, poi dalla configurazione per Code, altrimenti vale quello di default.
+
+    Args:
+        row (dict): Il record della query master.
+
+    Returns:
+        int: L'intervallo di sincronizzazione in secondi.
+    """
+
+    code = row.get("Code")
+    interval = row.get(config.SYNC_INTERVAL_MASTER_FIELD) or config.SYNC_INTERVALS.get(code)
+    if interval is None:
+        return config.DEFAULT_SYNC_INTERVAL
+
+    try:
+        interval = int(interval)
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        return interval
+    except (TypeError, ValueError):
+        LOGGER.warning(f"Invalid sync interval {interval!r} for CODE: {code!r}, using {config.DEFAULT_SYNC_INTERVAL} seconds")
+        return config.DEFAULT_SYNC_INTERVAL
+
+
+def _encode_watermark(value) -> tuple:
+    """ Converte un valore watermark in una coppia (tipo, stringa) salvabile nei metadati dell'indice. """
+
+    if isinstance(value, datetime.datetime):
+        return "datetime", value.isoformat()
+    if isinstance(value, datetime.date):
+        return "date", value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return "decimal", str(value)
+    if isinstance(value, int):
+        return "int", str(value)
+    if isinstance(value, float):
+        return "float", repr(value)
+    return "string", str(value)
+
+
+def _decode_watermark(kind: str, value: str):
+    """ Ricostruisce il valore watermark salvato da `_encode_watermark`, così viene passato a SAP HANA con il tipo corretto. """
+
+    decoders = {
+        "datetime": datetime.datetime.fromisoformat,
+        "date": datetime.date.fromisoformat,
+        "decimal": decimal.Decimal,
+        "int": int,
+        "float": float,
+        "string": str
+    }
+    return decoders.get(kind, str)(value)
+
+
+def get_last_watermark(index_name: str, column: str):
+    """ Recupera dai metadati dell'indice l'ultimo valore watermark sincronizzato.
+
+    Args:
+        index_name (str): Nome dell'indice
+        column (str): Colonna watermark attesa; se nei metadati ne è salvata un'altra il valore viene ignorato.
+
+    Returns:
+        Il valore watermark, None se l'indice non esiste o non è mai stato sincronizzato con questa colonna.
+    """
+
+    if not ELASTIC:
+        raise ConnectionError("Elasticsearch connection not initialized")
+
+    if not index_exists(index_name):
+        return None
+
+    metadata = get_index_metadata(index_name)
+    if metadata.get("watermark_column") != column or metadata.get("watermark_value") is None:
+        return None
+
+    return _decode_watermark(metadata.get("watermark_type", "string"), metadata["watermark_value"])
+
+
+def _bulk_action(index: str, doc_id: str, document: dict, version_column: str = None) -> tuple:
+    """ Crea l'operazione bulk di un documento secondo `config.BULK_WRITE_MODE`.
+
+    In UPSERT è un update con doc_as_upsert; in INDEX un index che sostituisce il documento, con la versione
+    esterna letta da `version_column` se presente (senza versione il documento viene sovrascritto comunque).
+    La versione usa `external_gte`: una riga con la stessa versione di quella indicizzata (ad esempio modificata
+    di nuovo nello stesso giorno con una colonna DATE) la sovrascrive, vengono rifiutate solo le versioni più vecchie.
+
+    Returns:
+        tuple: La coppia (azione, documento) da inviare con il bulk API.
+    """
+
+    if config.BULK_WRITE_MODE != "INDEX":
+        return {"update": {"_index": index, "_id": doc_id}}, {"doc": document, "doc_as_upsert": True}
+
+    action = {"_index": index, "_id": doc_id}
+    version = _external_version(document.get(version_column)) if version_column else None
+    if version is not None:
+        action["version"] = version
+        action["version_type"] = "external_gte"
+    return {"index": action}, document
+
+
+def _action_meta(action: dict) -> dict:
+    # Metadati (_index, _id, ...) di un'operazione bulk, qualunque sia il suo tipo
+    return next(iter(action.values()))
+
+
+def _action_document(action: dict, source: dict) -> dict:
+    # Il documento di un'operazione bulk: in un update è racchiuso in "doc"
+    return source["doc"] if "update" in action else source
+
+
+def _build_bulk_actions(index: str, batch: list, common_key: str, version_column: str = None) -> list:
+    """ Prepara le operazioni di upsert per il bulk API a partire da un blocco di risultati.
+
+    Args:
+        index (str): Nome dell'indice di destinazione.
+        batch (list): Blocco di risultati della query figlia.
+        common_key (str): Campo usato come identificativo univoco dei documenti.
+        version_column (str): Campo da cui leggere la versione esterna, in BULK_WRITE_MODE INDEX.
+
+    Returns:
+        list: Lista di coppie (azione, documento) da inviare con il bulk API.
+    """
+
+    if isinstance(batch, classes.ColumnBatch):
+        return _build_columnar_bulk_actions(index, batch, common_key, version_column)
+
+    actions = []
+    for result in batch:
+        # Verifico che il documento abbia effettivamente la chiave identificativa
+        if common_key not in result:
+            LOGGER.warning(f"Document missing key {common_key!r} for index {index}, skipping")
+            continue
+
+        if config.CONTENT_HASH_ENABLED:
+            # Salvo l'hash del contenuto nel documento per riconoscerlo come invariato nelle esecuzioni successive
+            result[config.CONTENT_HASH_FIELD] = compute_content_hash(result)
+
+        # Converto l'identificativo in stringa per sicurezza
+        actions.append(_bulk_action(index, str(result[common_key]), result, version_column))
+
+    return actions
+
+
+def _build_columnar_bulk_actions(index: str, batch: classes.ColumnBatch, common_key: str, version_column: str = None) -> list:
+    """ Versione di `_build_bulk_actions` per i blocchi colonnari.
+
+    Gli identificativi vengono estratti dall'intera colonna chiave e i documenti costruiti direttamente
+    con le colonne in ordine alfabetico: serializzati senza riordinare le chiavi danno gli stessi byte
+    di `compute_content_hash`, quindi l'hash si calcola senza copiare né ordinare ogni documento.
+    """
+
+    if common_key not in batch.columns:
+        LOGGER.warning(f"Documents missing key {common_key!r} for index {index}, skipping {len(batch)} documents")
+        return []
+
+    ids = batch.ids(common_key)
+    hash_field = config.CONTENT_HASH_FIELD
+    if not config.CONTENT_HASH_ENABLED:
+        documents = batch.documents()
+    else:
+        documents = batch.documents(sorted(name for name in batch.columns if name != hash_field))
+
+    actions = []
+    for doc_id, document in zip(ids, documents):
+        if config.CONTENT_HASH_ENABLED:
+            document[hash_field] = hashlib.blake2b(BULK_SERIALIZER.dumps(document), digest_size=16).hexdigest()
+        actions.append(_bulk_action(index, doc_id, document, version_column))
+
+    return actions
+
+
+def compute_content_hash(document: dict) -> str:
+    """ Calcola un hash stabile del contenuto di un documento.
+
+    Il documento viene serializzato con le chiavi ordinate dallo stesso serializzatore usato per il bulk,
+    quindi lo stesso record di SAP HANA produce sempre lo stesso hash tra un'esecuzione e l'altra.
+
+    Args:
+        document (dict): Il documento, senza considerare il campo `config.CONTENT_HASH_FIELD`.
+
+    Returns:
+        str: L'hash esadecimale del contenuto.
+    """
+
+    content = {key: value for key, value in document.items() if key != config.CONTENT_HASH_FIELD}
+    return hashlib.blake2b(BULK_SERIALIZER.dumps_sorted(content), digest_size=16).hexdigest()
+
+
+def _skip_unchanged_actions(index: str, actions: list, progress: dict) -> list:
+    """ Scarta le operazioni dei documenti il cui contenuto non è cambiato rispetto a quello già indicizzato.
+
+    Gli hash già presenti nell'indice vengono letti con una sola mget per blocco, recuperando solo il campo dell'hash.
+
+    Args:
+        index (str): Nome dell'indice di destinazione.
+        actions (list): Coppie (azione, documento) generate da `_build_bulk_actions`.
+        progress (dict): Contatori aggiornati con i documenti nuovi, modificati e invariati.
+
+    Returns:
+        list: Le sole operazioni dei documenti nuovi o modificati.
+    """
+
+    if not actions:
+        return actions
+
+    ids = [_action_meta(action)["_id"] for action, _ in actions]
+    response = ELASTIC.mget(index=index, ids=ids, _source_includes=[config.CONTENT_HASH_FIELD])
+    stored_hashes = {
+        doc["_id"]: doc.get("_source", {}).get(config.CONTENT_HASH_FIELD)
+        for doc in response.get("docs", []) if doc.get("found")
+    }
+
+    changed_actions = []
+    for action, source in actions:
+        doc_id = _action_meta(action)["_id"]
+        if doc_id not in stored_hashes:
+            progress["new"] += 1
+        elif stored_hashes[doc_id] != _action_document(action, source)[config.CONTENT_HASH_FIELD]:
+            progress["changed"] += 1
+        else:
+            progress["skipped"] += 1
+            continue
+        changed_actions.append((action, source))
+
+    return changed_actions
+
+
+def _chunk_bulk_actions(actions, controller: classes.BulkController, max_bytes: int, code: str = None):
+    """ Serializza le operazioni in righe NDJSON e le raggruppa in blocchi limitati per numero e dimensione.
+
+    Args:
+        actions (iterable): Coppie (azione, documento); il documento è None per le operazioni di delete.
+        controller (classes.BulkController): Fornisce il numero massimo di operazioni per blocco, letto a ogni blocco.
+        max_bytes (int): Dimensione massima in byte di un blocco.
+        code (str): Code a cui attribuire il tempo di serializzazione nelle metriche.
+
+    Yields:
+        tuple: Operazioni del blocco (ognuna come lista delle sue righe NDJSON), numero di operazioni e dimensione in byte.
+    """
+
+    operations, size = [], 0
+    serialize_time = 0.0
+    for action, source in actions:
+        started = time.perf_counter()
+        op_lines = [BULK_SERIALIZER.dumps(action)]
+        if source is not None:
+            op_lines.append(BULK_SERIALIZER.dumps(source))
+        serialize_time += time.perf_counter() - started
+        op_size = sum(len(line) + 1 for line in op_lines)  # +1 per il newline
+
+        # Un singolo documento più grande del limite viene comunque inviato da solo
+        if operations and (len(operations) >= controller.chunk_docs or size + op_size > max_bytes):
+            METRICS.add_time(code, "serialize", serialize_time)
+            serialize_time = 0.0
+            yield operations, len(operations), size
+            operations, size = [], 0
+
+        operations.append(op_lines)
+        size += op_size
+
+    METRICS.add_time(code, "serialize", serialize_time)
+    if operations:
+        yield operations, len(operations), size
+
+
+# Stati con cui Elasticsearch rifiuta un'operazione per sovraccarico, che può quindi essere ritentata
+RETRYABLE_BULK_STATUSES = {429, 503}
+
+
+def _parse_bulk_response(index: str, chunk_no: int, response: dict, docs: int, size: int, can_retry: bool = False) -> dict:
+    """ Estrae le statistiche di un blocco dalla risposta del bulk API, registrando gli errori dei singoli documenti.
+
+    Args:
+        index (str): Nome dell'indice di destinazione.
+        chunk_no (int): Numero progressivo del blocco.
+        response (dict): Risposta del bulk API.
+        docs (int): Numero di operazioni contenute nel blocco.
+        size (int): Dimensione del blocco in byte.
+        can_retry (bool): Se True le operazioni rifiutate per sovraccarico non sono contate come errori,
+            ma restituite in "retry" per essere ritentate.
+
+    Returns:
+        dict: Statistiche del blocco (documenti, byte, took, operazioni riuscite ed errori)
+            e posizioni delle operazioni da ritentare. Le scritture rifiutate per una versione esterna
+            più vecchia di quella indicizzata sono contate in "stale", non come errori.
+    """
+
+    succeeded = 0
+    errors = 0
+    stale = 0
+    retry = []
+    for position, item in enumerate(response.get('items', [])):
+        # Ogni item ha come unica chiave il tipo di operazione (update, index, delete)
+        operation, result = next(iter(item.items()))
+        if result.get('error'):
+            if can_retry and result.get('status') in RETRYABLE_BULK_STATUSES:
+                retry.append(position)
+                continue
+            if operation == "index" and result.get('status') == 409:
+                # Versione esterna più vecchia di quella indicizzata: il documento è già aggiornato
+                stale += 1
+                continue
+            errors += 1
+            LOGGER.error(f"Error details: {result['error']}")
+        else:
+            succeeded += 1
+
+    stats = {
+        "chunk": chunk_no,
+        "docs": docs,
+        "bytes": size,
+        "took": response.get('took', 0),
+        "succeeded": succeeded,
+        "errors": errors,
+        "stale": stale,
+        "retry": retry
+    }
+    LOGGER.debug(f"Bulk chunk {chunk_no} for index {index}: {docs} docs, {size} bytes, took {stats['took']}ms, {errors} errors, {stale} stale, {len(retry)} rejected")
+    return stats
+
+
+def _new_bulk_stats() -> dict:
+    return {"chunks": 0, "docs": 0, "bytes": 0, "took": 0, "succeeded": 0, "errors": 0, "stale": 0, "retries": 0, "chunk_stats": []}
+
+
+def _new_chunk_stats(chunk_no: int, docs: int, size: int) -> dict:
+    return {"chunk": chunk_no, "docs": docs, "bytes": size, "took": 0, "succeeded": 0, "errors": 0, "stale": 0, "retries": 0}
+
+
+def _merge_bulk_stats(stats: dict, chunk_stats: dict) -> None:
+    stats["chunk_stats"].append(chunk_stats)
+    stats["chunks"] += 1
+    for key in ("docs", "bytes", "took", "succeeded", "errors", "stale", "retries"):
+        stats[key] += chunk_stats[key]
+
+
+def _bulk_attempt(index: str, chunk_no: int, operations: list, size: int, response: dict, attempt: int, chunk_stats: dict) -> list:
+    """ Registra l'esito di un tentativo di invio di un blocco e restituisce le operazioni da ritentare.
+
+    Args:
+        index (str): Nome dell'indice di destinazione.
+        chunk_no (int): Numero progressivo del blocco.
+        operations (list): Operazioni inviate in questo tentativo.
+        size (int): Dimensione del blocco in byte.
+        response (dict): Risposta del bulk API.
+        attempt (int): Numero del tentativo, da 0.
+        chunk_stats (dict): Statistiche del blocco, aggiornate con l'esito del tentativo.
+
+    Returns:
+        list: Le operazioni rifiutate per sovraccarico da ritentare, vuota se non ce ne sono.
+    """
+
+    attempt_stats = _parse_bulk_response(index, chunk_no, response, len(operations), size, can_retry=attempt < config.BULK_MAX_RETRIES)
+    BULK_CONTROLLER.observe(len(operations), attempt_stats["took"], len(attempt_stats["retry"]))
+
+    for key in ("took", "succeeded", "errors", "stale"):
+        chunk_stats[key] += attempt_stats[key]
+    retry = [operations[position] for position in attempt_stats["retry"]]
+    chunk_stats["retries"] += len(retry)
+    return retry
+
+
+def _send_bulk_chunk(index: str, chunk_no: int, operations: list, docs: int, size: int, code: str = None) -> dict:
+    """ Invia un blocco di operazioni a Elasticsearch e ne restituisce le statistiche.
+
+    Le operazioni rifiutate per sovraccarico vengono ritentate da sole fino a `config.BULK_MAX_RETRIES` volte,
+    con un'attesa esponenziale tra un tentativo e l'altro; oltre questo limite vengono contate come errori.
+
+    Args:
+        index (str): Nome dell'indice di destinazione.
+        chunk_no (int): Numero progressivo del blocco.
+        operations (list): Operazioni del blocco, ognuna come lista delle sue righe NDJSON già serializzate.
+        docs (int): Numero di operazioni contenute nel blocco.
+        size (int): Dimensione del blocco in byte.
+        code (str): Code a cui attribuire il tempo della richiesta nelle metriche.
+
+    Returns:
+        dict: Statistiche del blocco (documenti, byte, took, operazioni riuscite, errori e ritentate).
+    """
+
+    chunk_stats = _new_chunk_stats(chunk_no, docs, size)
+    attempt = 0
+    while operations:
+        with METRICS.timer(code, "bulk"):
+            response = ELASTIC.bulk(
+                operations=[line for op_lines in operations for line in op_lines],
+                timeout='30s',                               # Timeout per l'operazione
+                request_timeout=config.BULK_REQUEST_TIMEOUT  # Timeout per la richiesta HTTP
+            )
+        operations = _bulk_attempt(index, chunk_no, operations, size, response, attempt, chunk_stats)
+        if operations:
+            delay = BULK_CONTROLLER.backoff(attempt)
+            LOGGER.warning(f"{len(operations)} operations rejected in bulk chunk {chunk_no} for index {index}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+    return chunk_stats
+
+
+def bulk_index(index: str, actions, code: str = None) -> dict:
+    """ Invia le operazioni a Elasticsearch in blocchi, con un numero limitato di richieste contemporanee.
+
+    I blocchi sono limitati sia per numero di operazioni (regolato da `BULK_CONTROLLER` in base alla latenza
+    e ai rifiuti del cluster) sia per dimensione (`config.BULK_CHUNK_BYTES`); al più `config.BULK_MAX_IN_FLIGHT` richieste sono in corso
+    allo stesso tempo, così anche la memoria occupata dai blocchi in attesa resta limitata.
+    Il refresh dell'indice non viene eseguito, è compito del chiamante farlo una volta sola alla fine.
+
+    Args:
+        index (str): Nome dell'indice di destinazione, usato per i log.
+        actions (iterable): Coppie (azione, documento) da inviare.
+        code (str): Code a cui attribuire i tempi di serializzazione e delle richieste nelle metriche.
+
+    Raises:
+        ConnectionError: Se la connessione a Elasticsearch non è stata inizializzata.
+
+    Returns:
+        dict: Statistiche complessive e per blocco dell'operazione.
+    """
+
+    if not ELASTIC:
+        raise ConnectionError("Elasticsearch connection not initialized")
+
+    stats = _new_bulk_stats()
+
+    def collect(futures):
+        for future in futures:
+            chunk_stats = future.result()
+            _merge_bulk_stats(stats, chunk_stats)
+
+    chunks = _chunk_bulk_actions(actions, BULK_CONTROLLER, config.BULK_CHUNK_BYTES, code)
+    pending = set()
+    with ThreadPoolExecutor(max_workers=config.BULK_MAX_IN_FLIGHT, thread_name_prefix=f"bulk-{index}") as executor:
+        try:
+            for chunk_no, (operations, docs, size) in enumerate(chunks, start=1):
+                # Attendo che si liberi uno slot prima di preparare altri blocchi
+                if len(pending) >= config.BULK_MAX_IN_FLIGHT:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(executor.submit(_send_bulk_chunk, index, chunk_no, operations, docs, size, code))
+
+            done, pending = wait(pending)
+            collect(done)
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+
+    stats["chunk_stats"].sort(key=lambda chunk: chunk["chunk"])
+    return stats
+
+
+def refresh_index(index_name: str) -> None:
+    """ Esegue il refresh di un indice, rendendo visibili alla ricerca i documenti indicizzati.
+
+    Args:
+        index_name (str): Nome dell'indice
+
+    Raises:
+        ConnectionError: Se la connessione a Elasticsearch non è stata inizializzata.
+    """
+
+    if not ELASTIC:
+        raise ConnectionError("Elasticsearch connection not initialized")
+
+    try:
+        ELASTIC.indices.refresh(index=index_name)
+        LOGGER.debug(f"Index {index_name} refreshed")
+    except Exception as e:
+        LOGGER.error(f"Error refreshing index {index_name}: {e}")
+        raise
+
+
+# Impostazioni modificate durante il caricamento massivo e i relativi valori di caricamento
+BULK_LOAD_SETTINGS = {
+    "index.refresh_interval": "-1",        # Nessun refresh periodico durante il caricamento
+    "index.translog.durability": "async",  # Fsync del translog in background invece che a ogni richiesta
+    "index.number_of_replicas": 0          # Le repliche vengono ricostruite una volta sola alla fine
+}
+
+# Impostazioni di produzione ripristinate dopo un caricamento interrotto, di cui non si conoscono quelle originali
+PRODUCTION_INDEX_SETTINGS = {
+    "index.refresh_interval": config.INDEX_REFRESH_INTERVAL,
+    "index.translog.durability": None,
+    "index.number_of_replicas": config.INDEX_REPLICAS
+}
+
+
+def apply_bulk_load_settings(index_name: str, drop_replicas: bool = False) -> dict:
+    """ Imposta un indice per il caricamento massivo, disattivando refresh, fsync sincrono del translog e,
+    se richiesto, repliche.
+
+    Le repliche vanno tolte solo a un indice che non serve ancora ricerche: su un indice attivo la loro
+    ricostruzione copierebbe di nuovo tutti i dati e nel frattempo l'indice resterebbe senza ridondanza.
+
+    Args:
+        index_name (str): Nome dell'indice (o alias)
+        drop_replicas (bool): Toglie anche le repliche, da ricostruire una volta sola alla fine.
+
+    Raises:
+        ConnectionError: Se la connessione a Elasticsearch non è stata inizializzata.
+
+    Returns:
+        dict: Le impostazioni originali da ripristinare con `restore_index_settings`;
+            None per quelle non impostate esplicitamente, che tornano al valore di default.
+    """
+
+    if not ELASTIC:
+        raise ConnectionError("Elasticsearch connection not initialized")
+
+    settings = {
+        key: value for key, value in BULK_LOAD_SETTINGS.items()
+        if drop_replicas or key != "index.number_of_replicas"
+    }
+    try:
+        response = ELASTIC.indices.get_settings(index=index_name, name=list(settings), flat_settings=True)
+        current = next(iter(response.values()), {}).get("settings", {})
+        original = {key: current.get(key) for key in settings}
+        if original["index.refresh_interval"] == BULK_LOAD_SETTINGS["index.refresh_interval"]:
+            # Impostazioni lasciate da un caricamento interrotto: al termine vanno ripristinate quelle di produzione
+            original = {key: PRODUCTION_INDEX_SETTINGS[key] for key in settings}
+            if not drop_replicas:
+                # Anche le repliche tolte dal caricamento interrotto vanno ripristinate
+                original["index.number_of_replicas"] = config.INDEX_REPLICAS
+
+        ELASTIC.indices.put_settings(index=index_name, settings=settings)
+        LOGGER.debug(f"Bulk load settings applied to index {index_name}, original settings: {original}")
+        return original
+    except Exception as e:
+        LOGGER.error(f"Error applying bulk load settings to index {index_name}: {e}")
+        raise
+
+
+def restore_index_settings(index_name: str, load_state: dict) -> None:
+    """ Ripristina le impostazioni salvate da `apply_bulk_load_settings`, se il profilo di caricamento è stato attivato.
+
+    Args:
+        index_name (str): Nome dell'indice (o alias)
+        load_state (dict): Stato del caricamento con le impostazioni originali; dopo il ripristino viene svuotato.
+    """
+
+    original = load_state.pop("original_settings", None)
+    if original is None:
+        return
+
+    try:
+        ELASTIC.indices.put_settings(index=index_name, settings=original)
+        LOGGER.debug(f"Production settings restored on index {index_name}: {original}")
+    except Exception as e:
+        LOGGER.error(f"Error restoring settings on index {index_name}: {e}")
+        raise
+
+
+def force_merge_index(index_name: str) -> None:
+    """ Esegue il force merge di un indice fino a `config.FORCE_MERGE_MAX_SEGMENTS` segmenti.
+
+    Args:
+        index_name (str): Nome dell'indice
+    """
+
+    if not ELASTIC:
+        raise ConnectionError("Elasticsearch connection not initialized")
+
+    try:
+        ELASTIC.indices.forcemerge(
+            index=index_name,
+            max_num_segments=config.FORCE_MERGE_MAX_SEGMENTS,
+            request_timeout=config.FORCE_MERGE_TIMEOUT
+        )
+        LOGGER.info(f"Index {index_name} force merged to {config.FORCE_MERGE_MAX_SEGMENTS} segments")
+    except Exception as e:
+        # Il force merge è solo un'ottimizzazione, l'indice resta comunque utilizzabile
+        LOGGER.warning(f"Error force merging index {index_name}: {e}")
+
+
+def _generate_upsert_actions(code: str, index_name: str, name: str, results, progress: dict, load_state: dict):
+    """ Consuma lo stream dei risultati e genera le operazioni di upsert, creando l'indice al primo blocco.
+
+    Args:
+        code (str): Codice (in minuscolo) del Code sincronizzato.
+        index_name (str): Indice di destinazione: l'alias del Code in INCREMENTAL, una nuova generazione in FULL.
+        name (str): Nome leggibile dell'indice.
+        results (iterable): Stream a blocchi dei risultati della query figlia.
+        progress (dict): Contatori aggiornati durante la lettura (record letti, documenti nuovi, modificati e invariati).
+        load_state (dict): Stato del caricamento: impostazioni originali dell'indice e hash dello schema applicato.
+
+    Raises:
+        Exception: Se non viene trovata una chiave comune per identificare i documenti.
+
+    Yields:
+        tuple: Coppie (azione, documento) per il bulk API.
+    """
+
+    # Per trovare l'identificativo univoco di ogni documento, cerco un campo che contenga "Code"
+    common_key = None
+    # I documenti vanno confrontati con quelli esistenti solo se l'indice c'era già prima di questa esecuzione,
+    # o se si riprende una generazione FULL caricata in parte da un'esecuzione interrotta
+    compare_hashes = config.CONTENT_HASH_ENABLED and (config.UPDATE_MODE == "INCREMENTAL" or load_state.get("resumed", False))
+    version_column = getattr(results, "version_column", None)
+
+    for batch in results:
+        # Un'altra istanza ha ripreso il Code: smetto di scrivere prima del blocco successivo
+        check_lease(code)
+        if not batch:
+            continue
+
+        if common_key is None:
+            # Identifico la chiave comune che contiene "Code" dal primo record
+            common_key = get_key_field(batch[0])
+            if common_key is None:
+                raise Exception(f"No common key found in results for CODE: {code!r}, NAME: {name!r}")
+            LOGGER.debug(f"Using common key: {common_key!r} for CODE: {code!r}, NAME: {name!r}")
+            load_state["key_field"] = common_key
+            if version_column and version_column not in batch[0]:
+                LOGGER.warning(f"Version column {version_column!r} not found in results for CODE: {code!r}, NAME: {name!r}, indexing without external versions")
+                version_column = None
+
+            # Ricavo il mapping esplicito dallo schema dei risultati
+            properties, schema_hash = build_index_properties(code, getattr(results, "schema", None))
+
+            # Creo l'indice con metadati se non esiste, prima di inviare il primo blocco
+            try:
+                if not index_exists(index_name):
+                    compare_hashes = False
+                    load_state["created"] = True
+                    number_of_shards = estimate_shard_count(code, results)
+                    create_index_with_metadata(
+                        index_name=index_name,
+                        display_name=name,
+                        custom_metadata={
+                            "sap_code": code.upper(),
+                            "alias": code,
+                            "last_sync": datetime.datetime.now().isoformat(),
+                            "data_source": "SAP HANA Child Query",
+                            "schema_hash": schema_hash,
+                            "key_field": common_key,
+                            "number_of_shards": number_of_shards
+                        },
+                        properties=properties,
+                        number_of_shards=number_of_shards
+                    )
+                elif properties and get_index_metadata(index_name).get("schema_hash") != schema_hash:
+                    # Lo schema è cambiato dall'ultima sincronizzazione: aggiungo i nuovi campi al mapping
+                    put_index_properties(index_name, properties)
+                    load_state["schema_hash"] = schema_hash
+            except Exception as e:
+                LOGGER.error(f"Error managing index {index_name}: {e}")
+                # Continuo comunque con l'upsert anche se i metadati falliscono
+
+        progress["records"] += len(batch)
+        with METRICS.timer(code, "transform"):
+            actions = _build_bulk_actions(index_name, batch, common_key, version_column)
+        keys = load_state.get("keys")
+        if keys is not None:
+            # Tengo tutte le chiavi lette, anche dei documenti invariati, per riconoscere quelli eliminati
+            for action, _ in actions:
+                keys.add(_action_meta(action)["_id"])
+        if compare_hashes:
+            with METRICS.timer(code, "change_detection"):
+                actions = _skip_unchanged_actions(index_name, actions, progress)
+        else:
+            progress["new"] += len(actions)
+
+        # Da qui in poi l'indice esiste: lo preparo per il caricamento massivo. L'indice attivo di un Code INCREMENTAL
+        # viene preparato solo se i documenti da inviare sono molti, e senza togliere le repliche
+        if (config.BULK_LOAD_PROFILE_ENABLED and "original_settings" not in load_state and actions
+                and (index_name != code or progress["new"] + progress["changed"] >= config.BULK_LOAD_PROFILE_MIN_DOCS)):
+            load_state["original_settings"] = apply_bulk_load_settings(index_name, drop_replicas=index_name != code)
+        yield from actions
+
+
+def _new_progress() -> dict:
+    return {"records": 0, "new": 0, "changed": 0, "skipped": 0, "deleted": 0}
+
+
+def _new_load_state(code: str, index_name: str, results) -> dict:
+    load_state = {"started": time.perf_counter()}
+    if index_name != code and index_exists(index_name):
+        # Generazione FULL lasciata a metà da un'esecuzione interrotta
+        load_state["resumed"] = True
+    # Le chiavi servono solo per riconciliare un indice già esistente in INCREMENTAL; con il watermark
+    # la query figlia restituisce solo le righe modificate, quindi le chiavi vengono lette a parte alla fine
+    if config.RECONCILE_DELETES and index_name == code and index_exists(index_name) and not getattr(results, "base_query", None):
+        load_state["keys"] = classes.KeySet()
+    return load_state
+
+
+def _close_results(results) -> None:
+    # Chiudo il cursore anche se l'upsert si interrompe a metà
+    close = getattr(results, "close", None)
+    if close:
+        close()
+
+
+def _record_upsert_metrics(code: str, results, progress: dict, stats: dict) -> None:
+    # Registro i tempi di lettura da SAP HANA e i contatori del caricamento, anche se interrotto
+    METRICS.add_time(code, "hana_fetch", getattr(results, "fetch_time", 0.0))
+    METRICS.add_time(code, "materialize", getattr(results, "materialize_time", 0.0))
+    METRICS.increment(code, "rows", progress["records"])
+    for key in ("new", "changed", "skipped", "deleted"):
+        METRICS.increment(code, key, progress[key])
+    for key in ("docs", "bytes", "chunks", "errors", "stale", "retries"):
+        METRICS.increment(code, key, stats[key])
+
+
+def _finalize_upsert(code: str, index_name: str, name: str, results, progress: dict, stats: dict, load_state: dict) -> None:
+    """ Conclude il caricamento di un Code: registra l'esito, esegue il refresh e aggiorna i metadati.
+    In FULL sposta infine l'alias del Code sulla nuova generazione dell'indice.
+
+    Args:
+        code (str): Codice (in minuscolo) e quindi alias dell'indice.
+        index_name (str): Indice in cui sono stati caricati i documenti.
+        name (str): Nome leggibile dell'indice.
+        results (classes.ResultStream): Lo stream dei risultati, ormai consumato.
+        progress (dict): Contatori raccolti durante la lettura dei risultati.
+        stats (dict): Statistiche restituite dal bulk.
+        load_state (dict): Stato del caricamento raccolto durante la lettura dei risultati.
+    """
+
+    # Senza il lease non vanno eseguite eliminazioni, aggiornamenti dei metadati né lo spostamento dell'alias
+    check_lease(code)
+
+    watermark_column = getattr(results, "track_max", None)
+
+    if progress["records"] == 0:
+        if watermark_column:
+            LOGGER.info(f"No new rows past watermark {watermark_column!r} for CODE: {code!r}, NAME: {name!r}")
+            # Anche senza righe nuove possono esserci righe eliminate su SAP HANA
+            with METRICS.timer(code, "reconcile"):
+                deleted = _reconcile_deletes(code, index_name, name, results, progress, stats, load_state)
+            if deleted:
+                refresh_index(index_name)
+                # Il nuovo last_sync invalida i risultati delle ricerche in cache che contengono i documenti eliminati
+                try:
+                    update_index_metadata(index_name, {"last_sync": datetime.datetime.now().isoformat()})
+                except Exception as e:
+                    LOGGER.error(f"Error managing index {index_name}: {e}")
+        elif index_name != code:
+            # In FULL l'alias continua a puntare ai dati precedenti
+            LOGGER.warning(f"No results to upsert for CODE: {code!r}, NAME: {name!r}, keeping the current index generation")
+        else:
+            LOGGER.warning(f"No results to upsert for CODE: {code!r}, NAME: {name!r}")
+        return
+
+    if stats["errors"]:
+        LOGGER.error(f"Errors occurred during bulk upsert for CODE: {code!r}, NAME: {name!r}: {stats['errors']} failed documents")
+        if index_name != code:
+            # Una generazione FULL incompleta non sostituisce quella attuale: il chiamante la elimina e l'alias non si sposta
+            raise Exception(f"Index generation {index_name} is incomplete ({stats['errors']} failed documents), keeping the current generation for CODE: {code!r}")
+    LOGGER.info(f"Successfully upserted {stats['succeeded']} documents to index {index_name} for NAME: {name!r}")
+    if stats["stale"]:
+        LOGGER.info(f"{stats['stale']} documents of index {index_name} already had a newer version and were not overwritten")
+    if config.CONTENT_HASH_ENABLED:
+        LOGGER.info(f"Change detection for index {index_name}: {progress['new']} new, {progress['changed']} changed, {progress['skipped']} skipped")
+    LOGGER.debug(f"Bulk operation for index {index_name}: {stats['chunks']} chunks, {stats['bytes']} bytes, took {stats['took']}ms")
+
+    with METRICS.timer(code, "reconcile"):
+        _reconcile_deletes(code, index_name, name, results, progress, stats, load_state)
+
+    # Rendo visibili i documenti con un unico refresh al termine del caricamento
+    with METRICS.timer(code, "refresh"):
+        refresh_index(index_name)
+
+    if config.FORCE_MERGE_AFTER_LOAD and index_name != code:
+        # Solo per le nuove generazioni FULL, che non verranno più riscritte per intero
+        with METRICS.timer(code, "force_merge"):
+            force_merge_index(index_name)
+
+    # Aggiorno i metadati dell'indice con il numero di record sincronizzati e le durate, usate per ordinare
+    # i Code nelle esecuzioni successive: sync_seconds è il tempo reale dall'esecuzione della query figlia,
+    # extract_seconds la somma dei tempi di lettura da SAP HANA (in ASYNC in parte sovrapposti al caricamento)
+    extract_seconds = sum(getattr(results, name, 0.0) for name in ("execute_time", "fetch_time", "materialize_time"))
+    metadata = {
+        "last_sync": datetime.datetime.now().isoformat(),
+        "record_count": progress["records"],
+        "sync_seconds": round(getattr(results, "execute_time", 0.0) + time.perf_counter() - load_state["started"], 3),
+        "extract_seconds": round(extract_seconds, 3)
+    }
+
+    # Conteggio e dimensione dei documenti, per dimensionare gli shard della prossima generazione
+    metadata.update(get_index_size(index_name))
+    if config.SHARD_AUTO_RESIZE and index_name == code and metadata.get("doc_count"):
+        needed = shard_count_for(metadata["doc_count"], metadata["store_bytes"] / metadata["doc_count"])
+        current = get_index_metadata(code).get("number_of_shards", 1)
+        if needed > current:
+            LOGGER.warning(f"Index {index_name} outgrew its {current} shards, CODE: {code!r} will be rebuilt with {needed} shards")
+            metadata["resize_to_shards"] = needed
+
+    if "schema_hash" in load_state:
+        metadata["schema_hash"] = load_state["schema_hash"]
+    if "key_field" in load_state:
+        metadata["key_field"] = load_state["key_field"]
+
+    # Il watermark avanza solo se tutti i documenti sono stati indicizzati, altrimenti quelli falliti andrebbero persi
+    max_value = getattr(results, "max_value", None)
+    if watermark_column and max_value is not None and not stats["errors"]:
+        watermark_type, watermark_value = _encode_watermark(max_value)
+        metadata.update({
+            "watermark_column": watermark_column,
+            "watermark_type": watermark_type,
+            "watermark_value": watermark_value
+        })
+
+    try:
+        update_index_metadata(index_name, metadata)
+    except Exception as e:
+        LOGGER.error(f"Error managing index {index_name}: {e}")
+
+    if index_name != code:
+        # La nuova generazione è completa: l'alias passa su di essa in modo atomico
+        swap_alias(code, index_name)
+        delete_old_generations(code, index_name)
+
+
+def scan_document_ids(index_name: str):
+    """ Legge gli identificativi di tutti i documenti di un indice, senza il loro contenuto.
+
+    La lettura avviene con un point in time e `search_after` ordinando per `_shard_doc`, così resta
+    coerente e a costo costante per pagina anche con decine di milioni di documenti.
+
+    Args:
+        index_name (str): Nome dell'indice (o alias)
+
+    Raises:
+        ConnectionError: Se la connessione a Elasticsearch non è stata inizializzata.
+
+    Yields:
+        tuple: Coppie (indice reale, _id) dei documenti.
+    """
+
+    query = {"source": False, "filter_path": ["pit_id", "hits.hits._index", "hits.hits._id", "hits.hits.sort"]}
+    for hit in iter_search(index_name, query, page_size=config.RECONCILE_PAGE_SIZE, keep_alive=config.RECONCILE_KEEP_ALIVE):
+        yield hit["_index"], hit["_id"]
+
+
+def load_current_keys(results, key_field: str) -> classes.KeySet:
+    """ Legge da SAP HANA tutte le chiavi della query figlia, senza il filtro watermark.
+
+    Viene letta la sola colonna chiave, così il costo resta contenuto anche quando la query figlia
+    restituisce molte colonne.
+
+    Args:
+        results (classes.ResultStream): Lo stream dei risultati, con la query senza filtro e la sua connessione.
+        key_field (str): Colonna usata come identificativo dei documenti.
+
+    Returns:
+        classes.KeySet: Le chiavi attualmente presenti su SAP HANA.
+    """
+
+    quoted_key = key_field.replace('"', '""')
+    keys = classes.KeySet()
+    with results.connection.execute_stream(f'SELECT "{quoted_key}" FROM ({results.base_query})') as stream:
+        # Stessa conversione della chiave usata per gli _id, altrimenti le chiavi non corrisponderebbero
+        stream.converters = build_column_converters(stream.schema, key_field)
+        for batch in stream:
+            for row in batch:
+                if row[key_field] is not None:
+                    keys.add(str(row[key_field]))
+    return keys
+
+
+def delete_stale_documents(index_name: str, keys: classes.KeySet, code: str = None) -> dict:
+    """ Elimina da un indice i documenti il cui identificativo non è tra le chiavi indicate.
+
+    Gli _id vengono letti con `scan_document_ids` e le eliminazioni inviate a blocchi con `bulk_index`,
+    man mano che le pagine vengono lette.
+
+    Args:
+        index_name (str): Nome dell'indice (o alias)
+        keys (classes.KeySet): Le chiavi dei documenti da mantenere.
+        code (str): Code a cui attribuire i tempi del bulk nelle metriche.
+
+    Returns:
+        dict: Statistiche del bulk delle eliminazioni.
+    """
+
+    def delete_actions():
+        for document_index, document_id in scan_document_ids(index_name):
+            if document_id not in keys:
+                yield {"delete": {"_index": document_index, "_id": document_id}}, None
+
+    return bulk_index(index_name, delete_actions(), code)
+
+
+def _reconcile_deletes(code: str, index_name: str, name: str, results, progress: dict, stats: dict, load_state: dict) -> int:
+    """ Elimina i documenti di un Code non più presenti su SAP HANA, al termine di un caricamento INCREMENTAL.
+
+    La riconciliazione viene saltata se il bulk ha avuto errori o se le chiavi lette sono zero,
+    per non svuotare l'indice a causa di una query fallita o temporaneamente vuota.
+
+    Args:
+        code (str): Codice (in minuscolo) e quindi alias dell'indice.
+        index_name (str): Indice in cui sono stati caricati i documenti.
+        name (str): Nome leggibile dell'indice.
+        results (classes.ResultStream): Lo stream dei risultati, ormai consumato.
+        progress (dict): Contatori del caricamento, aggiornati con i documenti eliminati.
+        stats (dict): Statistiche restituite dal bulk.
+        load_state (dict): Stato del caricamento con le chiavi lette e la colonna chiave.
+
+    Returns:
+        int: Il numero di documenti eliminati.
+    """
+
+    if not config.RECONCILE_DELETES or index_name != code or load_state.get("created"):
+        return 0
+
+    if stats["errors"]:
+        LOGGER.warning(f"Skipping delete reconciliation for CODE: {code!r}, NAME: {name!r} because of bulk errors")
+        return 0
+
+    keys = load_state.pop("keys", None)
+    if getattr(results, "base_query", None):
+        key_field = load_state.get("key_field") or get_index_metadata(index_name).get("key_field")
+        if not key_field:
+            LOGGER.debug(f"Key field unknown for CODE: {code!r}, skipping delete reconciliation")
+            return 0
+        keys = load_current_keys(results, key_field)
 
+    if not keys:
+        LOGGER.warning(f"No keys read for CODE: {code!r}, NAME: {name!r}, skipping delete reconciliation")
+        return 0
+
+    delete_stats = delete_stale_documents(index_name, keys, code)
+    if delete_stats["errors"]:
+        LOGGER.error(f"Errors occurred deleting stale documents for CODE: {code!r}, NAME: {name!r}: {delete_stats['errors']} failed deletes")
+    progress["deleted"] += delete_stats["succeeded"]
+    LOGGER.info(f"Deleted {delete_stats['succeeded']} stale documents from index {index_name} for NAME: {name!r}")
+    return delete_stats["succeeded"]
 
-def init_sap_hana() -> classes.SAP_HANA:
-    """ Inizializza la connessione a SAP HANA.
+
+def new_generation_index_name(code: str) -> str:
+    """ Restituisce il nome di una nuova generazione dell'indice di un Code, nella forma `<code>-<timestamp>`.
+
+    Args:
+        code (str): Codice (in minuscolo) e quindi alias dell'indice.
 
     Returns:
-        classes.SAP_HANA: L'istanza della connessione a SAP HANA.
+        str: Il nome dell'indice della nuova generazione.
     """
 
-    global SAP_HANA
+    return f"{code}-{datetime.datetime.now():%Y%m%d%H%M%S%f}"
 
-    SAP_HANA = classes.SAP_HANA(
-        host = config.SAP_HANA_HOST,
-        port = config.SAP_HANA_PORT,
-        user = config.SAP_HANA_USER,
-        password = config.SAP_HANA_PASSWORD
-    )
-    SAP_HANA.connect()
 
-    return SAP_HANA
+def _is_generation_of(index_name: str, code: str) -> bool:
+    return re.fullmatch(re.escape(code) + r"-\d{20}", index_name) is not None
 
 
-def execute_master_query() -> list:
-    """ Esegue la query master su SAP HANA.
+def _target_index(code: str) -> str:
+    # In FULL ogni esecuzione carica una nuova generazione, in INCREMENTAL si scrive tramite l'alias
+    # salvo quando l'indice va ricostruito con più shard
+    if config.UPDATE_MODE != "FULL" and not needs_shard_resize(code):
+        return code
+
+    # Se l'esecuzione precedente è stata interrotta durante il caricamento, riprendo la sua generazione:
+    # conviene solo con l'hash del contenuto, che evita di reinviare i documenti già caricati
+    previous_index = JOURNAL.get(code).get("index") if JOURNAL and config.CONTENT_HASH_ENABLED else None
+    if previous_index and _is_generation_of(previous_index, code) and index_exists(previous_index):
+        LOGGER.info(f"Resuming load of CODE: {code!r} into index {previous_index}")
+        return previous_index
+    return new_generation_index_name(code)
+
+
+def _journal_start(code: str, index_name: str) -> None:
+    # Registra l'inizio del caricamento e l'indice in cui avviene, da riprendere se l'esecuzione si interrompe
+    if JOURNAL:
+        JOURNAL.start(code, index_name)
+
+
+def _journal_end(code: str, completed: bool) -> None:
+    if JOURNAL:
+        if completed:
+            JOURNAL.complete(code)
+        else:
+            # La generazione incompleta è stata eliminata, la prossima esecuzione riparte da zero
+            JOURNAL.discard(code)
+
+
+def _discard_generation(code: str, index_name: str) -> None:
+    # Se il caricamento FULL fallisce elimino la generazione incompleta, l'alias resta su quella precedente
+    if index_name != code:
+        try:
+            delete_index(index_name)
+        except Exception as e:
+            LOGGER.error(f"Error discarding incomplete index {index_name}: {e}")
+
+
+def swap_alias(alias: str, index_name: str) -> None:
+    """ Sposta atomicamente un alias su un indice, togliendolo dagli indici su cui puntava prima.
+
+    Se con lo stesso nome dell'alias esiste ancora un indice (creato prima dell'introduzione delle generazioni),
+    viene eliminato nella stessa operazione atomica.
+
+    Args:
+        alias (str): Nome dell'alias
+        index_name (str): Indice su cui deve puntare l'alias
+
     Raises:
-        ConnectionError: Se la connessione a SAP HANA non è stata inizializzata.
-    Returns:
-        list: Una lista di dizionari contenenti i risultati della query master.
+        ConnectionError: Se la connessione a Elasticsearch non è stata inizializzata.
     """
 
-    if not SAP_HANA:
-        raise ConnectionError("SAP HANA connection not initialized")
+    if not ELASTIC:
+        raise ConnectionError("Elasticsearch connection not initialized")
 
+    actions = []
     try:
-        # Eseguo la query master
-        results = SAP_HANA.execute(config.SAP_HANA_MASTER_QUERY)
-        LOGGER.info(f"Master query executed successfully, retrieved {len(results)} records")
-        return results
+        with INDEX_CACHE_LOCK:
+            cache = load_index_cache()
+            if alias in cache:
+                actions.append({"remove_index": {"index": alias}})
+            for current_index, info in cache.items():
+                if alias in info["aliases"] and current_index != index_name:
+                    actions.append({"remove": {"index": current_index, "alias": alias}})
+            actions.append({"add": {"index": index_name, "alias": alias}})
+
+            ELASTIC.indices.update_aliases(actions=actions)
+
+            cache.pop(alias, None)
+            for info in cache.values():
+                info["aliases"].discard(alias)
+            if index_name in cache:
+                cache[index_name]["aliases"].add(alias)
+        if SEARCH_CACHE:
+            SEARCH_CACHE.expire_versions()
+        LOGGER.info(f"Alias {alias} now points to index {index_name}")
     except Exception as e:
-        LOGGER.error(f"Error executing master query: {e}")
+        LOGGER.error(f"Error moving alias {alias} to index {index_name}: {e}")
         raise
 
 
-def execute_child_query(row: dict) -> tuple:
-    """ Esegue la query figlia su SAP HANA per un dato record.
+def delete_old_generations(code: str, current_index: str) -> None:
+    """ Elimina le generazioni precedenti dell'indice di un Code, tenendo le `config.INDEX_GENERATIONS_TO_KEEP` più recenti.
+
+    Vengono tenute solo generazioni complete, cioè con il record_count scritto al termine del caricamento:
+    quelle lasciate a metà da un'esecuzione interrotta non servono a tornare indietro e vengono eliminate.
 
     Args:
-        row (dict): Il record da cui estrarre i parametri per la query figlia.
+        code (str): Codice (in minuscolo) e quindi alias dell'indice.
+        current_index (str): Generazione attuale, su cui punta l'alias, che non viene mai eliminata.
+    """
 
-    Raises:
-        ConnectionError: Se la connessione a SAP HANA non è stata inizializzata.
+    if not ELASTIC:
+        raise ConnectionError("Elasticsearch connection not initialized")
 
-    Returns:
-        tuple: Un tuple contenente il codice, il nome e i risultati della query figlia.
+    cache = load_index_cache()
+    old_generations = sorted(
+        (index for index in list(cache) if _is_generation_of(index, code) and index != current_index),
+        reverse=True
+    )
+    complete = [index for index in old_generations if "record_count" in cache[index]["metadata"]]
+    kept = set(complete[:config.INDEX_GENERATIONS_TO_KEEP])
+    for index in old_generations:
+        if index in kept:
+            continue
+        try:
+            delete_index(index)
+        except Exception as e:
+            LOGGER.error(f"Error deleting old generation {index}: {e}")
+
+
+def delete_orphan_indices(codes: list) -> None:
+    """ Elimina gli indici sincronizzati da SAP HANA il cui Code non è più presente nella query master.
+
+    Vengono considerati solo gli indici con il metadato `sap_code`, cioè creati da questa applicazione.
+
+    Args:
+        codes (list): I Code presenti nella query master.
     """
 
-    if not SAP_HANA:
-        raise ConnectionError("SAP HANA connection not initialized")
+    active_codes = {str(code).upper() for code in codes}
+    for index_name, info in list_indices_with_metadata().items():
+        sap_code = info['metadata'].get('sap_code')
+        if sap_code and sap_code.upper() not in active_codes:
+            try:
+                delete_index(index_name)
+                LOGGER.info(f"Deleted orphan index {index_name} for CODE: {sap_code!r}")
+            except Exception as e:
+                LOGGER.error(f"Error deleting orphan index {index_name}: {e}")
 
-    code = row.get("Code", None)
-    name = row.get("Name", None)
-    query = row.get("U_KAI_FUNCTION", None)
 
-    assert code is not None, "CODE cannot be None"
-    assert name is not None, "NAME cannot be None"
-    assert query is not None, "U_KAI_FUNCTION cannot be None"
-    
-    LOGGER.info(f"Executing child query {query!r} for CODE: {code!r}, NAME: {name!r}")
+def write_run_report() -> None:
+    """ Scrive il report dell'esecuzione in JSON (`config.RUN_REPORT_PATH`) e nel formato
+    del textfile collector di Prometheus (`config.PROMETHEUS_TEXTFILE_PATH`).
 
-    try:
-        # Eseguo la query figlia
-        results = SAP_HANA.execute(query)
-        LOGGER.info(f"Child query executed successfully for CODE: {code!r}, NAME: {name!r}, retrieved {len(results)} records")
-        return code, name, results
-    except Exception as e:
-        LOGGER.error(f"Error executing child query for CODE: {code!r}, NAME: {name!r}: {e}")
-        raise
+    I file vengono scritti in un file temporaneo e poi rinominati, così chi li legge non li trova mai a metà.
+    """
+
+    outputs = []
+    if config.RUN_REPORT_PATH:
+        outputs.append((config.RUN_REPORT_PATH, json.dumps(METRICS.report(), indent=2)))
+    if config.PROMETHEUS_TEXTFILE_PATH:
+        outputs.append((config.PROMETHEUS_TEXTFILE_PATH, METRICS.to_prometheus()))
 
+    for path, content in outputs:
+        try:
+            temp_path = f"{path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as report_file:
+                report_file.write(content)
+            os.replace(temp_path, path)
+            LOGGER.debug(f"Run report written to {path}")
+        except OSError as e:
+            LOGGER.error(f"Error writing run report {path}: {e}")
 
-def upsert_to_elasticsearch(child_results: tuple) -> None:
+
+def upsert_to_elasticsearch(child_results: tuple) -> dict:
     """ Inserisce o aggiorna i risultati della query figlia in Elasticsearch.
 
+    I risultati vengono consumati blocco per blocco e inviati tramite `bulk_index`, quindi
+    la memoria occupata dipende dalla dimensione dei blocchi e non da quella del risultato.
+    Il refresh dell'indice viene eseguito una sola volta, al termine del caricamento.
+
     Args:
-        child_results (tuple): Un tuple contenente il codice, il nome e i risultati della query figlia.
+        child_results (tuple): Un tuple contenente il codice, il nome e lo stream dei risultati della query figlia.
     
     Raises:
         Exception: Se non viene trovata una chiave comune per identificare i documenti.
         ConnectionError: Se la connessione a Elasticsearch non è stata inizializzata.
+
+    Returns:
+        dict: Record letti e documenti nuovi, modificati, invariati (non reinviati) ed eliminati.
     """
 
     if not ELASTIC:
@@ -137,106 +2013,168 @@ def upsert_to_elasticsearch(child_results: tuple) -> None:
 
     # Code rappresenta l'indice dei risultati
     # Name invece rappresenta la versione leggibile agli umani dell'indice
-    # Results è la lista dei risultati della query figlia da upsertare su Elasticsearch
+    # Results è lo stream (a blocchi) dei risultati della query figlia da upsertare su Elasticsearch
     code, name, results = child_results
     code = code.lower()  # Assicuro che il codice sia in minuscolo per coerenza con gli indici Elasticsearch
-    
-    if not results:
-        LOGGER.warning(f"No results to upsert for CODE: {code!r}, NAME: {name!r}")
-        return
-    
-    # Creo l'indice con metadati se non esiste
+
+    index_name = _target_index(code)
+    progress = _new_progress()
+    load_state = _new_load_state(code, index_name, results)
+    stats = _new_bulk_stats()
+    _journal_start(code, index_name)
     try:
-        if not ELASTIC.indices.exists(index=code):
-            create_index_with_metadata(
-                index_name=code,
-                display_name=name,
-                custom_metadata={
-                    "sap_code": code.upper(),
-                    "last_sync": datetime.datetime.now().isoformat(),
-                    "record_count": len(results),
-                    "data_source": "SAP HANA Child Query"
-                }
-            )
-        else:
-            # Aggiorno i metadati dell'indice esistente
-            update_index_metadata(code, {
-                "last_sync": datetime.datetime.now().isoformat(),
-                "record_count": len(results)
-            })
+        try:
+            actions = _generate_upsert_actions(code, index_name, name, results, progress, load_state)
+            stats = bulk_index(index_name, actions, code)
+        finally:
+            # Le impostazioni di produzione vanno ripristinate anche se il caricamento fallisce
+            restore_index_settings(index_name, load_state)
+        _finalize_upsert(code, index_name, name, results, progress, stats, load_state)
+        _journal_end(code, completed=True)
     except Exception as e:
-        LOGGER.error(f"Error managing index {code}: {e}")
-        # Continuo comunque con l'upsert anche se i metadati falliscono
-    
-    # Preparo i documenti da upsertare
-    actions = []
-    # Per trovare l'identificativo univoco di ogni documento, cerco un campo che contenga "Code"
-    common_key = None
-    
-    for result in results:
-        # Identifico la chiave comune che contiene "Code"
-        if common_key is None:
-            common_key = next((key for key in result if "Code" in key), None)
-            if common_key:
-                LOGGER.debug(f"Using common key: {common_key!r} for CODE: {code!r}, NAME: {name!r}")
-        
-        if common_key is None:
-            raise Exception(f"No common key found in results for CODE: {code!r}, NAME: {name!r}")
-        
-        # Verifico che il documento abbia effettivamente la chiave identificativa
-        if common_key not in result:
-            LOGGER.warning(f"Document missing key {common_key!r} for CODE: {code!r}, NAME: {name!r}, skipping")
-            continue
-        
-        # Preparo le operazioni per il bulk API (formato NDJSON alternato: azione, documento)
-        actions.append({
-            "update": {
-                "_index": code,
-                "_id": str(result[common_key])  # Converto in stringa per sicurezza
-            }
-        })
-        actions.append({
-            "doc": result,
-            "doc_as_upsert": True
-        })
+        LOGGER.error(f"Error during bulk upsert for CODE: {code!r}, NAME: {name!r}: {e}")
+        _discard_generation(code, index_name)
+        _journal_end(code, completed=False)
+        raise
+    finally:
+        _close_results(results)
+        _record_upsert_metrics(code, results, progress, stats)
+
+    return progress
+
+
+async def async_upsert_to_elasticsearch(child_results: tuple, client: AsyncElasticsearch = None) -> dict:
+    """ Versione asincrona di `upsert_to_elasticsearch` in cui estrazione e indicizzazione si sovrappongono.
+
+    Un thread legge i blocchi da SAP HANA e li serializza in una coda limitata a
+    `config.PIPELINE_QUEUE_SIZE` blocchi, mentre `config.PIPELINE_WRITERS` writer asincroni
+    la svuotano con il bulk di AsyncElasticsearch. Mentre il blocco N viene indicizzato si estrae
+    già il blocco N+1; quando la coda è piena il thread di estrazione si ferma (backpressure),
+    così la memoria resta costante.
+
+    Args:
+        child_results (tuple): Un tuple contenente il codice, il nome e lo stream dei risultati della query figlia.
+        client (AsyncElasticsearch): Client asincrono dell'event loop corrente, di default quello globale.
+
+    Raises:
+        Exception: Se non viene trovata una chiave comune per identificare i documenti.
+        ConnectionError: Se le connessioni a Elasticsearch non sono state inizializzate.
+
+    Returns:
+        dict: Record letti e documenti nuovi, modificati, invariati (non reinviati) ed eliminati.
+    """
+
+    client = client or ASYNC_ELASTIC
+    if not ELASTIC or not client:
+        raise ConnectionError("Elasticsearch connection not initialized")
+
+    code, name, results = child_results
+    code = code.lower()  # Assicuro che il codice sia in minuscolo per coerenza con gli indici Elasticsearch
+
+    index_name = _target_index(code)
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=config.PIPELINE_QUEUE_SIZE)
+    abort = threading.Event()
+    errors = []
+    progress = _new_progress()
+    load_state = _new_load_state(code, index_name, results)
+    stats = _new_bulk_stats()
+    await asyncio.to_thread(_journal_start, code, index_name)
+
+    def produce():
+        try:
+            actions = _generate_upsert_actions(code, index_name, name, results, progress, load_state)
+            chunks = _chunk_bulk_actions(actions, BULK_CONTROLLER, config.BULK_CHUNK_BYTES, code)
+            for chunk_no, chunk in enumerate(chunks, start=1):
+                if abort.is_set():
+                    break
+                # Blocca il thread finché nella coda non c'è posto
+                asyncio.run_coroutine_threadsafe(queue.put((chunk_no, *chunk)), loop).result()
+        except Exception as e:
+            errors.append(e)
+            abort.set()
+        finally:
+            _close_results(results)
+            # Un segnale di fine per ogni writer
+            for _ in range(config.PIPELINE_WRITERS):
+                asyncio.run_coroutine_threadsafe(queue.put(None), loop).result()
+
+    async def write():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            if abort.is_set():
+                # Dopo un errore continuo a svuotare la coda per sbloccare il thread di estrazione
+                continue
+
+            chunk_no, operations, docs, size = item
+            chunk_stats = _new_chunk_stats(chunk_no, docs, size)
+            attempt = 0
+            try:
+                while operations:
+                    with METRICS.timer(code, "bulk"):
+                        response = await client.bulk(
+                            operations=[line for op_lines in operations for line in op_lines],
+                            timeout='30s',
+                            request_timeout=config.BULK_REQUEST_TIMEOUT
+                        )
+                    operations = _bulk_attempt(index_name, chunk_no, operations, size, response, attempt, chunk_stats)
+                    if operations:
+                        delay = BULK_CONTROLLER.backoff(attempt)
+                        LOGGER.warning(f"{len(operations)} operations rejected in bulk chunk {chunk_no} for index {index_name}, retrying in {delay:.1f}s")
+                        await asyncio.sleep(delay)
+                        attempt += 1
+                _merge_bulk_stats(stats, chunk_stats)
+            except Exception as e:
+                errors.append(e)
+                abort.set()
 
     try:
-        # Eseguo il bulk upsert usando il parametro 'operations'
-        if actions:
-            response = ELASTIC.bulk(
-                operations=actions,
-                refresh='wait_for',  # Attendo che i documenti siano visibili per la ricerca
-                timeout='30s',       # Timeout per l'operazione
-                request_timeout=60   # Timeout per la richiesta HTTP
-            )
-            
-            if response.get('errors', False):
-                # Log dettagliato degli errori
-                error_items = [item for item in response.get('items', []) 
-                             if 'update' in item and item['update'].get('error')]
-                LOGGER.error(f"Errors occurred during bulk upsert for CODE: {code!r}, NAME: {name!r}")
-                for error_item in error_items:
-                    error_detail = error_item['update']['error']
-                    LOGGER.error(f"Error details: {error_detail}")
-            else:
-                successful_ops = len([item for item in response.get('items', []) 
-                                    if 'update' in item and item['update'].get('result') in ['created', 'updated']])
-                LOGGER.info(f"Successfully upserted {successful_ops} documents to index {code} for NAME: {name!r}")
-                LOGGER.debug(f"Bulk operation took {response.get('took', 0)}ms")
-        else:
-            LOGGER.warning(f"No valid actions to perform for CODE: {code!r}, NAME: {name!r}")
-            
+        await asyncio.gather(asyncio.to_thread(produce), *(write() for _ in range(config.PIPELINE_WRITERS)))
+    finally:
+        # Le impostazioni di produzione vanno ripristinate anche se il caricamento fallisce
+        await asyncio.to_thread(restore_index_settings, index_name, load_state)
+
+    try:
+        if errors:
+            raise errors[0]
+
+        stats["chunk_stats"].sort(key=lambda chunk: chunk["chunk"])
+        await asyncio.to_thread(_finalize_upsert, code, index_name, name, results, progress, stats, load_state)
+        await asyncio.to_thread(_journal_end, code, True)
     except Exception as e:
         LOGGER.error(f"Error during bulk upsert for CODE: {code!r}, NAME: {name!r}: {e}")
+        await asyncio.to_thread(_discard_generation, code, index_name)
+        await asyncio.to_thread(_journal_end, code, False)
         raise
+    finally:
+        _record_upsert_metrics(code, results, progress, stats)
+
+    return progress
+
+
+def _index_sync_version(index: str) -> tuple:
+    # Indici reali dietro il nome e il loro last_sync: cambia a ogni sincronizzazione e a ogni spostamento dell'alias
+    response = ELASTIC.indices.get_mapping(index=index, filter_path=["*.mappings._meta.last_sync"])
+    return tuple(sorted(
+        (name, mapping.get("mappings", {}).get("_meta", {}).get("last_sync"))
+        for name, mapping in response.items()
+    ))
 
 
-def search(index: str, query: dict) -> list:
+def search(index: str, query: dict, use_cache: bool = True) -> list:
     """ Esegue una ricerca su un indice specifico in Elasticsearch.
 
+    I risultati restano in `SEARCH_CACHE` finché non scadono o non cambia il last_sync dell'indice, così
+    le stesse ricerche ripetute (ad esempio da una dashboard) non interrogano il cluster. I risultati
+    restituiti dalla cache sono condivisi tra le chiamate e non vanno modificati.
+
     Args:
-        index (str): Il nome dell'indice su cui eseguire la ricerca.
+        index (str): Il nome dell'indice su cui eseguire la ricerca; per un Code è il suo alias,
+            che resta disponibile anche durante una ricostruzione FULL.
         query (dict): Il corpo della query di ricerca.
+        use_cache (bool): Se False la ricerca viene sempre eseguita su Elasticsearch.
 
     Returns:
         list: I risultati della ricerca.
@@ -248,22 +2186,230 @@ def search(index: str, query: dict) -> list:
     if not ELASTIC:
         raise ConnectionError("Elasticsearch connection not initialized")
 
+    key = version = None
+    if SEARCH_CACHE and use_cache:
+        try:
+            key = SEARCH_CACHE.key(index, query)
+            version = SEARCH_CACHE.version(index, _index_sync_version)
+            hits = SEARCH_CACHE.get(key, version)
+            if hits is not None:
+                return hits
+        except Exception as e:
+            # Senza la versione dell'indice la ricerca viene eseguita senza cache
+            LOGGER.warning(f"Search cache unavailable for index {index}: {e}")
+            key = None
+
     try:
         # In Elasticsearch v8, usa direttamente i parametri invece di 'body'
         response = ELASTIC.search(index=index, **query)
-        return response.get('hits', {}).get('hits', [])
+        hits = response.get('hits', {}).get('hits', [])
     except Exception as e:
         LOGGER.error(f"Error executing search on index {index}: {e}")
         raise
 
+    if key is not None:
+        SEARCH_CACHE.put(key, version, hits)
+    return hits
+
+
+def iter_search(index: str, query: dict = None, page_size: int = None, keep_alive: str = None):
+    """ Legge tutti i risultati di una ricerca a pagine, con un point in time e `search_after`.
+
+    A differenza della paginazione con from/size ogni pagina ha lo stesso costo e i risultati restano
+    coerenti anche se l'indice viene aggiornato durante la lettura. L'ordinamento della query viene
+    mantenuto (Elasticsearch aggiunge `_shard_doc` per rendere univoca la posizione di ogni documento),
+    senza ordinamento i documenti vengono letti nell'ordine più economico. I risultati non passano dalla cache.
+
+    Args:
+        index (str): Nome dell'indice (o alias).
+        query (dict): Il corpo della query di ricerca, senza from, size e search_after.
+        page_size (int): Documenti per pagina, di default `config.SEARCH_PAGE_SIZE`.
+        keep_alive (str): Durata del point in time tra una pagina e l'altra, di default `config.SEARCH_KEEP_ALIVE`.
+
+    Raises:
+        ConnectionError: Se la connessione a Elasticsearch non è stata inizializzata.
+
+    Yields:
+        dict: I risultati della ricerca, uno alla volta.
+    """
+
+    if not ELASTIC:
+        raise ConnectionError("Elasticsearch connection not initialized")
+
+    keep_alive = keep_alive or config.SEARCH_KEEP_ALIVE
+    query = {key: value for key, value in (query or {}).items() if key not in ("from", "size", "search_after")}
+    query.setdefault("sort", ["_shard_doc"])
+    query.setdefault("track_total_hits", False)
+
+    pit_id = ELASTIC.open_point_in_time(index=index, keep_alive=keep_alive)["id"]
+    try:
+        search_after = None
+        while True:
+            response = ELASTIC.search(
+                pit={"id": pit_id, "keep_alive": keep_alive},
+                search_after=search_after,
+                size=page_size or config.SEARCH_PAGE_SIZE,
+                **query
+            )
+            hits = response.get("hits", {}).get("hits", [])
+            if not hits:
+                break
+            # Il point in time può cambiare id tra una pagina e l'altra
+            pit_id = response.get("pit_id", pit_id)
+            yield from hits
+            search_after = hits[-1]["sort"]
+    finally:
+        try:
+            ELASTIC.close_point_in_time(id=pit_id)
+        except Exception as e:
+            LOGGER.warning(f"Error closing point in time on index {index}: {e}")
+
+
+def build_index_properties(code: str, schema: list) -> tuple:
+    """Ricava il mapping esplicito dei campi dallo schema dei risultati di SAP HANA.
+
+    Ai campi ricavati dai type code si applicano le eventuali sostituzioni configurate per il Code
+    in `config.INDEX_MAPPING_OVERRIDES`. Il risultato viene messo in cache per Code e hash dello schema,
+    che viene salvato anche nei metadati dell'indice per non riapplicare un mapping invariato.
+
+    Args:
+        code (str): Codice (in minuscolo) del Code sincronizzato.
+        schema (list): Schema dei risultati (`classes.ResultStream.schema`), None se non disponibile.
+
+    Returns:
+        tuple: Le properties del mapping e l'hash dello schema; (None, None) se lo schema non è disponibile.
+    """
+
+    if not schema:
+        return None, None
+
+    overrides = config.INDEX_MAPPING_OVERRIDES.get(code.upper(), {})
+    schema_hash = hashlib.blake2b(
+        json.dumps([schema, overrides], sort_keys=True, default=str).encode("utf-8"), digest_size=16
+    ).hexdigest()
+
+    cache_key = (code, schema_hash)
+    if cache_key in SCHEMA_CACHE:
+        return SCHEMA_CACHE[cache_key], schema_hash
+
+    properties = {}
+    for column in schema:
+        type_code = column["type_code"]
+        if type_code in HANA_STRING_TYPE_CODES:
+            length = column["length"]
+            if not length:
+                # Lunghezza non nota: keyword, ignorando in indicizzazione i valori troppo lunghi
+                mapping = {"type": "keyword", "ignore_above": config.KEYWORD_MAX_LENGTH}
+            elif length <= config.KEYWORD_MAX_LENGTH:
+                mapping = {"type": "keyword"}
+            else:
+                mapping = {"type": "text"}
+        elif type_code in HANA_TYPE_MAPPINGS:
+            mapping = dict(HANA_TYPE_MAPPINGS[type_code])
+        else:
+            # Tipo non riconosciuto: lascio decidere al mapping dinamico
+            LOGGER.debug(f"Unknown SAP HANA type code {type_code} for field {column['name']!r} of CODE: {code!r}")
+            continue
+        properties[column["name"]] = mapping
+
+    properties.update(overrides)
+    SCHEMA_CACHE[cache_key] = properties
+    return properties, schema_hash
+
+
+def put_index_properties(index_name: str, properties: dict) -> None:
+    """Aggiunge al mapping di un indice esistente i campi ricavati dallo schema.
+
+    I campi già mappati con un tipo diverso non possono essere modificati: in quel caso
+    il mapping esistente resta invariato e viene registrato un avviso.
+
+    Args:
+        index_name (str): Nome dell'indice (o alias)
+        properties (dict): Properties del mapping
+    """
+
+    if not ELASTIC:
+        raise ConnectionError("Elasticsearch connection not initialized")
+
+    try:
+        ELASTIC.indices.put_mapping(index=index_name, properties=properties)
+        LOGGER.info(f"Mapping of index {index_name} updated with {len(properties)} fields")
+    except Exception as e:
+        LOGGER.warning(f"Could not update mapping of index {index_name}, keeping the current one: {e}")
+
+
+def shard_count_for(docs: int, doc_bytes: float) -> int:
+    """ Calcola il numero di shard primari per un indice di `docs` documenti di `doc_bytes` byte ciascuno.
+
+    Ogni shard deve restare sotto `config.SHARD_TARGET_SIZE_GB` e `config.SHARD_MAX_DOCS` documenti,
+    con almeno uno e al più `config.INDEX_MAX_SHARDS` shard.
+    """
+
+    by_size = math.ceil(docs * doc_bytes / (config.SHARD_TARGET_SIZE_GB * 1024 ** 3))
+    by_docs = math.ceil(docs / config.SHARD_MAX_DOCS)
+    return min(max(by_size, by_docs, 1), config.INDEX_MAX_SHARDS)
 
-def create_index_with_metadata(index_name: str, display_name: str, custom_metadata: dict = None) -> None:
+
+def estimate_shard_count(code: str, results) -> int:
+    """ Stima il numero di shard primari di un nuovo indice di un Code.
+
+    I documenti attesi sono le righe contate prima della lettura, se note, altrimenti quelli
+    dell'indice attuale del Code; la dimensione di un documento è quella media dell'indice attuale,
+    o `config.SHARD_DEFAULT_DOC_BYTES` senza storico.
+
+    Args:
+        code (str): Codice (in minuscolo) e quindi alias dell'indice.
+        results (iterable): Stream dei risultati della query figlia.
+
+    Returns:
+        int: Il numero di shard primari, 1 se il dimensionamento è disattivato.
+    """
+
+    if not config.SHARD_SIZING_ENABLED:
+        return 1
+
+    metadata = get_index_metadata(code)
+    docs = getattr(results, "expected_rows", None)
+    if docs is None:
+        docs = metadata.get("doc_count", metadata.get("record_count", 0))
+    doc_bytes = config.SHARD_DEFAULT_DOC_BYTES
+    if metadata.get("doc_count") and metadata.get("store_bytes"):
+        doc_bytes = metadata["store_bytes"] / metadata["doc_count"]
+
+    number_of_shards = max(shard_count_for(docs, doc_bytes), metadata.get("resize_to_shards", 1))
+    LOGGER.debug(f"Sizing index of CODE: {code!r} for {docs} documents of {doc_bytes:.0f} bytes: {number_of_shards} shards")
+    return number_of_shards
+
+
+def needs_shard_resize(code: str) -> bool:
+    # Un indice INCREMENTAL cresciuto oltre le soglie degli shard va ricostruito in una nuova generazione
+    return bool(config.SHARD_AUTO_RESIZE and ELASTIC and get_index_metadata(code).get("resize_to_shards"))
+
+
+def get_index_size(index_name: str) -> dict:
+    """ Legge numero di documenti e dimensione in byte degli shard primari di un indice.
+
+    Returns:
+        dict: `doc_count` e `store_bytes`, vuoto se le statistiche non sono disponibili.
+    """
+
+    try:
+        primaries = ELASTIC.indices.stats(index=index_name, metric="docs,store")["_all"]["primaries"]
+        return {"doc_count": primaries["docs"]["count"], "store_bytes": primaries["store"]["size_in_bytes"]}
+    except Exception as e:
+        LOGGER.warning(f"Could not read the size of index {index_name}: {e}")
+        return {}
+
+
+def create_index_with_metadata(index_name: str, display_name: str, custom_metadata: dict = None, properties: dict = None, number_of_shards: int = 1) -> None:
     """Crea un indice con metadati custom.
     
     Args:
         index_name (str): Nome dell'indice
         display_name (str): Nome leggibile dell'indice  
         custom_metadata (dict): Metadati aggiuntivi
+        properties (dict): Mapping esplicito dei campi; quelli non indicati restano dinamici
+        number_of_shards (int): Numero di shard primari
         
     Raises:
         ConnectionError: Se la connessione a Elasticsearch non è stata inizializzata.
@@ -288,21 +2434,36 @@ def create_index_with_metadata(index_name: str, display_name: str, custom_metada
     index_body = {
         "settings": {
             "index": {
-                "number_of_shards": 1,
-                "number_of_replicas": 0
+                "number_of_shards": number_of_shards,
+                "number_of_replicas": config.INDEX_REPLICAS,
+                "refresh_interval": config.INDEX_REFRESH_INTERVAL
             }
         },
         "mappings": {
+            # I campi non presenti nello schema restano dinamici, ma le stringhe diventano
+            # solo keyword invece della coppia text + keyword
+            "dynamic_templates": [
+                {
+                    "strings_as_keyword": {
+                        "match_mapping_type": "string",
+                        "mapping": {"type": "keyword", "ignore_above": config.KEYWORD_MAX_LENGTH}
+                    }
+                }
+            ],
             "properties": {
-                # Mapping dinamico per gestire automaticamente i tipi di campo
+                **(properties or {}),
+                # L'hash del contenuto serve solo per il confronto, non viene indicizzato
+                config.CONTENT_HASH_FIELD: {"type": "keyword", "index": False, "doc_values": False}
             },
             "_meta": metadata
         }
     }
     
     try:
-        if not ELASTIC.indices.exists(index=index_name):
+        if not index_exists(index_name):
             ELASTIC.indices.create(index=index_name, body=index_body)
+            with INDEX_CACHE_LOCK:
+                load_index_cache()[index_name] = {"metadata": metadata, "aliases": set()}
             LOGGER.info(f"Index {index_name} created with metadata: {metadata}")
         else:
             LOGGER.debug(f"Index {index_name} already exists")
@@ -311,11 +2472,86 @@ def create_index_with_metadata(index_name: str, display_name: str, custom_metada
         raise
 
 
+def load_index_cache(force: bool = False) -> dict:
+    """Carica in memoria metadati e alias di tutti gli indici con due richieste complessive.
+
+    La cache viene caricata una sola volta per esecuzione e poi mantenuta aggiornata
+    dalle funzioni che creano, modificano o eliminano indici e alias.
+
+    Args:
+        force (bool): Se True ricarica la cache anche se è già stata caricata.
+
+    Returns:
+        dict: La cache, nella forma {indice: {"metadata": {...}, "aliases": set()}}
+
+    Raises:
+        ConnectionError: Se la connessione a Elasticsearch non è stata inizializzata.
+    """
+
+    global INDEX_CACHE
+
+    if not ELASTIC:
+        raise ConnectionError("Elasticsearch connection not initialized")
+
+    with INDEX_CACHE_LOCK:
+        if INDEX_CACHE is not None and not force:
+            return INDEX_CACHE
+
+        try:
+            aliases = ELASTIC.indices.get_alias(index="*")
+            mappings = ELASTIC.indices.get_mapping(index="*", filter_path=["*.mappings._meta"])
+        except Exception as e:
+            LOGGER.error(f"Error loading index metadata: {e}")
+            raise
+
+        INDEX_CACHE = {
+            index_name: {
+                "metadata": mappings.get(index_name, {}).get('mappings', {}).get('_meta', {}),
+                "aliases": set(info.get('aliases', {}))
+            }
+            for index_name, info in aliases.items()
+        }
+        LOGGER.debug(f"Index metadata cache loaded for {len(INDEX_CACHE)} indices")
+        return INDEX_CACHE
+
+
+def invalidate_index_cache() -> None:
+    """Svuota la cache dei metadati, che verrà ricaricata al primo utilizzo."""
+
+    global INDEX_CACHE
+
+    with INDEX_CACHE_LOCK:
+        INDEX_CACHE = None
+
+
+def resolve_index(name: str) -> str:
+    """Restituisce l'indice reale corrispondente a un nome di indice o di alias.
+
+    Args:
+        name (str): Nome dell'indice o dell'alias
+
+    Returns:
+        str: Il nome dell'indice reale, None se non esiste
+    """
+
+    with INDEX_CACHE_LOCK:
+        cache = load_index_cache()
+        if name in cache:
+            return name
+        return next((index_name for index_name, info in cache.items() if name in info["aliases"]), None)
+
+
+def index_exists(name: str) -> bool:
+    """Verifica tramite la cache se esiste un indice o un alias con il nome indicato."""
+
+    return resolve_index(name) is not None
+
+
 def get_index_metadata(index_name: str) -> dict:
     """Recupera i metadati di un indice.
     
     Args:
-        index_name (str): Nome dell'indice
+        index_name (str): Nome dell'indice (o alias)
         
     Returns:
         dict: Metadati dell'indice, dizionario vuoto se non trovati
@@ -328,9 +2564,11 @@ def get_index_metadata(index_name: str) -> dict:
         raise ConnectionError("Elasticsearch connection not initialized")
     
     try:
-        mappings = ELASTIC.indices.get_mapping(index=index_name)
-        metadata = mappings.get(index_name, {}).get('mappings', {}).get('_meta', {})
-        return metadata
+        with INDEX_CACHE_LOCK:
+            resolved = resolve_index(index_name)
+            if resolved is None:
+                return {}
+            return dict(load_index_cache()[resolved]["metadata"])
     except Exception as e:
         LOGGER.error(f"Error retrieving metadata for index {index_name}: {e}")
         return {}
@@ -338,9 +2576,11 @@ def get_index_metadata(index_name: str) -> dict:
 
 def update_index_metadata(index_name: str, new_metadata: dict) -> None:
     """Aggiorna i metadati di un indice esistente.
+
+    I metadati esistenti vengono presi dalla cache, quindi l'aggiornamento richiede una sola put_mapping.
     
     Args:
-        index_name (str): Nome dell'indice
+        index_name (str): Nome dell'indice (o alias)
         new_metadata (dict): Nuovi metadati da aggiungere/aggiornare
         
     Raises:
@@ -364,6 +2604,13 @@ def update_index_metadata(index_name: str, new_metadata: dict) -> None:
         }
         
         ELASTIC.indices.put_mapping(index=index_name, body=mapping_body)
+
+        with INDEX_CACHE_LOCK:
+            resolved = resolve_index(index_name)
+            if resolved is not None:
+                load_index_cache()[resolved]["metadata"] = current_metadata
+        if SEARCH_CACHE:
+            SEARCH_CACHE.expire_versions()
         LOGGER.info(f"Metadata updated for index {index_name}: {new_metadata}")
         
     except Exception as e:
@@ -387,12 +2634,15 @@ def list_indices_with_metadata() -> dict:
     try:
         indices = ELASTIC.cat.indices(format="json")
         result = {}
+
+        # I metadati arrivano dalla cache, senza una get_mapping per ogni indice
+        cache = load_index_cache()
         
         for index_info in indices:
             index_name = index_info['index']
             # Escludo indici di sistema che iniziano con '.'
             if not index_name.startswith('.'):
-                metadata = get_index_metadata(index_name)
+                metadata = dict(cache.get(index_name, {}).get("metadata", {}))
                 result[index_name] = {
                     'metadata': metadata,
                     'docs_count': int(index_info.get('docs.count', 0)) if index_info.get('docs.count') != 'null' else 0,
@@ -441,6 +2691,9 @@ def delete_index(index_name: str) -> None:
     try:
         if ELASTIC.indices.exists(index=index_name):
             ELASTIC.indices.delete(index=index_name)
+            with INDEX_CACHE_LOCK:
+                if INDEX_CACHE is not None:
+                    INDEX_CACHE.pop(index_name, None)
             LOGGER.info(f"Index {index_name} deleted successfully")
         else:
             LOGGER.warning(f"Index {index_name} does not exist, cannot delete")
@@ -2,10 +2,15 @@ import config
 import model
 import classes
 
+import asyncio
 import logging
 import logging.handlers
 import os
+import signal
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from icecream import ic as print
 
@@ -16,6 +21,9 @@ from icecream import ic as print
 
 LOGGER : logging.Logger = None
 
+# Impostato alla ricezione di SIGTERM/SIGINT per fermare la modalità DAEMON
+STOP = threading.Event()
+
 def init_logger() -> None:
     """Funzione che inizializza il logger
     """
@@ -79,6 +87,278 @@ def init_logger() -> None:
 
 
 
+def sync_code(row: dict) -> dict:
+    """Sincronizza un singolo Code: esegue la query figlia con una connessione del pool e carica i risultati su Elasticsearch.
+    Gli errori vengono gestiti qui, così il fallimento di un Code non interrompe gli altri.
+
+    Args:
+        row (dict): Il record della query master da sincronizzare.
+
+    Returns:
+        dict: I contatori della sincronizzazione, None se la sincronizzazione è fallita.
+    """
+
+    code = row.get("Code", None)
+    metrics_code = str(code).lower()
+
+    claimed = False
+    progress = None
+    try:
+        claimed = model.claim_code(row)
+        if not claimed:
+            return skip_claimed_code(code)
+        with model.METRICS.timer(metrics_code, "total"):
+            if config.SNAPSHOT_MODE == "LOAD":
+                progress = model.upsert_to_elasticsearch(model.open_snapshot(row))
+            else:
+                with model.SAP_HANA_POOL.connection() as connection:
+                    child_results = model.execute_child_query(row, connection)
+                    progress = model.upsert_to_elasticsearch(child_results)
+        model.METRICS.set_status(metrics_code, "ok")
+        return progress
+    except Exception as e:
+        LOGGER.error(f"Error synchronizing CODE: {code!r}: {e}", exc_info=True)
+        model.METRICS.set_status(metrics_code, "failed")
+        return None
+    finally:
+        if claimed:
+            model.release_code(row, completed=progress is not None)
+
+
+def skip_claimed_code(code: str) -> dict:
+    """Registra un Code saltato perché sincronizzato da un'altra istanza e ne restituisce i contatori, tutti a zero."""
+
+    LOGGER.info(f"CODE: {code!r} is being or was recently synchronized by another worker, skipping")
+    model.METRICS.set_status(str(code).lower(), "skipped")
+    return {"records": 0, "new": 0, "changed": 0, "skipped": 0, "deleted": 0}
+
+
+async def async_sync_code(row: dict, semaphore: asyncio.Semaphore, client) -> dict:
+    """Versione asincrona di `sync_code`, usata dalla pipeline ASYNC.
+
+    Args:
+        row (dict): Il record della query master da sincronizzare.
+        semaphore (asyncio.Semaphore): Limita i Code sincronizzati contemporaneamente alle connessioni del pool.
+        client (AsyncElasticsearch): Client asincrono dell'event loop corrente.
+
+    Returns:
+        dict: I contatori della sincronizzazione, None se la sincronizzazione è fallita.
+    """
+
+    code = row.get("Code", None)
+    metrics_code = str(code).lower()
+
+    async with semaphore:
+        claimed = False
+        progress = None
+        try:
+            claimed = await asyncio.to_thread(model.claim_code, row)
+            if not claimed:
+                return skip_claimed_code(code)
+            with model.METRICS.timer(metrics_code, "total"):
+                if config.SNAPSHOT_MODE == "LOAD":
+                    child_results = await asyncio.to_thread(model.open_snapshot, row)
+                    progress = await model.async_upsert_to_elasticsearch(child_results, client)
+                else:
+                    # Il semaforo garantisce che nel pool ci sia sempre una connessione libera
+                    with model.SAP_HANA_POOL.connection() as connection:
+                        child_results = await asyncio.to_thread(model.execute_child_query, row, connection)
+                        progress = await model.async_upsert_to_elasticsearch(child_results, client)
+            model.METRICS.set_status(metrics_code, "ok")
+            return progress
+        except Exception as e:
+            LOGGER.error(f"Error synchronizing CODE: {code!r}: {e}", exc_info=True)
+            model.METRICS.set_status(metrics_code, "failed")
+            return None
+        finally:
+            if claimed:
+                await asyncio.to_thread(model.release_code, row, progress is not None)
+
+
+def export_code(row: dict) -> dict:
+    """Esporta un singolo Code nello snapshot su disco, con una connessione del pool.
+
+    Args:
+        row (dict): Il record della query master da esportare.
+
+    Returns:
+        dict: Il numero di record esportati, None se l'esportazione è fallita.
+    """
+
+    code = row.get("Code", None)
+    metrics_code = str(code).lower()
+
+    try:
+        with model.METRICS.timer(metrics_code, "total"), model.SAP_HANA_POOL.connection() as connection:
+            progress = model.export_snapshot(row, connection)
+        model.METRICS.set_status(metrics_code, "ok")
+        return progress
+    except Exception as e:
+        LOGGER.error(f"Error exporting CODE: {code!r}: {e}", exc_info=True)
+        model.METRICS.set_status(metrics_code, "failed")
+        return None
+
+
+def run_export() -> None:
+    """Modalità SNAPSHOT_MODE EXPORT: esegue la query master e tutte le query figlie e ne scrive i risultati
+    in SNAPSHOT_DIR, senza usare Elasticsearch. Lo snapshot potrà poi essere caricato con SNAPSHOT_MODE LOAD.
+    """
+
+    results = model.execute_master_query()
+
+    LOGGER.info(f"Exporting {len(results)} codes to {config.SNAPSHOT_DIR} with {config.SYNC_WORKERS} workers")
+    try:
+        with ThreadPoolExecutor(max_workers=config.SYNC_WORKERS, thread_name_prefix="export") as executor:
+            outcomes = list(executor.map(export_code, results))
+    finally:
+        model.SAP_HANA_POOL.close()
+        model.SAP_HANA.close()
+
+    # Il manifest contiene tutti i Code: quelli non esportati falliranno al caricamento invece di sparire
+    model.write_snapshot_manifest(results)
+    model.write_run_report()
+
+    failed = [row.get("Code", None) for row, outcome in zip(results, outcomes) if outcome is None]
+    if failed:
+        LOGGER.error(f"Export failed for {len(failed)} of {len(results)} codes: {failed}")
+        sys.exit(1)
+
+    LOGGER.info(f"Export completed: {sum(outcome['records'] for outcome in outcomes)} records of {len(results)} codes")
+
+
+async def run_async_pipeline(rows: list) -> list:
+    """Sincronizza i Code con la pipeline ASYNC, al più SYNC_WORKERS alla volta.
+
+    Args:
+        rows (list): I record della query master da sincronizzare.
+
+    Returns:
+        list: I contatori della sincronizzazione di ogni record, None per quelli falliti.
+    """
+
+    client, semaphore = await init_async_pipeline()
+    try:
+        return await asyncio.gather(*(async_sync_code(row, semaphore, client) for row in rows))
+    finally:
+        await client.close()
+
+
+async def init_async_pipeline() -> tuple:
+    """Prepara l'event loop corrente per la pipeline ASYNC.
+
+    Returns:
+        tuple: Il client AsyncElasticsearch dell'event loop e il semaforo che limita i Code a SYNC_WORKERS.
+    """
+
+    # Ogni Code usa un thread per l'estrazione più uno per le operazioni sincrone di contorno
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=config.SYNC_WORKERS * 2, thread_name_prefix="extract")
+    )
+    return model.create_async_elasticsearch(), asyncio.Semaphore(config.SYNC_WORKERS)
+
+
+def start_async_daemon() -> tuple:
+    """Avvia la pipeline ASYNC della modalità DAEMON: un solo event loop, in un thread dedicato, per tutta l'esecuzione.
+
+    Il client AsyncElasticsearch e le sue connessioni restano aperti tra un ciclo e l'altro e sono condivisi
+    da tutte le sincronizzazioni, che i thread del daemon pianificano sul loop attendendone l'esito.
+
+    Returns:
+        tuple: La funzione che sincronizza un Code sul loop e quella che chiude client e loop al termine.
+    """
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name="async-pipeline", daemon=True)
+    thread.start()
+    client, semaphore = asyncio.run_coroutine_threadsafe(init_async_pipeline(), loop).result()
+
+    def sync(row: dict) -> dict:
+        return asyncio.run_coroutine_threadsafe(async_sync_code(row, semaphore, client), loop).result()
+
+    def stop() -> None:
+        asyncio.run_coroutine_threadsafe(client.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.run_until_complete(loop.shutdown_default_executor())
+        loop.close()
+
+    return sync, stop
+
+
+def request_stop(signum, frame) -> None:
+    """Handler di SIGTERM/SIGINT: la modalità DAEMON smette di avviare Code e attende quelli in corso."""
+
+    LOGGER.info(f"Received signal {signum}, stopping after the running codes complete")
+    STOP.set()
+
+
+def run_daemon() -> None:
+    """Modalità DAEMON: resta attiva riusando le connessioni e sincronizza ogni Code al proprio intervallo.
+
+    La query master viene riletta ogni MASTER_REFRESH_INTERVAL secondi, insieme alla cache dei metadati
+    degli indici. Un Code non viene mai avviato mentre una sua sincronizzazione è ancora in corso o in coda:
+    il successivo avvio viene calcolato dal momento in cui è stato accodato.
+    """
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    sync, stop_pipeline = start_async_daemon() if config.PIPELINE_MODE == "ASYNC" else (sync_code, None)
+    rows = {}
+    next_run = {}
+    running = {}
+    master_loaded_at = None
+
+    LOGGER.info(f"Running in DAEMON mode with {config.SYNC_WORKERS} workers in {config.PIPELINE_MODE} pipeline mode")
+    with ThreadPoolExecutor(max_workers=config.SYNC_WORKERS, thread_name_prefix="sync") as executor:
+        while not STOP.is_set():
+            now = time.monotonic()
+
+            if master_loaded_at is None or now - master_loaded_at >= config.MASTER_REFRESH_INTERVAL:
+                master_loaded_at = now
+                try:
+                    results = model.execute_master_query()
+                    # Altri processi possono aver modificato gli indici dall'ultimo caricamento della cache
+                    model.load_index_cache(force=True)
+                except Exception as e:
+                    # Continuo con i Code già noti, la query master verrà riletta al prossimo intervallo
+                    LOGGER.error(f"Error reloading master query, keeping {len(rows)} known codes: {e}")
+                else:
+                    removed = set(rows) - {row.get("Code", None) for row in results}
+                    if removed:
+                        LOGGER.info(f"Codes no longer in the master query: {sorted(removed)}")
+                    rows = {row.get("Code", None): row for row in results}
+                    for code in removed:
+                        next_run.pop(code, None)
+                    if config.UPDATE_MODE == "FULL":
+                        model.delete_orphan_indices(list(rows) + list(running))
+                # Le metriche sono cumulative dall'avvio del processo
+                model.write_run_report()
+
+            for code, future in list(running.items()):
+                if future.done():
+                    del running[code]
+
+            due = [row for code, row in rows.items() if code not in running and next_run.get(code, now) <= now]
+            # I Code scaduti insieme vengono accodati in ordine di priorità e durata
+            for row in model.schedule_rows(due) if due else []:
+                code = row.get("Code", None)
+                next_run[code] = now + model.get_sync_interval(row)
+                running[code] = executor.submit(sync, row)
+
+            STOP.wait(config.DAEMON_POLL_INTERVAL)
+
+        if running:
+            LOGGER.info(f"Waiting for {len(running)} running codes to complete: {sorted(running)}")
+        # Le sincronizzazioni non ancora avviate vengono annullate, quelle in corso terminano normalmente
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    if stop_pipeline:
+        stop_pipeline()
+    model.write_run_report()
+    LOGGER.info("Daemon stopped")
+
+
 def main():
     """Funzione principale che inizializza il logger e gli oggetti globali
     """
@@ -86,30 +366,90 @@ def main():
     init_logger()
     LOGGER.info("Logger initialized successfully")
 
-    # Inizializzo Elasticsearch
-    model.init_sap_hana()
+    # Inizializzo le connessioni: l'esportazione dello snapshot non usa Elasticsearch, il suo caricamento non usa SAP HANA
+    if config.SNAPSHOT_MODE != "LOAD":
+        model.init_sap_hana()
+        model.init_sap_hana_pool()
+    if config.SNAPSHOT_MODE == "EXPORT":
+        run_export()
+        return
     model.init_elasticsearch()
+    # Carico in un'unica volta metadati e alias di tutti gli indici, usati poi da tutti i Code
+    model.load_index_cache()
+    if config.COORDINATION_ENABLED:
+        model.init_coordination()
 
     if config.UPDATE_MODE == "FULL":
         LOGGER.info("Running in FULL update mode")
-        # Ottengo tutti gli indici di Elasticsearch
-        result = model.list_indices_with_metadata()
-        # Elimino gli indici
-        for index in result:
-            try:
-                model.delete_index(index)
-                LOGGER.info(f"Deleted index: {index}")
-            except Exception as e:
-                LOGGER.error(f"Error deleting index {index}: {e}")        
+        # Ogni Code viene ricaricato in una nuova generazione dell'indice e l'alias viene spostato solo
+        # a caricamento completato, così le ricerche continuano a usare i dati precedenti durante l'esecuzione
     else:
         LOGGER.info("Running in INCREMENTAL update mode")
         # In modalità incrementale, non elimino gli indici esistenti
 
-    # Eseguo la query master su SAP HANA
-    results = model.execute_master_query()
-    for row in results:
-        child_results = model.execute_child_query(row)
-        model.upsert_to_elasticsearch(child_results)
+    if config.RUN_MODE == "DAEMON":
+        try:
+            run_daemon()
+        finally:
+            if model.COORDINATOR:
+                model.COORDINATOR.stop()
+            model.SAP_HANA_POOL.close()
+            model.SAP_HANA.close()
+        return
+
+    # Eseguo la query master su SAP HANA, o la rileggo dallo snapshot da caricare
+    results = model.read_snapshot_manifest() if config.SNAPSHOT_MODE == "LOAD" else model.execute_master_query()
+
+    # Se l'esecuzione precedente è stata interrotta, riprendo dai Code non ancora completati
+    pending = results
+    if config.RUN_JOURNAL_PATH:
+        model.JOURNAL = classes.RunJournal.open(
+            config.RUN_JOURNAL_PATH, config.UPDATE_MODE, config.RUN_CLEAN_START, config.RUN_JOURNAL_MAX_AGE
+        )
+        if model.JOURNAL.resumed:
+            pending = [row for row in results if not model.JOURNAL.is_completed(str(row.get("Code", "")).lower())]
+            LOGGER.info(f"Resuming interrupted run: {len(results) - len(pending)} of {len(results)} codes already completed")
+
+    # Sincronizzo i Code in parallelo, al più SYNC_WORKERS alla volta, prima i prioritari e poi i più lunghi
+    pending = model.schedule_rows(pending)
+    LOGGER.info(f"Synchronizing {len(pending)} codes with {config.SYNC_WORKERS} workers in {config.PIPELINE_MODE} pipeline mode")
+    try:
+        if config.PIPELINE_MODE == "ASYNC":
+            outcomes = asyncio.run(run_async_pipeline(pending))
+        else:
+            with ThreadPoolExecutor(max_workers=config.SYNC_WORKERS, thread_name_prefix="sync") as executor:
+                outcomes = list(executor.map(sync_code, pending))
+    finally:
+        if model.COORDINATOR:
+            model.COORDINATOR.stop()
+        if model.SAP_HANA_POOL:
+            model.SAP_HANA_POOL.close()
+
+    # Riepilogo del rilevamento delle modifiche sull'intera esecuzione
+    totals = {"new": 0, "changed": 0, "skipped": 0, "deleted": 0}
+    for outcome in outcomes:
+        for key in totals:
+            totals[key] += outcome[key] if outcome else 0
+    if config.CONTENT_HASH_ENABLED:
+        LOGGER.info(f"Documents in this run: {totals['new']} new, {totals['changed']} changed, {totals['skipped']} skipped")
+    if config.RECONCILE_DELETES and config.UPDATE_MODE == "INCREMENTAL":
+        LOGGER.info(f"Stale documents deleted in this run: {totals['deleted']}")
+
+    if config.UPDATE_MODE == "FULL":
+        # Elimino gli indici dei Code che non sono più presenti nella query master
+        model.delete_orphan_indices([row.get("Code", None) for row in results])
+
+    model.write_run_report()
+
+    failed = [row.get("Code", None) for row, outcome in zip(pending, outcomes) if outcome is None]
+    if model.JOURNAL and not failed:
+        # Esecuzione completata: la prossima parte da zero
+        model.JOURNAL.remove()
+    if failed:
+        LOGGER.error(f"Synchronization failed for {len(failed)} of {len(results)} codes: {failed}")
+        sys.exit(1)
+
+    LOGGER.info(f"Synchronization completed for {len(results)} codes")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,122 @@
+""" Connessione SAP HANA finta, compatibile con quanto `classes.SAP_HANA` usa di `hdbcli.dbapi`.
+
+La query master restituisce `codes` Code, ognuno con una query figlia che genera `rows` righe
+di `columns` colonne. Le righe vengono generate solo quando vengono lette con fetchmany,
+quindi la memoria occupata dal generatore non dipende dal numero di righe.
+"""
+
+import datetime
+import decimal
+import re
+
+# Tipi delle colonne generate, ripetuti in ordine fino a raggiungere il numero di colonne richiesto:
+# (type code SAP HANA, lunghezza, funzione che genera il valore dalla riga e dalla colonna)
+COLUMN_TYPES = [
+    (3, 10, lambda row, col: row * 31 + col),                                              # INTEGER
+    (11, 40, lambda row, col: f"Value {row % 997} of column {col}"),                       # NVARCHAR
+    (5, 19, lambda row, col: decimal.Decimal(row % 100000) / 100),                         # DECIMAL
+    (16, 27, lambda row, col: datetime.datetime(2024, 1, 1) + datetime.timedelta(seconds=row)),  # TIMESTAMP
+    (7, 15, lambda row, col: row / 7),                                                     # DOUBLE
+    (11, 500, lambda row, col: f"Long description {row} " * 4),                            # NVARCHAR lungo (text)
+]
+
+CHILD_QUERY_PATTERN = re.compile(r"BENCH_CHILD\((\w+)\)")
+KEY_QUERY_PATTERN = re.compile(r'^SELECT "([^"]+)" FROM \(')
+# Query usate dall'estrazione partizionata: conteggio, limiti per quantili e filtri sugli intervalli della chiave
+COUNT_QUERY_PATTERN = re.compile(r'^SELECT COUNT\(\*\) AS "([^"]+)" FROM \(')
+BOUNDARY_QUERY_PATTERN = re.compile(r'ROW_NUMBER\(\) OVER')
+RANGE_LOWER_PATTERN = re.compile(r'"ItemCode" > \?')
+RANGE_UPPER_PATTERN = re.compile(r'"ItemCode" <= \?')
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self._connection = connection
+        self._rows = iter(())
+        self.description = None
+
+    def execute(self, query, params=None):
+        self._connection.queries.append(query)
+        params = list(params or [])
+        if query == self._connection.master_query:
+            self.description = [
+                ("Code", 11, 50, 50, None, None, 1),
+                ("Name", 11, 100, 100, None, None, 1),
+                ("U_KAI_FUNCTION", 11, 500, 500, None, None, 1)
+            ]
+            self._rows = iter([
+                (f"BENCH{i:03d}", f"Benchmark code {i}", f"SELECT * FROM BENCH_CHILD(BENCH{i:03d})")
+                for i in range(self._connection.codes)
+            ])
+            return
+
+        match = CHILD_QUERY_PATTERN.search(query)
+        if match is None:
+            raise ValueError(f"Unexpected query: {query!r}")
+
+        rows = range(self._connection.rows)
+        count_match = COUNT_QUERY_PATTERN.match(query)
+        if count_match:
+            self.description = [(count_match.group(1), 4, 19, 19, None, None, 0)]
+            self._rows = iter([(len(rows),)])
+            return
+        if BOUNDARY_QUERY_PATTERN.search(query):
+            # Le chiavi ITEM0000000000, ITEM0000000001, ... sono già in ordine di riga
+            step = params[-1]
+            self.description = [("ItemCode", 11, 20, 20, None, None, 1)]
+            self._rows = iter([(f"ITEM{row:010d}",) for row in rows if (row + 1) % step == 0])
+            return
+        if query.endswith("LIMIT 0"):
+            rows = range(0)
+        elif RANGE_LOWER_PATTERN.search(query) or RANGE_UPPER_PATTERN.search(query):
+            bounds = iter(params)
+            lower = int(next(bounds)[4:]) + 1 if RANGE_LOWER_PATTERN.search(query) else 0
+            upper = int(next(bounds)[4:]) + 1 if RANGE_UPPER_PATTERN.search(query) else len(rows)
+            rows = range(lower, min(upper, len(rows)))
+
+        description = [("ItemCode", 11, 20, 20, None, None, 1)]
+        generators = [lambda row, col: f"ITEM{row:010d}"]
+        for col in range(1, self._connection.columns):
+            type_code, length, generator = COLUMN_TYPES[(col - 1) % len(COLUMN_TYPES)]
+            description.append((f"Column{col:03d}", type_code, length, length, None, None, 1))
+            generators.append(generator)
+
+        key_match = KEY_QUERY_PATTERN.match(query)
+        if key_match:
+            # Query della sola colonna chiave, usata dalla riconciliazione delle eliminazioni
+            index = [column[0] for column in description].index(key_match.group(1))
+            description, generators = [description[index]], [generators[index]]
+
+        self.description = description
+        self._rows = (
+            tuple(generator(row, col) for col, generator in enumerate(generators))
+            for row in rows
+        )
+
+    def fetchmany(self, size):
+        return [row for _, row in zip(range(size), self._rows)]
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def close(self):
+        self._rows = iter(())
+
+
+class FakeConnection:
+    def __init__(self, master_query, codes, rows, columns):
+        self.master_query = master_query
+        self.codes = codes
+        self.rows = rows
+        self.columns = columns
+        self.queries = []
+        self.connected = True
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def isconnected(self):
+        return self.connected
+
+    def close(self):
+        self.connected = False
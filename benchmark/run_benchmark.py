@@ -0,0 +1,254 @@
+""" Benchmark end to end della sincronizzazione, senza SAP HANA né Elasticsearch reali.
+
+Avvia in un processo separato il server Elasticsearch finto (`stub_elasticsearch.py`), sostituisce
+`hdbcli.dbapi.connect` con la connessione finta di `fake_hana.py` ed esegue `run.main` una o più volte.
+Al termine riporta righe al secondo, picco di memoria (RSS) del processo di sincronizzazione e numero
+di richieste ricevute dal server per API.
+
+Esempio:
+    python benchmark/run_benchmark.py --codes 4 --rows 200000 --columns 20 --runs 2 --update-mode INCREMENTAL
+
+Le variabili d'ambiente dell'applicazione (BULK_CHUNK_DOCS, SYNC_WORKERS, PIPELINE_MODE, ...) vengono
+rispettate, così lo stesso benchmark può confrontare configurazioni diverse.
+
+Con `--snapshot DIR` le esecuzioni caricano lo snapshot in DIR (SNAPSHOT_MODE LOAD) invece di leggere
+dalla connessione finta: così si misura solo il caricamento, anche con uno snapshot esportato da un
+sistema reale. Se DIR non contiene uno snapshot, viene prima esportato quello dei dati generati.
+
+Con `--workers N` ogni esecuzione avvia N processi con il coordinamento attivo (COORDINATION_ENABLED),
+che si dividono i Code tramite i lease sul server finto come farebbero più container.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), "app")
+sys.path.insert(0, BENCHMARK_DIR)
+
+import fake_hana
+import stub_elasticsearch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the SAP HANA -> Elasticsearch sync")
+    parser.add_argument("--codes", type=int, default=2, help="Codes returned by the master query")
+    parser.add_argument("--rows", type=int, default=100000, help="Rows returned by each child query")
+    parser.add_argument("--columns", type=int, default=12, help="Columns of each child query row")
+    parser.add_argument("--runs", type=int, default=1, help="Consecutive runs of run.main (later runs hit existing indices)")
+    parser.add_argument("--update-mode", choices=["FULL", "INCREMENTAL"], default="INCREMENTAL")
+    parser.add_argument("--port", type=int, default=0, help="Port of the stub Elasticsearch server, 0 for a free one")
+    parser.add_argument("--workers", type=int, default=1, help="Coordinated processes per run, each claiming codes through leases")
+    parser.add_argument("--snapshot", help="Load this snapshot directory instead of the fake connection, exporting it first if missing")
+    parser.add_argument("--output", help="Also write the results as JSON to this file")
+    return parser.parse_args()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(url, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"Stub Elasticsearch server not reachable at {url}")
+
+
+def server_stats(url):
+    with urllib.request.urlopen(f"{url}/_bench/stats", timeout=5) as response:
+        return json.loads(response.read())
+
+
+def peak_rss_mb(children=False):
+    # ru_maxrss è in kilobyte su Linux e in byte su macOS; per i processi figli è quello del più grande
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def snapshot_rows(snapshot_dir):
+    with open(os.path.join(snapshot_dir, "manifest.json"), encoding="utf-8") as manifest_file:
+        codes = [row["Code"].lower() for row in json.load(manifest_file)["rows"]]
+    rows = 0
+    for code in codes:
+        with open(os.path.join(snapshot_dir, f"{code}.json"), encoding="utf-8") as metadata_file:
+            rows += json.load(metadata_file)["rows"]
+    return len(codes), rows
+
+
+def run_worker(args, workdir, worker_no):
+    """ Esegue run.main in un processo separato, come una delle istanze coordinate. """
+
+    worker_dir = os.path.join(workdir, f"worker-{worker_no}")
+    os.makedirs(worker_dir, exist_ok=True)
+    os.environ.update({
+        "COORDINATION_ENABLED": "true",
+        "WORKER_ID": f"benchmark-{worker_no}",
+        "RUN_REPORT_PATH": os.path.join(worker_dir, "run_report.json")
+    })
+    # Le esecuzioni del benchmark sono consecutive: ognuna deve risincronizzare i Code completati dalla precedente
+    os.environ.setdefault("COORDINATION_RUN_WINDOW", "0")
+    os.chdir(worker_dir)
+    sys.path.insert(0, APP_DIR)
+
+    import classes
+    import config
+    import run
+
+    classes.dbapi.connect = lambda **kwargs: fake_hana.FakeConnection(
+        config.SAP_HANA_MASTER_QUERY, args.codes, args.rows, args.columns
+    )
+    run.main()
+
+
+def run_workers(args, workdir):
+    # spawn: i processi non devono ereditare i moduli dell'applicazione già importati da questo processo
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_worker, args=(args, workdir, worker_no)) for worker_no in range(1, args.workers + 1)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    failed = [worker_no for worker_no, worker in enumerate(workers, start=1) if worker.exitcode]
+    if failed:
+        raise RuntimeError(f"Workers {failed} failed, see {workdir}/worker-N/logs/Log.log")
+
+    synced = {}
+    for worker_no in range(1, args.workers + 1):
+        with open(os.path.join(workdir, f"worker-{worker_no}", "run_report.json"), encoding="utf-8") as report_file:
+            codes = json.load(report_file)["codes"]
+        synced[worker_no] = sorted(code for code, entry in codes.items() if entry["status"] == "ok")
+    return synced
+
+
+def main():
+    args = parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+    snapshot_dir = os.path.abspath(args.snapshot) if args.snapshot else None
+    port = args.port or free_port()
+    url = f"http://127.0.0.1:{port}"
+
+    server = multiprocessing.Process(
+        target=stub_elasticsearch.serve,
+        args=(port, os.environ.get("CONTENT_HASH_FIELD", "radar_content_hash")),
+        daemon=True
+    )
+    server.start()
+    workdir = tempfile.mkdtemp(prefix="radar-benchmark-")
+
+    try:
+        wait_for_server(url)
+
+        # La configurazione viene letta all'import di config, quindi va impostata prima
+        os.environ.update({
+            "ELASTIC_HOST": url,
+            "ELASTIC_USERNAME": "benchmark",
+            "ELASTIC_PASSWORD": "benchmark",
+            "SAP_HANA_HOST": "fake",
+            "SAP_HANA_PORT": "30015",
+            "SAP_HANA_USER": "benchmark",
+            "SAP_HANA_PASSWORD": "benchmark",
+            "UPDATE_MODE": args.update_mode,
+            "RUN_MODE": "ONCE"
+        })
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+        os.environ.setdefault("RUN_REPORT_PATH", os.path.join(workdir, "run_report.json"))
+        os.environ.setdefault("PROMETHEUS_TEXTFILE_PATH", "")
+        if snapshot_dir:
+            os.environ["SNAPSHOT_DIR"] = snapshot_dir
+            os.environ["SNAPSHOT_MODE"] = "LOAD"
+        os.chdir(workdir)  # run.main scrive i log in ./logs
+        sys.path.insert(0, APP_DIR)
+
+        import classes
+        import config
+        import run
+
+        classes.dbapi.connect = lambda **kwargs: fake_hana.FakeConnection(
+            config.SAP_HANA_MASTER_QUERY, args.codes, args.rows, args.columns
+        )
+
+        total_rows = args.codes * args.rows
+        if snapshot_dir:
+            if not os.path.exists(os.path.join(snapshot_dir, "manifest.json")):
+                # La modalità viene letta da run.main a ogni chiamata, quindi basta cambiarla per l'esportazione
+                config.SNAPSHOT_MODE = "EXPORT"
+                started = time.perf_counter()
+                run.main()
+                print(f"Exported snapshot to {snapshot_dir} in {time.perf_counter() - started:.2f}s")
+                config.SNAPSHOT_MODE = "LOAD"
+            codes, total_rows = snapshot_rows(snapshot_dir)
+            print(f"Loading snapshot {snapshot_dir}: {codes} codes, {total_rows} rows")
+
+        results = []
+        for run_no in range(1, args.runs + 1):
+            requests_before = server_stats(url)["requests"]
+            started = time.perf_counter()
+            synced = None
+            if args.workers > 1:
+                synced = run_workers(args, workdir)
+            else:
+                try:
+                    run.main()
+                except SystemExit as e:
+                    if e.code:
+                        raise RuntimeError(f"run.main exited with code {e.code}, see {workdir}/logs/Log.log")
+            elapsed = time.perf_counter() - started
+
+            stats = server_stats(url)
+            requests = {
+                endpoint: count - requests_before.get(endpoint, 0)
+                for endpoint, count in sorted(stats["requests"].items())
+                if count - requests_before.get(endpoint, 0) and not endpoint.endswith("_bench")
+            }
+            rows = total_rows
+            results.append({
+                "run": run_no,
+                "seconds": round(elapsed, 3),
+                "rows": rows,
+                "rows_per_second": round(rows / elapsed, 1),
+                "peak_rss_mb": peak_rss_mb(children=synced is not None),
+                "requests": requests,
+                "synced_by_worker": synced
+            })
+            print(f"Run {run_no}: {rows} rows in {elapsed:.2f}s, {rows / elapsed:,.0f} rows/s, "
+                  f"peak RSS {peak_rss_mb(children=synced is not None)} MB, {sum(requests.values())} requests")
+            for worker_no, codes in (synced or {}).items():
+                print(f"    worker {worker_no}: {len(codes)} codes synced {codes}")
+            for endpoint, count in requests.items():
+                print(f"    {endpoint:<24} {count}")
+
+        summary = {
+            "codes": args.codes,
+            "rows_per_code": args.rows,
+            "columns": args.columns,
+            "update_mode": args.update_mode,
+            "snapshot": snapshot_dir,
+            "runs": results
+        }
+        if output:
+            with open(output, "w", encoding="utf-8") as output_file:
+                json.dump(summary, output_file, indent=2)
+        return summary
+    finally:
+        server.terminate()
+        server.join()
+
+
+if __name__ == "__main__":
+    main()
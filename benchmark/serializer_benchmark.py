@@ -0,0 +1,99 @@
+""" Confronto della preparazione dei payload bulk: percorso precedente e serializzatori con conversioni per colonna.
+
+Per ogni variante vengono lette dal cursore finto di `fake_hana.py` le stesse righe, costruiti i dizionari,
+calcolato l'hash del contenuto e serializzate azione e documento come righe NDJSON:
+
+- `baseline`: dizionari con i valori originali, hash e righe serializzati con il JsonSerializer del client
+  Elasticsearch, che riconosce il tipo di ogni valore non JSON (il percorso usato prima delle conversioni);
+- `converters+json`: conversioni per colonna preparate dallo schema e `classes.BulkSerializer`;
+- `converters+orjson`: conversioni per colonna e `classes.OrjsonBulkSerializer`, se orjson è installato.
+
+Esempio:
+    python benchmark/serializer_benchmark.py --rows 200000 --columns 20
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_DIR)
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARK_DIR), "app"))
+
+# La configurazione dell'applicazione richiede queste variabili, che qui non vengono usate
+for variable in ("ELASTIC_USERNAME", "ELASTIC_PASSWORD", "SAP_HANA_HOST", "SAP_HANA_PORT", "SAP_HANA_USER", "SAP_HANA_PASSWORD"):
+    os.environ.setdefault(variable, "benchmark")
+
+from elasticsearch.serializer import JsonSerializer
+import classes
+import fake_hana
+import model
+
+HASH_FIELD = "radar_content_hash"
+
+
+def read_results(args, converters):
+    connection = fake_hana.FakeConnection("MASTER", 1, args.rows, args.columns)
+    cursor = connection.cursor()
+    cursor.execute("SELECT * FROM BENCH_CHILD(BENCH000)")
+    results = classes.ResultStream(cursor, args.batch_size)
+    if converters:
+        results.converters = model.build_column_converters(results.schema)
+    return results
+
+
+def baseline(args):
+    serializer = JsonSerializer()
+    size = 0
+    for batch in read_results(args, converters=False):
+        for document in batch:
+            content = json.dumps(document, sort_keys=True, separators=(",", ":"), default=serializer.default)
+            document[HASH_FIELD] = hashlib.blake2b(content.encode("utf-8"), digest_size=16).hexdigest()
+            size += len(serializer.dumps({"update": {"_index": "bench", "_id": str(document["ItemCode"])}}))
+            size += len(serializer.dumps({"doc": document, "doc_as_upsert": True}))
+    return size
+
+
+def with_converters(serializer):
+    def run(args):
+        size = 0
+        for batch in read_results(args, converters=True):
+            for document in batch:
+                document[HASH_FIELD] = hashlib.blake2b(serializer.dumps_sorted(document), digest_size=16).hexdigest()
+                size += len(serializer.dumps({"update": {"_index": "bench", "_id": str(document["ItemCode"])}}))
+                size += len(serializer.dumps({"doc": document, "doc_as_upsert": True}))
+        return size
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the bulk payload preparation")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--columns", type=int, default=12)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per variant, the fastest one is reported")
+    args = parser.parse_args()
+
+    variants = [("baseline", baseline), ("converters+json", with_converters(classes.BulkSerializer()))]
+    if classes.orjson is not None:
+        variants.append(("converters+orjson", with_converters(classes.OrjsonBulkSerializer())))
+    else:
+        print("orjson is not installed, skipping the orjson variant")
+
+    reference = None
+    for name, variant in variants:
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            size = variant(args)
+            timings.append(time.perf_counter() - started)
+        best = min(timings)
+        reference = reference or best
+        print(f"{name:<20} {args.rows / best:>12,.0f} rows/s  {size / best / 1024 / 1024:>8.1f} MB/s  x{reference / best:.2f}")
+
+
+if __name__ == "__main__":
+    main()
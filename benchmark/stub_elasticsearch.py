@@ -0,0 +1,342 @@
+""" Server HTTP che simula le API di Elasticsearch usate da `model.py`, per i benchmark senza cluster.
+
+Degli indici vengono mantenuti metadati, alias, impostazioni e, per ogni documento, solo l'_id, l'hash
+del contenuto e la dimensione della riga NDJSON ricevuta (per `_stats`): abbastanza per il rilevamento delle modifiche, la riconciliazione delle eliminazioni e
+le ricostruzioni FULL, con una memoria contenuta anche con milioni di documenti.
+I documenti scritti singolarmente (`_doc`, `_create`, come i lease del coordinamento) vengono invece
+mantenuti per intero, con `_seq_no` e `_primary_term` per le scritture condizionate.
+Il numero di richieste ricevute per API è disponibile su `GET /_bench/stats`.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, unquote, parse_qs
+import collections
+import itertools
+import json
+import threading
+import time
+
+
+class StubElasticsearch:
+    def __init__(self, hash_field="radar_content_hash"):
+        self.hash_field = hash_field
+        self.indices = {}
+        self.pits = {}
+        self.requests = collections.Counter()
+        self.bytes_received = 0
+        self.lock = threading.Lock()
+        self._pit_ids = itertools.count(1)
+
+    # --- Risoluzione dei nomi ---
+
+    def resolve(self, name):
+        if name in self.indices:
+            return [name]
+        if name in ("*", "_all"):
+            return list(self.indices)
+        return [index for index, info in self.indices.items() if name in info["aliases"]]
+
+    def resolve_one(self, name):
+        indices = self.resolve(name)
+        if len(indices) != 1:
+            raise KeyError(name)
+        return indices[0]
+
+    # --- API ---
+
+    def info(self, method, path, query, body):
+        if method == "HEAD":
+            return 200, None
+        return 200, {"name": "stub", "cluster_name": "benchmark", "version": {"number": "8.5.1"}, "tagline": "You Know, for Search"}
+
+    def index(self, method, name, query, body):
+        if method == "HEAD":
+            return (200 if self.resolve(name) else 404), None
+        if method == "PUT":
+            if name in self.indices:
+                return 400, {"error": {"type": "resource_already_exists_exception"}, "status": 400}
+            mappings = body.get("mappings", {})
+            self.indices[name] = {
+                "meta": mappings.get("_meta", {}),
+                "aliases": set(body.get("aliases", {})),
+                "settings": {},
+                "docs": {},
+                "sizes": {},
+                "versions": {},
+                "sources": {},
+                "seq_no": 0
+            }
+            return 200, {"acknowledged": True, "shards_acknowledged": True, "index": name}
+        if method == "DELETE":
+            for index in self.resolve(name):
+                del self.indices[index]
+            return 200, {"acknowledged": True}
+        return 405, {"error": "method not allowed"}
+
+    def get_alias(self, names):
+        return 200, {index: {"aliases": {alias: {} for alias in self.indices[index]["aliases"]}} for index in names}
+
+    def mapping(self, method, names, body):
+        if method == "GET":
+            return 200, {index: {"mappings": {"_meta": self.indices[index]["meta"]}} for index in names}
+        for index in names:
+            if "_meta" in body:
+                self.indices[index]["meta"] = body["_meta"]
+        return 200, {"acknowledged": True}
+
+    def settings(self, method, names, body):
+        if method == "GET":
+            return 200, {index: {"settings": dict(self.indices[index]["settings"])} for index in names}
+        for index in names:
+            for key, value in body.items():
+                if value is None:
+                    self.indices[index]["settings"].pop(key, None)
+                else:
+                    self.indices[index]["settings"][key] = str(value)
+        return 200, {"acknowledged": True}
+
+    def bulk(self, raw_body):
+        lines = iter(line for line in raw_body.split(b"\n") if line)
+        items = []
+        started = time.perf_counter()
+        for line in lines:
+            operation, meta = next(iter(json.loads(line).items()))
+            source_line = next(lines) if operation != "delete" else None
+            source = json.loads(source_line) if source_line else None
+            try:
+                info = self.indices[self.resolve_one(meta["_index"])]
+                docs = info["docs"]
+            except KeyError:
+                items.append({operation: {"_index": meta["_index"], "_id": meta.get("_id"), "status": 404,
+                                          "error": {"type": "index_not_found_exception"}}})
+                continue
+
+            if operation == "delete":
+                found = docs.pop(meta["_id"], False) is not False
+                info["sizes"].pop(meta["_id"], None)
+                info["versions"].pop(meta["_id"], None)
+                items.append({operation: {"_index": meta["_index"], "_id": meta["_id"], "status": 200 if found else 404,
+                                          "result": "deleted" if found else "not_found"}})
+                continue
+
+            if meta.get("version_type") in ("external", "external_gte"):
+                # Con la versione esterna la scrittura riesce solo se la versione è maggiore (o uguale, con external_gte)
+                # di quella salvata
+                stored_version = info["versions"].get(meta["_id"])
+                if stored_version is not None and (meta["version"] < stored_version or
+                                                   meta["version"] == stored_version and meta["version_type"] == "external"):
+                    items.append({operation: {"_index": meta["_index"], "_id": meta["_id"], "status": 409,
+                                              "error": {"type": "version_conflict_engine_exception",
+                                                        "reason": f"[{meta['_id']}]: version conflict"}}})
+                    continue
+                info["versions"][meta["_id"]] = meta["version"]
+
+            document = source.get("doc", source) if operation == "update" else source
+            created = meta["_id"] not in docs
+            docs[meta["_id"]] = document.get(self.hash_field)
+            info["sizes"][meta["_id"]] = len(source_line)
+            items.append({operation: {"_index": meta["_index"], "_id": meta["_id"], "status": 201 if created else 200,
+                                      "result": "created" if created else "updated"}})
+        took = int((time.perf_counter() - started) * 1000)
+        return 200, {"took": took, "errors": False, "items": items}
+
+    def mget(self, name, body):
+        docs = self.indices[self.resolve_one(name)]["docs"]
+        result = []
+        for doc_id in body.get("ids", []):
+            if doc_id in docs:
+                result.append({"_index": name, "_id": doc_id, "found": True, "_source": {self.hash_field: docs[doc_id]}})
+            else:
+                result.append({"_index": name, "_id": doc_id, "found": False})
+        return 200, {"docs": result}
+
+    def document(self, method, name, api, doc_id, query, body):
+        info = self.indices[self.resolve_one(name)]
+        stored = info["sources"].get(doc_id)
+        if method == "GET":
+            if stored is None:
+                return 404, {"_index": name, "_id": doc_id, "found": False}
+            return 200, {"_index": name, "_id": doc_id, "_version": stored["seq_no"] + 1, "_seq_no": stored["seq_no"],
+                         "_primary_term": 1, "found": True, "_source": stored["source"]}
+
+        # Scritture condizionate: _create solo se il documento non esiste, if_seq_no solo se non è cambiato
+        if_seq_no = query.get("if_seq_no", [None])[0]
+        conflict = (
+            (api == "_create" or query.get("op_type") == ["create"]) and stored is not None
+            or if_seq_no is not None and (stored is None or stored["seq_no"] != int(if_seq_no))
+        )
+        if conflict:
+            return 409, {"error": {"type": "version_conflict_engine_exception",
+                                   "reason": f"[{doc_id}]: version conflict"}, "status": 409}
+
+        seq_no = info["seq_no"]
+        info["seq_no"] += 1
+        info["sources"][doc_id] = {"source": body, "seq_no": seq_no}
+        info["docs"][doc_id] = body.get(self.hash_field)
+        return (201 if stored is None else 200), {"_index": name, "_id": doc_id, "_version": seq_no + 1,
+                                                  "result": "created" if stored is None else "updated",
+                                                  "_seq_no": seq_no, "_primary_term": 1}
+
+    def stats(self, names):
+        indices = {
+            index: {"primaries": {"docs": {"count": len(self.indices[index]["docs"])},
+                                  "store": {"size_in_bytes": sum(self.indices[index]["sizes"].values())}}}
+            for index in names
+        }
+        total = {
+            "docs": {"count": sum(entry["primaries"]["docs"]["count"] for entry in indices.values())},
+            "store": {"size_in_bytes": sum(entry["primaries"]["store"]["size_in_bytes"] for entry in indices.values())}
+        }
+        return 200, {"_all": {"primaries": total}, "indices": indices}
+
+    def update_aliases(self, body):
+        for action in body.get("actions", []):
+            operation, params = next(iter(action.items()))
+            if operation == "add":
+                self.indices[params["index"]]["aliases"].add(params["alias"])
+            elif operation == "remove":
+                self.indices[params["index"]]["aliases"].discard(params["alias"])
+            elif operation == "remove_index":
+                self.indices.pop(params["index"], None)
+        return 200, {"acknowledged": True}
+
+    def cat_indices(self):
+        return 200, [
+            {"index": index, "health": "green", "status": "open", "docs.count": str(len(info["docs"])), "store.size": "0b"}
+            for index, info in self.indices.items()
+        ]
+
+    def open_pit(self, name):
+        pit_id = f"pit-{next(self._pit_ids)}"
+        # Il point in time è una fotografia degli _id presenti al momento dell'apertura
+        self.pits[pit_id] = [(index, doc_id) for index in self.resolve(name) for doc_id in self.indices[index]["docs"]]
+        return 200, {"id": pit_id}
+
+    def search(self, body):
+        pit_id = body["pit"]["id"]
+        snapshot = self.pits[pit_id]
+        start = body["search_after"][0] + 1 if body.get("search_after") else 0
+        size = body.get("size", 10)
+        hits = [
+            {"_index": index, "_id": doc_id, "sort": [position]}
+            for position, (index, doc_id) in enumerate(snapshot[start:start + size], start=start)
+        ]
+        return 200, {"pit_id": pit_id, "took": 0, "timed_out": False, "hits": {"hits": hits}}
+
+    def search_index(self, names, body):
+        # Ricerca semplice su un indice: tutti i documenti in ordine di inserimento, paginati con from/size
+        docs = [(index, doc_id, content_hash) for index in names for doc_id, content_hash in self.indices[index]["docs"].items()]
+        start = body.get("from", 0)
+        hits = [
+            {"_index": index, "_id": doc_id, "_source": {self.hash_field: content_hash}}
+            for index, doc_id, content_hash in docs[start:start + body.get("size", 10)]
+        ]
+        return 200, {"took": 0, "timed_out": False, "hits": {"total": {"value": len(docs), "relation": "eq"}, "hits": hits}}
+
+    def close_pit(self, body):
+        self.pits.pop(body.get("id"), None)
+        return 200, {"succeeded": True, "num_freed": 1}
+
+    # --- Instradamento ---
+
+    def handle(self, method, path, query, raw_body):
+        segments = [unquote(segment) for segment in path.strip("/").split("/") if segment]
+        body = json.loads(raw_body) if raw_body and not segments[-1:] == ["_bulk"] else {}
+        endpoint = next((segment for segment in segments if segment.startswith("_")), "index" if segments else "root")
+        with self.lock:
+            self.requests[f"{method} {endpoint}"] += 1
+            self.bytes_received += len(raw_body)
+
+            if segments[:2] == ["_bench", "stats"]:
+                return 200, {"requests": dict(self.requests), "bytes_received": self.bytes_received}
+            if not segments:
+                return self.info(method, path, query, body)
+            if segments[-1] == "_bulk":
+                return self.bulk(raw_body)
+            if segments == ["_aliases"]:
+                return self.update_aliases(body)
+            if segments[:2] == ["_cat", "indices"]:
+                return self.cat_indices()
+            if segments == ["_search"]:
+                return self.search(body)
+            if segments == ["_pit"]:
+                return self.close_pit(body)
+
+            name = segments[0]
+            if len(segments) == 1:
+                return self.index(method, name, query, body)
+
+            names = self.resolve(name)
+            if not names and name not in ("*", "_all"):
+                return 404, {"error": {"type": "index_not_found_exception", "index": name}, "status": 404}
+
+            api = segments[1]
+            if api == "_alias":
+                return self.get_alias(names)
+            if api == "_mapping":
+                return self.mapping(method, names, body)
+            if api == "_settings":
+                return self.settings(method, names, body)
+            if api == "_mget":
+                return self.mget(name, body)
+            if api == "_pit":
+                return self.open_pit(name)
+            if api == "_search":
+                return self.search_index(names, body)
+            if api == "_stats":
+                return self.stats(names)
+            if api in ("_doc", "_create") and len(segments) == 3:
+                return self.document(method, name, api, segments[2], query, body)
+            if api in ("_refresh", "_forcemerge"):
+                return 200, {"_shards": {"total": 1, "successful": 1, "failed": 0}}
+            return 400, {"error": f"unsupported endpoint {method} {path}"}
+
+
+def make_handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _dispatch(self, method):
+            url = urlsplit(self.path)
+            raw_body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            try:
+                status, response = stub.handle(method, url.path, parse_qs(url.query), raw_body)
+            except Exception as e:
+                status, response = 500, {"error": {"type": "stub_exception", "reason": repr(e)}, "status": 500}
+
+            payload = b"" if response is None or method == "HEAD" else json.dumps(response).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("X-Elastic-Product", "Elasticsearch")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            if payload:
+                self.wfile.write(payload)
+
+        def do_GET(self):
+            self._dispatch("GET")
+
+        def do_HEAD(self):
+            self._dispatch("HEAD")
+
+        def do_PUT(self):
+            self._dispatch("PUT")
+
+        def do_POST(self):
+            self._dispatch("POST")
+
+        def do_DELETE(self):
+            self._dispatch("DELETE")
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(port, hash_field="radar_content_hash"):
+    """ Avvia il server sulla porta indicata e resta in ascolto fino alla terminazione del processo. """
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(StubElasticsearch(hash_field)))
+    server.daemon_threads = True
+    server.serve_forever()